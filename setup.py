@@ -28,7 +28,7 @@ setup(
     platforms="any",
     packages=find_packages(),
     include_package_data=True,
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -42,11 +42,14 @@ setup(
         "xlrd",
     ],
     extras_require={
-        'violins': ['matplotlib', 'seaborn']
+        'violins': ['matplotlib', 'seaborn'],
+        'yaml': ['pyyaml'],
+        'columnar': ['pyarrow'],
+        'sparse': ['scipy']
     },
     entry_points={
         'console_scripts': [
-            'scouts=src.gui:main',
+            'scouts=src.cli:main',
             'scouts-violins=src.violins:main [violins]'
         ]
     }
@@ -1,70 +1,620 @@
+import logging
 import os
+import re
+import time
+import warnings
 from collections import namedtuple
+from contextlib import ExitStack
 from itertools import chain
-from typing import Dict, Generator, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from PySide2.QtWidgets import QMainWindow
-from openpyxl import Workbook, load_workbook
 
-from src.utils import NoReferenceError, PandasInputError, SampleNamingError
+from src.cache import load_cached_dataframe
+from src.catalog import CATALOG_FILE, CatalogWriter, RunCatalog
+from src.config import ScoutsConfig, get_scouts_config
+from src.manifest import ManifestWriter
+from src.profiling import RunProfiler
+from src.progress import CancellationToken, Progress, ProgressReporter
+from src.sketch import QuantileSketch, get_sketch_cutoff_error, get_sketch_cutoff_values
+from src.stages import STAGE_CACHE_FOLDER, StageCache
+from src.store import STORE_FILE, STORE_INDEX_FILE, StoreWriter
+from src.utils import InvalidConfigError, NoReferenceError, PandasInputError, SampleNamingError
+from src.writers import MergedWorkbookWriter, WriterPool, save_dataframe
 
 Stats = namedtuple("Stats", ['first_quartile', 'third_quartile', 'iqr', 'lower_cutoff', 'upper_cutoff'])
 Info = namedtuple("Info", ['cutoff_from', 'reference', 'outliers_for', 'category'])
-
-
-def start_scouts(widget: QMainWindow, input_file: str, output_folder: str, cutoff_rule: str, marker_rule: str,
-                 tukey_factor: float, export_csv: bool, export_excel: bool, single_excel: bool,
-                 sample_list: List[Tuple[str, str]], gating: str, gate_cutoff_value: Optional[float],
-                 export_gated: bool, non_outliers: bool, bottom_outliers: bool) -> None:
-    """Main SCOUTS function that organizes user input and calls related functions accordingly."""
-    # Loads df and checks for file extension
-    df = load_dataframe(input_file=input_file)
-
-    # Sets first column (sample names) as the index
-    df.set_index(df.columns[0], inplace=True)
-
-    # Gets markers from dataframe
-    markers = get_marker_names(df)
-
-    # Checks if all sample names are in at least one cell of the first column in the df
-    samples = get_all_sample_names(sample_list=sample_list)
-    validate_sample_names(samples=samples, df=df)
-
-    # Retrieves information on reference, if necessary:
-    reference = None
-    if 'ref' in cutoff_rule:
-        reference = get_reference_sample_name(sample_list=sample_list)
-
-    # Apply gates to df, if any
-    if gating == 'cytof':
-        apply_cytof_gating(df=df, cutoff=gate_cutoff_value)
-    elif gating == 'rnaseq':
-        apply_rnaseq_gating(df=df, cutoff=gate_cutoff_value)
-
-    # Gets cutoff dict -> { 'sample' : { 'marker' : Stats(Q1, Q3, IQR, CUTOFF_LOW, CUTOFF_HIGH) } }
-    cutoff_df = get_cutoff_dataframe(df=df, samples=samples, markers=markers, reference=reference,
-                                     cutoff_rule=cutoff_rule, tukey=tukey_factor)
-
-    # generate outlier tables (SCOUTS)
-    run_scouts(widget=widget, df=df, cutoff_df=cutoff_df, samples=samples, markers=markers, reference=reference,
-               cutoff_rule=cutoff_rule, marker_rule=marker_rule, export_csv=export_csv, export_excel=export_excel,
-               single_excel=single_excel, export_gated=export_gated, non_outliers=non_outliers,
-               bottom_outliers=bottom_outliers, output_folder=output_folder)
+GatingReport = namedtuple("GatingReport", ['rows_before', 'rows_dropped', 'seconds'])
+OutlierMasks = namedtuple("OutlierMasks", ['rows', 'top', 'bottom', 'non', 'non_any'])
+Selection = namedtuple("Selection", ['rows', 'mask'])
+
+# Input of a run, once loaded and gated: the DataFrame (sample names as its index), the rows of each sample in it
+# and the labels of the input before gating (used to check the sample names of a reused gated input)
+RunInput = namedtuple("RunInput", ['df', 'sample_index', 'labels'])
+
+# Cutoffs of a run, along with their error bounds (quantile sketches only) and the outlier masks and stats tables of
+# the "sample" cutoff source (only when worker processes calculated them along with the cutoffs)
+RunCutoffs = namedtuple("RunCutoffs", ['cutoff_df', 'error_df', 'sample_masks', 'sample_stats'])
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_MATCH_MODES = ('exact', 'substring', 'regex')
+QUANTILE_METHODS = ('exact', 'sketch')
+TABLE_FORMATS = ('xlsx', 'parquet', 'feather')
+STATS_FIELDS = ['#', 'mean', 'median', 'sd']
+PRECISIONS = ('float64', 'float32')
+
+# Number of rows read at a time when a .csv input is gated while it is loaded (see load_gated_csv)
+GATED_LOAD_CHUNK_ROWS = 100000
+
+# Positions of the lower and upper cutoffs in the last axis of cutoff arrays (samples x markers x Stats fields)
+FIRST_QUARTILE = Stats._fields.index('first_quartile')
+THIRD_QUARTILE = Stats._fields.index('third_quartile')
+IQR = Stats._fields.index('iqr')
+LOWER_CUTOFF = Stats._fields.index('lower_cutoff')
+UPPER_CUTOFF = Stats._fields.index('upper_cutoff')
+
+
+class SampleIndex:
+    """Maps each sample name to the labels and row positions of a DataFrame index that match it. This is built once
+    per run, so that selecting the rows of a sample never needs to scan the whole index again. Index labels are
+    matched against sample names by exact comparison, by substring ("sample name is part of the index label",
+    as described in the SCOUTS documentation) or as regular expressions."""
+    def __init__(self, index: pd.Index, samples: List[str], labels: Dict[str, pd.Index],
+                 positions: Dict[str, np.ndarray], match_mode: str) -> None:
+        self.index = index
+        self.samples = samples
+        self.labels = labels
+        self.positions = positions
+        self.match_mode = match_mode
+
+    @classmethod
+    def from_index(cls, index: pd.Index, samples: List[str], match_mode: str = 'substring') -> 'SampleIndex':
+        """Builds the SampleIndex for the given index. Each distinct label is matched only once, and row positions
+        are then gathered from the label codes, so repeated labels (e.g. one sample name per cell) are cheap."""
+        if match_mode not in SAMPLE_MATCH_MODES:
+            raise ValueError(f'sample match mode must be one of {SAMPLE_MATCH_MODES}, not "{match_mode}"')
+        codes, uniques = pd.factorize(index)
+        uniques = pd.Index(uniques)
+        labels = {}
+        positions = {}
+        for sample in samples:
+            matches = match_sample_name(labels=uniques, sample=sample, match_mode=match_mode)
+            labels[sample] = uniques[matches]
+            positions[sample] = np.flatnonzero(np.append(matches, False)[codes])  # code -1 (missing label) -> False
+        return cls(index=index, samples=list(samples), labels=labels, positions=positions, match_mode=match_mode)
+
+    def get_positions(self, sample: str) -> np.ndarray:
+        """Returns the row positions of the indexed DataFrame that belong to the sample."""
+        return self.positions[sample]
+
+    def get_slice(self, sample: str) -> Optional[slice]:
+        """Returns the rows of a sample as a slice, if they are contiguous in the indexed DataFrame."""
+        positions = self.positions[sample]
+        if len(positions) and positions[-1] - positions[0] + 1 == len(positions):
+            return slice(positions[0], positions[-1] + 1)
+        return None
+
+    def get_rows(self, sample: str) -> Union[slice, np.ndarray]:
+        """Returns the rows of a sample as a slice if they are contiguous, or as an array of positions otherwise."""
+        rows = self.get_slice(sample)
+        if rows is None:
+            return self.positions[sample]
+        return rows
+
+    def filter(self, df: pd.DataFrame, sample: str) -> pd.DataFrame:
+        """Selects the rows of a DataFrame that belong to the sample. Row positions are used for the indexed
+        DataFrame itself, while any other DataFrame (e.g. a subset of it) is filtered by the matched labels."""
+        if df.index is not self.index:
+            return df.loc[df.index.isin(self.labels[sample])]
+        return df.iloc[self.get_rows(sample)]
+
+    def make_contiguous(self, df: pd.DataFrame) -> Tuple[pd.DataFrame, 'SampleIndex']:
+        """Reorders the rows of the indexed DataFrame so that each sample is a contiguous slice (in sample order,
+        followed by rows that belong to no sample). Returns the reordered DataFrame along with its SampleIndex.
+        Raises an exception if a row belongs to more than one sample, since its position would be ambiguous."""
+        sample_positions = [self.positions[sample] for sample in self.samples]
+        order = np.concatenate(sample_positions) if sample_positions else np.array([], dtype=int)
+        if len(np.unique(order)) != len(order):
+            raise InvalidConfigError('cannot keep samples contiguous (contiguous_samples): some rows match more '
+                                     'than one sample name')
+        remaining = np.setdiff1d(np.arange(len(self.index)), order, assume_unique=True)
+        reordered_df = df.iloc[np.concatenate([order, remaining])]
+        positions = {}
+        start = 0
+        for sample, sample_rows in zip(self.samples, sample_positions):
+            positions[sample] = np.arange(start, start + len(sample_rows))
+            start += len(sample_rows)
+        sample_index = SampleIndex(index=reordered_df.index, samples=self.samples, labels=self.labels,
+                                   positions=positions, match_mode=self.match_mode)
+        return reordered_df, sample_index
+
+
+class SortedSampleValues:
+    """Keeps the values of each marker of each sample sorted (built once, with one sort per sample), so that
+    quantiles, ranks and the number of cells beyond any cutoff are found by binary search instead of by going
+    through every cell. NaN values are ignored. Uses as much memory as the values of all samples together,
+    so it is meant for interactive exploration of cutoffs rather than for a single SCOUTS run."""
+    def __init__(self, samples: List[str], markers: List[str], sorted_values: Dict[str, np.ndarray],
+                 counts: Dict[str, np.ndarray]) -> None:
+        self.samples = samples
+        self.markers = markers
+        self.sorted_values = sorted_values
+        self.counts = counts
+        self.marker_positions = {marker: i for i, marker in enumerate(markers)}
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, samples: List[str],
+                       sample_index: Optional[SampleIndex] = None) -> 'SortedSampleValues':
+        """Builds the sorted values of each sample (rows selected as in get_sample_rows) of an indexed DataFrame."""
+        values = get_values(df)
+        sorted_values = {}
+        counts = {}
+        for sample in samples:
+            sample_values = values[get_sample_rows(df=df, sample=sample, sample_index=sample_index)]
+            sorted_values[sample] = np.sort(sample_values, axis=0)  # NaNs are sorted to the end of each column
+            counts[sample] = np.count_nonzero(~np.isnan(sample_values), axis=0)
+        return cls(samples=list(samples), markers=get_marker_names(df), sorted_values=sorted_values, counts=counts)
+
+    def get_column(self, sample: str, marker: str) -> np.ndarray:
+        """Returns the sorted non-NaN values of a marker in a sample."""
+        position = self.marker_positions[marker]
+        return self.sorted_values[sample][:self.counts[sample][position], position]
+
+    def get_quantiles(self, sample: str, quantiles: List[float]) -> np.ndarray:
+        """Returns the quantiles of every marker of a sample (one row per quantile), as in get_quantiles."""
+        return get_sorted_quantiles(sorted_values=self.sorted_values[sample], counts=self.counts[sample],
+                                    quantiles=quantiles)
+
+    def get_cutoff_values(self, sample: str, tukey: float) -> np.ndarray:
+        """Returns the cutoff statistics of every marker of a sample (one row per marker), as in get_cutoff_values."""
+        first_quartile, third_quartile = self.get_quantiles(sample=sample, quantiles=[0.25, 0.75])
+        return get_tukey_cutoff_values(first_quartile=first_quartile, third_quartile=third_quartile, tukey=tukey)
+
+    def count_above(self, sample: str, marker: str, value: float) -> int:
+        """Returns the number of cells of a sample whose marker value is above the given value."""
+        column = self.get_column(sample=sample, marker=marker)
+        if np.isnan(value):
+            return 0
+        return len(column) - int(np.searchsorted(column, value, side='right'))
+
+    def count_below(self, sample: str, marker: str, value: float) -> int:
+        """Returns the number of cells of a sample whose marker value is below the given value."""
+        if np.isnan(value):
+            return 0
+        return int(np.searchsorted(self.get_column(sample=sample, marker=marker), value, side='left'))
+
+    def get_rank(self, sample: str, marker: str, value: float) -> float:
+        """Returns the fraction of cells of a sample (with a value for the marker) whose value is at most the given
+        value, or NaN if the marker has no values in the sample."""
+        column = self.get_column(sample=sample, marker=marker)
+        if not len(column):
+            return np.nan
+        return np.searchsorted(column, value, side='right') / len(column)
+
+    def count_outliers(self, sample: str, tukey: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the number of top outliers and of bottom outliers of every marker of a sample, for its own
+        cutoffs with the given Tukey factor."""
+        cutoff_values = self.get_cutoff_values(sample=sample, tukey=tukey)
+        top = [self.count_above(sample=sample, marker=marker, value=cutoff_values[i, UPPER_CUTOFF])
+               for i, marker in enumerate(self.markers)]
+        bottom = [self.count_below(sample=sample, marker=marker, value=cutoff_values[i, LOWER_CUTOFF])
+                  for i, marker in enumerate(self.markers)]
+        return np.array(top), np.array(bottom)
+
+
+class DenseBackend:
+    """Calculates the outlier masks and stats tables of run_scouts, and gathers the rows of its subsets, for input
+    data held as a DataFrame. Other ways of holding the input data (e.g. src.sparse.SparseBackend, for a
+    SparseFrame) override these methods, so that run_scouts selects and saves subsets the same way for all of them."""
+    def get_masks(self, df: pd.DataFrame, cutoff_df: pd.DataFrame, cutoff_rule: str, samples: List[str],
+                  reference: Optional[str], bottom_outliers: bool, non_outliers: bool,
+                  sample_index: Optional[SampleIndex] = None) -> Dict[str, OutlierMasks]:
+        """Computes the outlier masks of each cutoff source (see get_masks_by_cutoff_source)."""
+        return get_masks_by_cutoff_source(input_df=df, cutoff_df=cutoff_df, cutoff_rule=cutoff_rule, samples=samples,
+                                          reference=reference, bottom_outliers=bottom_outliers,
+                                          non_outliers=non_outliers, sample_index=sample_index)
+
+    def get_stats_dfs(self, df: pd.DataFrame, masks: Dict[str, OutlierMasks], markers: List[str], cutoff_rule: str,
+                      marker_rule: str, samples: List[str], bottom: bool, non: bool,
+                      sample_masks: Dict[str, np.ndarray],
+                      progress: Optional[ProgressReporter] = None) -> Dict[str, pd.DataFrame]:
+        """Calculates the stats tables from the outlier masks (see get_stats_dfs)."""
+        return get_stats_dfs(input_df=df, masks=masks, markers=markers, cutoff_rule=cutoff_rule,
+                             marker_rule=marker_rule, samples=samples, bottom=bottom, non=non,
+                             sample_masks=sample_masks, progress=progress)
+
+    def take(self, df: pd.DataFrame, positions: np.ndarray) -> pd.DataFrame:
+        """Returns the rows of a subset (as an array of positions), ready to be written by a WriterPool."""
+        return df.iloc[positions]
+
+    def save_gated(self, df: pd.DataFrame, output_folder: str, table_format: str) -> str:
+        """Saves the gated population in the output folder (see generate_gated_table), returning its path."""
+        gated_path = os.path.join(output_folder, f'gated_population.{table_format}')
+        generate_gated_table(df, gated_path)
+        return gated_path
+
+
+def match_sample_name(labels: pd.Index, sample: str, match_mode: str) -> np.ndarray:
+    """Returns a boolean array indicating which index labels match the sample name."""
+    labels = labels.astype(str)
+    if match_mode == 'exact':
+        return np.asarray(labels == sample)
+    try:
+        return np.asarray(labels.str.contains(sample, regex=(match_mode == 'regex')), dtype=bool)
+    except re.error as error:
+        raise InvalidConfigError(f'sample name "{sample}" is not a valid regular expression ({error})') from error
+
+
+def start_scouts(config: Optional[ScoutsConfig] = None, cancel_token: Optional[CancellationToken] = None,
+                 progress_callback: Optional[Callable[[Progress], None]] = None, **options: Any) -> None:
+    """Main SCOUTS function that organizes user input and calls related functions accordingly. The run options are
+    given as a ScoutsConfig and/or as keyword arguments (see src.config). The run goes through the load, gating,
+    cutoff, outlier and subset stages (see run_load_stage and the functions after it). The analysis stops with
+    AnalysisCancelledError soon after cancel_token is cancelled, and progress_callback (if given) receives the
+    progress of each stage of the run (see src.progress). The time, memory and output of each stage are saved as
+    run_profile.json in the output folder, along with a cProfile dump if profile_calls is True; profile_memory also
+    traces the memory allocated by each stage, at the cost of a much slower run (see src.profiling). With precision
+    'float32', the input values are held as float32 and the sample names as categorical codes, which halves the
+    memory used by the analysis. If reuse_stages is True, the gated data, cutoffs and outlier masks are saved in the
+    output folder (see src.stages), and the ones saved by a previous run are reused for every stage whose input file
+    and options did not change. If tukey_sweep is a list of Tukey factors, quartiles are calculated once and SCOUTS
+    is run for each factor (see run_tukey_sweep) instead of for tukey_factor alone. If sample_workers > 0 and
+    cutoffs are calculated from each sample (see use_sample_workers), the cutoffs, outlier masks and stats of each
+    sample are calculated by that many worker processes sharing the input values (see src.parallel)."""
+    config = get_scouts_config(config, **options)
+    profiler = RunProfiler(folder=config.output_folder, trace_memory=config.profile_memory,
+                           profile_calls=config.profile_calls)
+    with ProgressReporter(callback=progress_callback, cancel_token=cancel_token, profiler=profiler) as progress:
+        samples = get_all_sample_names(sample_list=config.sample_list)
+        stage_cache = None
+        if config.reuse_stages is True:
+            stage_cache = StageCache(folder=os.path.join(config.output_folder, STAGE_CACHE_FOLDER),
+                                     input_file=config.input_file)
+        run_input = get_gated_input(config=config, samples=samples, progress=progress, stage_cache=stage_cache)
+
+        # Gets markers from dataframe
+        markers = get_marker_names(run_input.df)
+
+        # Retrieves information on reference, if necessary:
+        reference = None
+        if 'ref' in config.cutoff_rule:
+            reference = get_reference_sample_name(sample_list=config.sample_list)
+
+        # Optionally places each sample's rows together
+        if config.contiguous_samples is True:
+            df, sample_index = run_input.sample_index.make_contiguous(run_input.df)
+            run_input = run_input._replace(df=df, sample_index=sample_index)
+
+        cutoffs = get_run_cutoffs(config=config, run_input=run_input, samples=samples, markers=markers,
+                                  reference=reference, progress=progress, stage_cache=stage_cache)
+
+        # Runs SCOUTS once per Tukey factor, all of them sharing the quartiles calculated above
+        if config.tukey_sweep is not None:
+            run_tukey_sweep(config=config, run_input=run_input, cutoff_df=cutoffs.cutoff_df, samples=samples,
+                            markers=markers, reference=reference, progress=progress)
+        else:
+            masks = get_run_masks(config=config, run_input=run_input, cutoffs=cutoffs, samples=samples,
+                                  reference=reference, progress=progress, stage_cache=stage_cache)
+            run_subset_stage(config=config, run_input=run_input, cutoff_df=cutoffs.cutoff_df, samples=samples,
+                             markers=markers, reference=reference, cutoff_error_df=cutoffs.error_df, masks=masks,
+                             sample_stats=cutoffs.sample_stats, progress=progress)
+        progress.finish()
+
+
+def get_load_precision(config: ScoutsConfig) -> str:
+    """Returns the precision of the values read by the load stage. Gating always sees float64 values, since rounding
+    them to float32 first could change which rows pass the gate, so the conversion then waits until after gating."""
+    return config.precision if config.gating == 'no_gate' else 'float64'
+
+
+def gate_while_loading(config: ScoutsConfig) -> bool:
+    """Returns whether the input is gated while it is loaded (see load_gated_csv), which keeps float32 runs from
+    ever holding all the float64 values of a .csv input at once."""
+    return (config.precision == 'float32' and config.gating != 'no_gate' and config.cache_folder is None
+            and config.input_file.endswith('.csv'))
+
+
+def run_load_stage(config: ScoutsConfig, samples: List[str], progress: ProgressReporter) -> RunInput:
+    """Loads the input file (from the cache folder, if given and the input was parsed before) with sample names as
+    the index, and checks that every sample name is in at least one cell of its first column."""
+    precision = get_load_precision(config=config)
+    if config.cache_folder is not None:
+        df = load_cached_dataframe(input_file=config.input_file, cache_folder=config.cache_folder,
+                                   loader=load_indexed_dataframe, precision=precision)
+    else:
+        df = load_indexed_dataframe(input_file=config.input_file, precision=precision)
+    df = set_dataframe_precision(df=df, precision=precision)
+    progress.advance(rows=len(df))
+    sample_index = SampleIndex.from_index(index=df.index, samples=samples, match_mode=config.sample_match)
+    validate_sample_names(samples=samples, df=df, sample_index=sample_index)
+    return RunInput(df=df, sample_index=sample_index, labels=list(pd.unique(df.index)))
+
+
+def run_gating_stage(config: ScoutsConfig, run_input: RunInput, samples: List[str],
+                     progress: ProgressReporter) -> RunInput:
+    """Applies the gating of the run (if any) to the loaded input, mapping samples to their rows again afterwards.
+    The DataFrame is gated in place, and only then converted to the precision of the run."""
+    df, gating_report = run_input.df, None
+    if config.gating == 'cytof':
+        progress.start_stage('gating', steps=len(df))
+        gating_report = apply_cytof_gating(df=df, cutoff=config.gate_cutoff_value, chunk_size=config.gate_chunk_size,
+                                           progress=progress)
+    elif config.gating == 'rnaseq':
+        progress.start_stage('gating')
+        gating_report = apply_rnaseq_gating(df=df, cutoff=config.gate_cutoff_value)
+    if gating_report is None:
+        return run_input
+    logger.info('%s gating dropped %d of %d rows in %.2f s', config.gating, gating_report.rows_dropped,
+                gating_report.rows_before, gating_report.seconds)
+    df = set_dataframe_precision(df=df, precision=config.precision)
+    return run_input._replace(df=df, sample_index=SampleIndex.from_index(index=df.index, samples=samples,
+                                                                         match_mode=config.sample_match))
+
+
+def run_gated_load_stage(config: ScoutsConfig, samples: List[str], progress: ProgressReporter) -> RunInput:
+    """Runs the load and gating stages together, gating a .csv input chunk by chunk as it is read (see
+    load_gated_csv). Sample names are checked against the labels of the input before gating, as in run_load_stage."""
+    df, labels, gating_report = load_gated_csv(input_file=config.input_file, gating=config.gating,
+                                               cutoff=config.gate_cutoff_value, precision=config.precision,
+                                               chunk_size=config.gate_chunk_size, progress=progress)
+    input_index = SampleIndex.from_index(index=pd.Index(labels), samples=samples, match_mode=config.sample_match)
+    validate_sample_names(samples=samples, df=df, sample_index=input_index)
+    logger.info('%s gating dropped %d of %d rows in %.2f s', config.gating, gating_report.rows_dropped,
+                gating_report.rows_before, gating_report.seconds)
+    sample_index = SampleIndex.from_index(index=df.index, samples=samples, match_mode=config.sample_match)
+    return RunInput(df=df, sample_index=sample_index, labels=labels)
+
+
+def get_gated_input(config: ScoutsConfig, samples: List[str], progress: ProgressReporter,
+                    stage_cache: Optional[StageCache] = None) -> RunInput:
+    """Runs the load and gating stages, reusing the gated input saved in the stage cache (if any) by a previous run
+    with the same input file and gating options. The sample names of a reused input are checked against the labels
+    of the input before gating, as they would be when loading it."""
+    gated_key = get_gated_stage_key(config=config)
+    progress.start_stage('loading')
+    if stage_cache is not None:
+        saved_labels = stage_cache.load(stage='labels', key=gated_key)
+        df = stage_cache.load_dataframe(stage='gated', key=gated_key) if saved_labels is not None else None
+        if df is not None:
+            labels = saved_labels.info
+            df = set_dataframe_precision(df=df, precision=config.precision)
+            progress.advance(rows=len(df))
+            input_index = SampleIndex.from_index(index=pd.Index(labels), samples=samples,
+                                                 match_mode=config.sample_match)
+            validate_sample_names(samples=samples, df=df, sample_index=input_index)
+            sample_index = SampleIndex.from_index(index=df.index, samples=samples, match_mode=config.sample_match)
+            return RunInput(df=df, sample_index=sample_index, labels=labels)
+    if gate_while_loading(config=config):
+        run_input = run_gated_load_stage(config=config, samples=samples, progress=progress)
+    else:
+        run_input = run_load_stage(config=config, samples=samples, progress=progress)
+        run_input = run_gating_stage(config=config, run_input=run_input, samples=samples, progress=progress)
+    if stage_cache is not None:
+        stage_cache.save_dataframe(stage='gated', key=gated_key, df=run_input.df)
+        stage_cache.save(stage='labels', key=gated_key, info=pd.Index(run_input.labels).tolist())
+    return run_input
+
+
+def use_sample_workers(config: ScoutsConfig) -> bool:
+    """Returns whether the cutoffs, outlier masks and stats of the "sample" cutoff source are calculated by worker
+    processes: this needs sample_workers > 0, exact quantiles, no Tukey sweep and no reused stages."""
+    return (config.sample_workers > 0 and 'sample' in config.cutoff_rule and config.quantile_method == 'exact'
+            and config.tukey_sweep is None and not config.reuse_stages)
+
+
+def run_cutoff_stage(config: ScoutsConfig, run_input: RunInput, samples: List[str], markers: List[str],
+                     reference: Optional[str], progress: ProgressReporter) -> RunCutoffs:
+    """Calculates the cutoffs of the run, as exact quartiles or with quantile sketches (along with their error
+    bounds). If use_sample_workers is True, the outlier masks and stats of the "sample" cutoff source are
+    calculated along with the cutoffs, by worker processes (see src.parallel)."""
+    if use_sample_workers(config=config):
+        from src.parallel import get_parallel_sample_results  # worker processes are only used when requested
+        results = get_parallel_sample_results(df=run_input.df, samples=samples, markers=markers,
+                                              tukey=config.tukey_factor, marker_rule=config.marker_rule,
+                                              bottom_outliers=config.bottom_outliers,
+                                              non_outliers=config.non_outliers, n_workers=config.sample_workers,
+                                              sample_index=run_input.sample_index, progress=progress)
+        return RunCutoffs(cutoff_df=results.cutoff_df, error_df=None, sample_masks=results.masks,
+                          sample_stats=results.stats)
+    if config.quantile_method == 'sketch':
+        cutoff_df, error_df = get_sketch_cutoff_dataframe(df=run_input.df, samples=samples, markers=markers,
+                                                          reference=reference, cutoff_rule=config.cutoff_rule,
+                                                          tukey=config.tukey_factor, error=config.sketch_error,
+                                                          sample_index=run_input.sample_index, progress=progress)
+        return RunCutoffs(cutoff_df=cutoff_df, error_df=error_df, sample_masks=None, sample_stats=None)
+    cutoff_df = get_cutoff_dataframe(df=run_input.df, samples=samples, markers=markers, reference=reference,
+                                     cutoff_rule=config.cutoff_rule, tukey=config.tukey_factor,
+                                     sample_index=run_input.sample_index, progress=progress)
+    return RunCutoffs(cutoff_df=cutoff_df, error_df=None, sample_masks=None, sample_stats=None)
+
+
+def get_run_cutoffs(config: ScoutsConfig, run_input: RunInput, samples: List[str], markers: List[str],
+                    reference: Optional[str], progress: ProgressReporter,
+                    stage_cache: Optional[StageCache] = None) -> RunCutoffs:
+    """Runs the cutoff stage, reusing the cutoffs saved in the stage cache (if any) by a previous run with the same
+    input and cutoff options."""
+    progress.start_stage('cutoffs', steps=1 if config.cutoff_rule == 'ref' else len(samples))
+    if stage_cache is None:
+        return run_cutoff_stage(config=config, run_input=run_input, samples=samples, markers=markers,
+                                reference=reference, progress=progress)
+    cutoff_key = get_cutoff_stage_key(config=config, samples=samples, reference=reference)
+    saved_cutoffs = stage_cache.load_frames(stage='cutoffs', key=cutoff_key)
+    if saved_cutoffs is not None:
+        cutoff_df, error_df = saved_cutoffs
+        return RunCutoffs(cutoff_df=cutoff_df, error_df=error_df, sample_masks=None, sample_stats=None)
+    cutoffs = run_cutoff_stage(config=config, run_input=run_input, samples=samples, markers=markers,
+                               reference=reference, progress=progress)
+    stage_cache.save_frames(stage='cutoffs', key=cutoff_key, frames=[cutoffs.cutoff_df, cutoffs.error_df])
+    return cutoffs
+
+
+def run_outlier_stage(config: ScoutsConfig, run_input: RunInput, cutoffs: RunCutoffs, samples: List[str],
+                      reference: Optional[str]) -> Dict[str, OutlierMasks]:
+    """Compares the input against the cutoffs of each cutoff source (see get_masks_by_cutoff_source), reusing the
+    masks of the "sample" cutoff source if worker processes already calculated them."""
+    if cutoffs.sample_masks is None:
+        return get_masks_by_cutoff_source(input_df=run_input.df, cutoff_df=cutoffs.cutoff_df,
+                                          cutoff_rule=config.cutoff_rule, samples=samples, reference=reference,
+                                          bottom_outliers=config.bottom_outliers, non_outliers=config.non_outliers,
+                                          sample_index=run_input.sample_index)
+    masks = {}
+    if 'ref' in config.cutoff_rule:
+        masks['reference'] = get_outlier_masks(input_df=run_input.df, cutoff_df=cutoffs.cutoff_df,
+                                               cutoff_from='reference', samples=[reference],
+                                               bottom_outliers=config.bottom_outliers,
+                                               non_outliers=config.non_outliers)
+    masks['sample'] = cutoffs.sample_masks
+    return masks
+
+
+def get_run_masks(config: ScoutsConfig, run_input: RunInput, cutoffs: RunCutoffs, samples: List[str],
+                  reference: Optional[str], progress: ProgressReporter,
+                  stage_cache: Optional[StageCache] = None) -> Dict[str, OutlierMasks]:
+    """Runs the outlier stage, reusing the outlier masks saved in the stage cache (if any) by a previous run with
+    the same input, cutoff and outlier options."""
+    progress.start_stage('outliers')
+    if stage_cache is None:
+        return run_outlier_stage(config=config, run_input=run_input, cutoffs=cutoffs, samples=samples,
+                                 reference=reference)
+    masks_key = {**get_cutoff_stage_key(config=config, samples=samples, reference=reference),
+                 'bottom_outliers': config.bottom_outliers, 'non_outliers': config.non_outliers}
+    saved_masks = stage_cache.load(stage='masks', key=masks_key)
+    if saved_masks is not None:  # arrays are saved as "<cutoff source>.<mask field>", and missing masks are None
+        return {source: OutlierMasks(*[saved_masks.arrays.get(f'{source}.{field}') for field in OutlierMasks._fields])
+                for source in saved_masks.info}
+    masks = run_outlier_stage(config=config, run_input=run_input, cutoffs=cutoffs, samples=samples,
+                              reference=reference)
+    arrays = {f'{source}.{field}': mask for source, source_masks in masks.items()
+              for field, mask in source_masks._asdict().items() if mask is not None}
+    stage_cache.save(stage='masks', key=masks_key, arrays=arrays, info=list(masks))
+    return masks
+
+
+def run_subset_stage(config: ScoutsConfig, run_input: RunInput, cutoff_df: pd.DataFrame, samples: List[str],
+                     markers: List[str], reference: Optional[str], cutoff_error_df: Optional[pd.DataFrame] = None,
+                     masks: Optional[Dict[str, OutlierMasks]] = None,
+                     sample_stats: Optional[Dict[str, pd.DataFrame]] = None,
+                     progress: Optional[ProgressReporter] = None) -> None:
+    """Selects the outlier subsets of the run and saves them, along with the summary, stats and cutoff tables, in
+    the output folder of config (see run_scouts)."""
+    run_scouts(df=run_input.df, cutoff_df=cutoff_df, samples=samples, markers=markers, reference=reference,
+               cutoff_rule=config.cutoff_rule, marker_rule=config.marker_rule, export_csv=config.export_csv,
+               export_excel=config.export_excel, single_excel=config.single_excel, export_gated=config.export_gated,
+               non_outliers=config.non_outliers, bottom_outliers=config.bottom_outliers,
+               output_folder=config.output_folder, sample_index=run_input.sample_index, n_writers=config.n_writers,
+               writer_queue_depth=config.writer_queue_depth, cutoff_error_df=cutoff_error_df,
+               export_parquet=config.export_parquet, export_feather=config.export_feather,
+               table_format=config.table_format, export_manifest=config.export_manifest,
+               export_store=config.export_store, masks=masks, sample_stats=sample_stats, progress=progress)
+
+
+def get_gated_stage_key(config: ScoutsConfig) -> Dict[str, Any]:
+    """Returns the options that the gated input depends on (its key in the stage cache, see src.stages)."""
+    return {'gating': config.gating, 'gate_cutoff_value': config.gate_cutoff_value, 'precision': config.precision}
+
+
+def get_cutoff_stage_key(config: ScoutsConfig, samples: List[str], reference: Optional[str]) -> Dict[str, Any]:
+    """Returns the options that the cutoffs depend on, including those of the gated input (their key in the stage
+    cache, see src.stages)."""
+    return {**get_gated_stage_key(config=config), 'samples': samples, 'reference': reference,
+            'cutoff_rule': config.cutoff_rule, 'sample_match': config.sample_match,
+            'contiguous_samples': config.contiguous_samples, 'tukey_factor': config.tukey_factor,
+            'quantile_method': config.quantile_method, 'sketch_error': config.sketch_error}
 
 
 def load_dataframe(input_file: str) -> pd.DataFrame:
     """Loads input dataframe into memory. Raises an exception if the filename doesn't end with
-    .xlsx or .csv (supported formats)."""
+    .xlsx, .csv, .parquet or .feather/.arrow (supported formats), or if pyarrow is needed but not installed."""
     if input_file.endswith('.xlsx') or input_file.endswith('.xls'):
         return pd.read_excel(input_file, header=0)
     elif input_file.endswith('.csv'):
         return pd.read_csv(input_file, header=0)
+    elif input_file.endswith('.parquet') or input_file.endswith('.feather') or input_file.endswith('.arrow'):
+        try:
+            return load_columnar_dataframe(input_file=input_file)
+        except ImportError:
+            raise PandasInputError
     else:
         raise PandasInputError
 
 
+def load_indexed_dataframe(input_file: str, precision: str = 'float64') -> pd.DataFrame:
+    """Loads input dataframe into memory, setting its first column (sample names) as the index. With precision
+    'float32', .csv files are parsed straight into float32 columns and a categorical index."""
+    if precision == 'float32' and input_file.endswith('.csv'):
+        columns = pd.read_csv(input_file, header=0, nrows=0).columns
+        dtypes = {column: np.float32 for column in columns[1:]}
+        dtypes[columns[0]] = 'category'
+        df = pd.read_csv(input_file, header=0, dtype=dtypes)
+    else:
+        df = load_dataframe(input_file=input_file)
+    df.set_index(df.columns[0], inplace=True)
+    return df
+
+
+def load_gated_csv(input_file: str, gating: str, cutoff: float, precision: str, chunk_size: Optional[int] = None,
+                   progress: Optional[ProgressReporter] = None) -> Tuple[pd.DataFrame, List[Any], GatingReport]:
+    """Loads a .csv input file chunk_size rows at a time (GATED_LOAD_CHUNK_ROWS by default), gating the float64 values
+    of each chunk before converting the rows it keeps to the given precision. The gated rows are the same as when
+    gating the whole input at once. Returns the gated DataFrame, the labels of the input before gating and a
+    GatingReport. The progress reporter (if any) advances by the rows of each chunk."""
+    start_time = time.perf_counter()
+    chunks, labels, rows_before = [], [], 0
+    for chunk in pd.read_csv(input_file, header=0, chunksize=chunk_size or GATED_LOAD_CHUNK_ROWS):
+        chunk.set_index(chunk.columns[0], inplace=True)
+        chunk_rows = len(chunk)
+        labels.extend(pd.unique(chunk.index))
+        if gating == 'cytof':
+            apply_cytof_gating(df=chunk, cutoff=cutoff)
+        elif gating == 'rnaseq':
+            apply_rnaseq_gating(df=chunk, cutoff=cutoff)
+        chunks.append(set_dataframe_precision(df=chunk, precision=precision))
+        rows_before += chunk_rows
+        if progress is not None:
+            progress.advance(rows=chunk_rows)
+    df = set_dataframe_precision(df=pd.concat(chunks), precision=precision)  # chunks may have different categories
+    gating_report = GatingReport(rows_before, rows_before - len(df), time.perf_counter() - start_time)
+    return df, list(pd.Index(labels).unique()), gating_report
+
+
+def set_dataframe_precision(df: pd.DataFrame, precision: str) -> pd.DataFrame:
+    """Returns the input DataFrame with its values converted to the given precision. With 'float32', numeric
+    columns become float32 and the index (sample names) becomes categorical. With 'float64', the DataFrame is
+    returned unchanged."""
+    if precision not in PRECISIONS:
+        raise ValueError(f'precision must be one of {PRECISIONS}, not "{precision}"')
+    if precision == 'float64':
+        return df
+    dtypes = {column: np.float32 for column, dtype in df.dtypes.items()
+              if pd.api.types.is_numeric_dtype(dtype) and dtype != np.float32}
+    df = df.astype(dtypes) if dtypes else df.copy(deep=False)  # the DataFrame passed in is never modified
+    if not isinstance(df.index, pd.CategoricalIndex):
+        df.index = pd.CategoricalIndex(df.index, name=df.index.name)
+    return df
+
+
+def get_values(df: pd.DataFrame) -> np.ndarray:
+    """Returns the values of a DataFrame as a 2D float array. float32 DataFrames keep their precision (and
+    are not copied); anything else is converted to float64."""
+    if len(df.columns) and all(dtype == np.float32 for dtype in df.dtypes):
+        return df.to_numpy()
+    return df.to_numpy(dtype=float)
+
+
+def load_columnar_dataframe(input_file: str) -> pd.DataFrame:
+    """Loads a Parquet or Feather/Arrow IPC file (columns are read by multiple threads). If the file stores a
+    pandas index, it becomes the first column, just like the first column of a .csv file."""
+    if input_file.endswith('.parquet'):
+        df = pd.read_parquet(input_file)
+    else:
+        df = pd.read_feather(input_file)
+    if not isinstance(df.index, pd.RangeIndex):
+        df.reset_index(inplace=True)
+    return df
+
+
 def get_marker_names(df: pd.DataFrame) -> List[str]:
     """Gets the name of all markers from the input DataFrame."""
     return list(df)
@@ -75,9 +625,13 @@ def get_all_sample_names(sample_list: List[Tuple[str, str]]) -> List[str]:
     return [tup[0] for tup in sample_list]
 
 
-def validate_sample_names(samples: List[str], df: pd.DataFrame) -> None:
+def validate_sample_names(samples: List[str], df: pd.DataFrame, sample_index: Optional[SampleIndex] = None) -> None:
     """Checks whether any sample name from the sample table isn't present on the input dataframe.
     Raises an exception if this happens."""
+    if sample_index is not None:
+        if any(len(sample_index.get_positions(sample)) == 0 for sample in samples):
+            raise SampleNamingError
+        return
     sample_names = df.index  # Assumes index = sample names (as per documentation)
     for sample in samples:
         if not any(sample in name for name in sample_names):
@@ -95,124 +649,363 @@ def get_reference_sample_name(sample_list: List[Tuple[str, str]]) -> str:
         raise NoReferenceError  # If the user chose to run by reference but did not select any reference
 
 
-def apply_cytof_gating(df: pd.DataFrame, cutoff: float) -> None:
-    """Applies gating for Mass Cytometry onto input dataframe, excluding rows with low average expression."""
-    indices_to_drop = []
-    for index, row in df.iterrows():
-        mean_row_value = np.mean(row)
-        if mean_row_value <= cutoff:
-            indices_to_drop.append(index)
-    df.drop(indices_to_drop, axis=0, inplace=True)
-
-
-def apply_rnaseq_gating(df: pd.DataFrame, cutoff: float) -> None:
+def apply_cytof_gating(df: pd.DataFrame, cutoff: float, chunk_size: Optional[int] = None,
+                       progress: Optional[ProgressReporter] = None) -> GatingReport:
+    """Applies gating for Mass Cytometry onto input dataframe, excluding rows with low average expression.
+    Row means are calculated for chunk_size rows at a time (all rows at once by default), which limits the
+    memory used for temporary arrays. The progress reporter (if any) advances by the rows of each chunk.
+    Returns a GatingReport with the number of dropped rows and elapsed time."""
+    start_time = time.perf_counter()
+    rows_before = len(df)
+    chunk_size = chunk_size or max(rows_before, 1)
+    masks = []
+    for start_row in range(0, rows_before, chunk_size):
+        chunk_values = df.iloc[start_row:start_row + chunk_size].to_numpy(dtype=float)
+        masks.append(get_cytof_gate_mask(values=chunk_values, cutoff=cutoff))
+        if progress is not None:
+            progress.advance(steps=len(chunk_values), rows=len(chunk_values))
+    keep = np.concatenate(masks) if masks else np.ones(0, dtype=bool)
+    drop_rows_in_place(df=df, keep=keep)
+    return GatingReport(rows_before, rows_before - len(df), time.perf_counter() - start_time)
+
+
+def get_cytof_gate_mask(values: np.ndarray, cutoff: float) -> np.ndarray:
+    """Returns a boolean array indicating which rows (cells) pass the Mass Cytometry gate, i.e. have an average
+    expression above the cutoff. Missing values are ignored when averaging. Can be applied to each chunk of a
+    streamed input independently, since every row is evaluated on its own."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        row_means = np.nansum(values, axis=1) / np.count_nonzero(~np.isnan(values), axis=1)
+    return ~(row_means <= cutoff)  # rows without any values have a NaN mean and are kept
+
+
+def drop_rows_in_place(df: pd.DataFrame, keep: np.ndarray) -> None:
+    """Drops the rows of a DataFrame whose position is False in the keep array, modifying the DataFrame in place.
+    Rows are dropped by position, so rows sharing the same index label are handled individually."""
+    if keep.all():
+        return
+    index = df.index
+    df.index = pd.RangeIndex(len(df))
+    df.drop(index=np.flatnonzero(~keep), inplace=True)
+    df.index = index[keep]
+
+
+def apply_rnaseq_gating(df: pd.DataFrame, cutoff: float) -> GatingReport:
     """Applies gating for Single-Cell RNASeq onto input dataframe, excluding values below threshold from
-    calculations of outlier values."""
+    calculations of outlier values. Returns a GatingReport with the number of dropped rows and elapsed time."""
+    start_time = time.perf_counter()
+    rows_before = len(df)
     df.mask(df <= cutoff, np.nan, inplace=True)
     df.dropna(how='all', inplace=True)
+    return GatingReport(rows_before, rows_before - len(df), time.perf_counter() - start_time)
 
 
 def get_cutoff_dataframe(df: pd.DataFrame, samples: List[str], markers: List[str], reference: Optional[str],
-                         cutoff_rule: str, tukey: float) -> pd.DataFrame:
+                         cutoff_rule: str, tukey: float, sample_index: Optional[SampleIndex] = None,
+                         progress: Optional[ProgressReporter] = None) -> pd.DataFrame:
     """Gets a dataframe with cutoff values(Q1, Q3, IQR, CUTOFF_LOW, CUTOFF_HIGH) in which columns correspond
-    to markers and rows (index) correspond to samples."""
+    to (marker, statistic) pairs and rows (index) correspond to samples."""
     if cutoff_rule == 'ref':
-        return get_cutoff(df=df, samples=[reference], markers=markers, tukey=tukey)
+        return get_cutoff(df=df, samples=[reference], markers=markers, tukey=tukey, sample_index=sample_index,
+                          progress=progress)
     else:
-        return get_cutoff(df=df, samples=samples, markers=markers, tukey=tukey)
-
-
-def get_cutoff(df: pd.DataFrame, samples: List[str], markers: List[str], tukey: float) -> pd.DataFrame:
+        return get_cutoff(df=df, samples=samples, markers=markers, tukey=tukey, sample_index=sample_index,
+                          progress=progress)
+
+
+def get_sketch_cutoff_dataframe(df: pd.DataFrame, samples: List[str], markers: List[str], reference: Optional[str],
+                                cutoff_rule: str, tukey: float, error: float,
+                                sample_index: Optional[SampleIndex] = None,
+                                progress: Optional[ProgressReporter] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Same as get_cutoff_dataframe, but estimates quartiles with a quantile sketch of each sample (with rank error
+    below error * number of cells). Also returns a DataFrame with the error bound of each cutoff value."""
+    cutoff_samples = [reference] if cutoff_rule == 'ref' else samples
+    values = get_values(df)
+    sketches = []
+    for sample in cutoff_samples:
+        sketch = QuantileSketch.from_error(error=error)
+        sketch.update(values[get_sample_rows(df=df, sample=sample, sample_index=sample_index)])
+        sketches.append(sketch)
+        if progress is not None:
+            progress.advance(rows=sketch.count)
+    return build_sketch_cutoff_dataframes(sketches=sketches, samples=cutoff_samples, markers=markers, tukey=tukey)
+
+
+def build_sketch_cutoff_dataframes(sketches: List[QuantileSketch], samples: List[str], markers: List[str],
+                                   tukey: float) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Builds the cutoff DataFrame from one quantile sketch per sample, along with a DataFrame holding the rank
+    error of each sample and how far each cutoff value can be from its exact value."""
+    cutoff_array = np.full((len(samples), len(markers), len(Stats._fields)), np.nan)
+    error_array = np.full((len(samples), len(markers), 2), np.nan)
+    for i, sketch in enumerate(sketches):
+        if sketch.count > 0:  # empty sketches (every cell of the sample was gated out) have undefined cutoffs
+            cutoff_array[i] = get_sketch_cutoff_values(sketch=sketch, tukey=tukey)
+            error_array[i] = get_sketch_cutoff_error(sketch=sketch, tukey=tukey)
+    columns = [f'{marker}_{cutoff}' for marker in markers for cutoff in ['upper_cutoff', 'lower_cutoff']]
+    cutoff_error_df = pd.DataFrame(error_array[:, :, ::-1].reshape(len(samples), -1), index=samples, columns=columns)
+    cutoff_error_df.insert(0, 'rank error', [sketch.error for sketch in sketches])
+    return build_cutoff_dataframe(cutoff_array=cutoff_array, samples=samples, markers=markers), cutoff_error_df
+
+
+def get_cutoff(df: pd.DataFrame, samples: List[str], markers: List[str], tukey: float,
+               sample_index: Optional[SampleIndex] = None, progress: Optional[ProgressReporter] = None) -> pd.DataFrame:
     """Gets cutoff values for each sample in the list "samples". Returns these values organized as a DataFrame
-    where rows represent samples and columns represent markers."""
-    result_df = pd.DataFrame(index=samples, columns=markers)
-    for sample in samples:
-        cutoff_values = get_sample_cutoff(df=df, sample=sample, tukey=tukey)
-        result_df.loc[sample] = cutoff_values
-    return result_df
-
-
-def get_sample_cutoff(df: pd.DataFrame, sample: str, tukey: float) -> List[Stats]:
-    """Calculates and returns the cutoff statistics for all markers of a given sample."""
-    values = []
-    filtered_df = filter_df_by_sample_in_index(df=df, sample=sample)
-    quantile_df = filtered_df.quantile([0.25, 0.75])
-    for marker in quantile_df:
-        values.append(get_marker_statistics(tukey=tukey, marker_series=quantile_df[marker]))
-    return values
-
-
-def filter_df_by_sample_in_index(df: pd.DataFrame, sample: str) -> pd.DataFrame:
-    """Filters dataframes row according to name passed as argument. Rows whose index contains the sample
-    string are selected."""
-    return df.loc[df.index.str.contains(sample)]
-
-
-def get_marker_statistics(tukey: float, marker_series: pd.Series) -> Stats:
-    """Calculates and returns the cutoff statistics for a given sample/marker combination (first quartile cutoff,
-    third quartile cutoff, interquartile range, lower cutoff and upper cutoff) as a Stats object."""
-    first_quartile, third_quartile = marker_series
+    where rows represent samples and columns represent (marker, statistic) pairs. The progress reporter (if any)
+    advances once per sample."""
+    values = get_values(df)
+    cutoff_array = np.empty((len(samples), len(markers), len(Stats._fields)))
+    for i, sample in enumerate(samples):
+        rows = get_sample_rows(df=df, sample=sample, sample_index=sample_index)
+        cutoff_array[i] = get_cutoff_values(values=values[rows], tukey=tukey)
+        if progress is not None:
+            progress.advance(rows=len(values[rows]) if isinstance(rows, slice) else len(rows))
+    return build_cutoff_dataframe(cutoff_array=cutoff_array, samples=samples, markers=markers)
+
+
+def get_sample_cutoff(df: pd.DataFrame, sample: str, tukey: float, sample_index: Optional[SampleIndex] = None,
+                      sorted_values: Optional['SortedSampleValues'] = None) -> List[Stats]:
+    """Calculates and returns the cutoff statistics for all markers of a given sample. If the sorted values of the
+    sample are given, quartiles are read from them instead of sorting the values of the sample again."""
+    if sorted_values is not None:
+        return [Stats(*marker_values) for marker_values in sorted_values.get_cutoff_values(sample=sample, tukey=tukey)]
+    rows = get_sample_rows(df=df, sample=sample, sample_index=sample_index)
+    cutoff_values = get_cutoff_values(values=get_values(df)[rows], tukey=tukey)
+    return [Stats(*marker_values) for marker_values in cutoff_values]
+
+
+def get_sample_rows(df: pd.DataFrame, sample: str,
+                    sample_index: Optional[SampleIndex] = None) -> Union[slice, np.ndarray]:
+    """Gets the rows of the DataFrame that belong to the sample, as a slice or as an array of row positions."""
+    if sample_index is not None and df.index is sample_index.index:
+        return sample_index.get_rows(sample)
+    return np.flatnonzero(df.index.str.contains(sample))
+
+
+def get_cutoff_values(values: np.ndarray, tukey: float) -> np.ndarray:
+    """Calculates the cutoff statistics (Q1, Q3, IQR, CUTOFF_LOW, CUTOFF_HIGH) of all columns in a 2D array of
+    values (rows are cells, columns are markers) at once. Returns an array with one row of statistics per marker."""
+    first_quartile, third_quartile = get_quantiles(values=values, quantiles=[0.25, 0.75])
+    return get_tukey_cutoff_values(first_quartile=first_quartile, third_quartile=third_quartile, tukey=tukey)
+
+
+def get_tukey_cutoff_values(first_quartile: np.ndarray, third_quartile: np.ndarray, tukey: float) -> np.ndarray:
+    """Calculates the cutoff statistics (Q1, Q3, IQR, CUTOFF_LOW, CUTOFF_HIGH) of each marker from its quartiles."""
     iqr = third_quartile - first_quartile
     upper_cutoff = third_quartile + (iqr * tukey)
     lower_cutoff = first_quartile - (iqr * tukey)
-    return Stats(first_quartile, third_quartile, iqr, lower_cutoff, upper_cutoff)
-
-
-def run_scouts(widget: QMainWindow, df: pd.DataFrame, samples: List[str], markers: List[str],
-               reference: Optional[str], cutoff_df: pd.DataFrame, cutoff_rule: str, marker_rule: str, export_csv: bool,
-               export_excel: bool, single_excel: bool, export_gated: bool, non_outliers: bool, bottom_outliers: bool,
-               output_folder: str) -> None:
+    return np.stack([first_quartile, third_quartile, iqr, lower_cutoff, upper_cutoff], axis=-1)
+
+
+def get_quantiles(values: np.ndarray, quantiles: List[float]) -> np.ndarray:
+    """Calculates quantiles of each column in a 2D array, ignoring NaN values. Uses the same linear interpolation
+    as pandas/numpy, but sorts all columns at once instead of going through them one by one. Returns an array with
+    one row per quantile (all NaN for columns without any values)."""
+    sorted_values = np.sort(values, axis=0)  # NaNs are sorted to the end of each column
+    counts = np.count_nonzero(~np.isnan(values), axis=0)
+    return get_sorted_quantiles(sorted_values=sorted_values, counts=counts, quantiles=quantiles)
+
+
+def get_sorted_quantiles(sorted_values: np.ndarray, counts: np.ndarray, quantiles: List[float]) -> np.ndarray:
+    """Same as get_quantiles, for a 2D array whose columns are already sorted (NaNs last) and hold counts[i]
+    non-NaN values each."""
+    result = np.full((len(quantiles), sorted_values.shape[1]), np.nan)
+    has_values = counts > 0
+    for i, quantile in enumerate(quantiles):
+        position = (counts[has_values] - 1) * quantile
+        lower_position = np.floor(position).astype(int)
+        upper_position = np.ceil(position).astype(int)
+        result[i, has_values] = interpolate_quantile(lower_values=sorted_values[lower_position, has_values],
+                                                     upper_values=sorted_values[upper_position, has_values],
+                                                     weight=position - lower_position)
+    return result
+
+
+def interpolate_quantile(lower_values: np.ndarray, upper_values: np.ndarray, weight: np.ndarray) -> np.ndarray:
+    """Interpolates linearly between the values on each side of a quantile position, the same way as numpy
+    (starting from the closest of the two values), so that quantiles match np.nanquantile exactly."""
+    difference = upper_values - lower_values
+    return np.where(weight >= 0.5, upper_values - difference * (1 - weight), lower_values + difference * weight)
+
+
+def build_cutoff_dataframe(cutoff_array: np.ndarray, samples: List[str], markers: List[str]) -> pd.DataFrame:
+    """Builds the cutoff DataFrame from a dense array of cutoff statistics (samples x markers x Stats fields)."""
+    columns = pd.MultiIndex.from_product([markers, Stats._fields], names=['marker', 'statistic'])
+    return pd.DataFrame(cutoff_array.reshape(len(samples), -1), index=samples, columns=columns)
+
+
+def get_tukey_cutoff_dataframe(cutoff_df: pd.DataFrame, tukey: float) -> pd.DataFrame:
+    """Returns a copy of the cutoff DataFrame with its lower and upper cutoffs calculated for another Tukey factor.
+    Quartiles and IQR do not depend on the Tukey factor, so they are kept as they are."""
+    cutoff_array = get_cutoff_array(cutoff_df).copy()
+    iqr = cutoff_array[:, :, IQR]
+    cutoff_array[:, :, LOWER_CUTOFF] = cutoff_array[:, :, FIRST_QUARTILE] - (iqr * tukey)
+    cutoff_array[:, :, UPPER_CUTOFF] = cutoff_array[:, :, THIRD_QUARTILE] + (iqr * tukey)
+    return build_cutoff_dataframe(cutoff_array=cutoff_array, samples=list(cutoff_df.index),
+                                  markers=list(cutoff_df.columns.unique(level=0)))
+
+
+def get_cutoff_array(cutoff_df: pd.DataFrame) -> np.ndarray:
+    """Gets the dense array of cutoff statistics (samples x markers x Stats fields) behind a cutoff DataFrame."""
+    return cutoff_df.to_numpy(dtype=float).reshape(len(cutoff_df), -1, len(Stats._fields))
+
+
+def get_marker_positions(cutoff_df: pd.DataFrame) -> Dict[str, int]:
+    """Gets the position of each marker along the marker axis of the cutoff array."""
+    return {marker: i for i, marker in enumerate(cutoff_df.columns.unique(level=0))}
+
+
+def run_scouts(df: pd.DataFrame, samples: List[str], markers: List[str], reference: Optional[str],
+               cutoff_df: pd.DataFrame, cutoff_rule: str, marker_rule: str, export_csv: bool, export_excel: bool,
+               single_excel: bool, export_gated: bool, non_outliers: bool, bottom_outliers: bool, output_folder: str,
+               sample_index: Optional[SampleIndex] = None, n_writers: int = 0, writer_queue_depth: Optional[int] = None,
+               cutoff_error_df: Optional[pd.DataFrame] = None, export_parquet: bool = False,
+               export_feather: bool = False, table_format: str = 'xlsx', export_manifest: bool = False,
+               export_store: bool = False, masks: Optional[Dict[str, OutlierMasks]] = None,
+               sample_stats: Optional[Dict[str, pd.DataFrame]] = None, progress: Optional[ProgressReporter] = None,
+               backend: Optional[DenseBackend] = None) -> None:
     """Function responsible for calling SCOUTS subsetting routines, yielding DataFrames, saving them in
-    the appropriate format/directory and recording information about each saved result."""
+    the appropriate format/directory and recording information about each saved result. If n_writers > 0,
+    files are written by that many worker processes, with at most writer_queue_depth subsets waiting in memory.
+    If cutoffs were estimated by quantile sketches, their error bounds (cutoff_error_df) are saved with them.
+    Summary, stats, cutoff and gated tables are saved in table_format ('xlsx', 'parquet' or 'feather').
+    If export_manifest is True, a selection manifest (see src.manifest) is saved in the data folder. If export_store
+    is True, all subsets are also saved into a single indexed Parquet file (see src.store) in the data folder.
+    A catalog of all subsets and exported files (see src.catalog) is always saved in the output folder.
+    Outlier masks are computed here, unless already given (see get_masks_by_cutoff_source), and so are the stats
+    tables of the "sample" cutoff source, unless already given as sample_stats (see src.parallel). Masks, stats and
+    the rows of each subset come from the backend (DenseBackend by default; df is a SparseFrame with
+    src.sparse.SparseBackend). The progress reporter (if any) goes through the outliers, stats, subsets and tables
+    stages, and is checked for cancellation between subsets."""
+    if progress is None:
+        progress = ProgressReporter()
+    if backend is None:
+        backend = DenseBackend()
     summary_df = pd.DataFrame(columns=['file number'] + list(Info._fields))
-    stats_df_dict = create_stats_dfs(markers=markers, cutoff_rule=cutoff_rule, marker_rule=marker_rule,
-                                     samples=samples, bottom=bottom_outliers, non=non_outliers)
-    add_whole_population_to_stats_dfs(input_df=df, stats_df_dict=stats_df_dict, samples=samples)
     output_path = os.path.join(output_folder, 'data')
     if not os.path.exists(output_path):
         os.mkdir(output_path)
-    excel_file_list = []
-    for i, (data, info) in enumerate(yield_dataframes(input_df=df, samples=samples, markers=markers,
-                                                      reference=reference, cutoff_df=cutoff_df, cutoff_rule=cutoff_rule,
-                                                      marker_rule=marker_rule, non_outliers=non_outliers,
-                                                      bottom_outliers=bottom_outliers), 1):
-        summary_df = add_scouts_data_to_summary(summary_df, i, info)
-        add_scouts_data_to_stats(data, samples, stats_df_dict, info)
-        if not widget.stacked_pages.isEnabled():  # user has exited the GUI
-            return
-        if export_csv:
-            csv_path = os.path.join(output_path, '%04d.csv' % i)
-            data.to_csv(csv_path)
-        if export_excel:
-            excel_path = os.path.join(output_path, '%04d.xlsx' % i)
-            excel_file_list.append(excel_path)
-            data.to_excel(excel_path)
-    summary_path = os.path.join(output_folder, 'summary.xlsx')
+    if masks is None:
+        progress.start_stage('outliers')
+        masks = backend.get_masks(df=df, cutoff_df=cutoff_df, cutoff_rule=cutoff_rule, samples=samples,
+                                  reference=reference, bottom_outliers=bottom_outliers, non_outliers=non_outliers,
+                                  sample_index=sample_index)
+    stats_masks = masks if sample_stats is None else {key: value for key, value in masks.items() if key != 'sample'}
+    progress.start_stage('stats', steps=len(samples) * len(stats_masks))
+    sample_masks = get_sample_masks(input_df=df, samples=samples, sample_index=sample_index)
+    stats_df_dict = backend.get_stats_dfs(df=df, masks=stats_masks, markers=markers, cutoff_rule=cutoff_rule,
+                                          marker_rule=marker_rule, samples=samples, bottom=bottom_outliers,
+                                          non=non_outliers, sample_masks=sample_masks, progress=progress)
+    if sample_stats is not None:
+        stats_df_dict = {**sample_stats, **stats_df_dict}  # same order as get_stats_dfs (OutS tables first)
+    catalog_writer = CatalogWriter(folder=output_folder)
+    progress.start_stage('subsets', steps=count_subsets(markers=markers, cutoff_rule=cutoff_rule,
+                                                        marker_rule=marker_rule, bottom_outliers=bottom_outliers,
+                                                        non_outliers=non_outliers))
+    with ExitStack() as stack:
+        writer_pool = stack.enter_context(WriterPool(n_writers=n_writers, queue_depth=writer_queue_depth,
+                                                     on_written=progress.add_files))
+        manifest_writer = None
+        if export_manifest:
+            matrix_format = table_format if table_format != 'xlsx' else 'csv'
+            manifest_writer = stack.enter_context(ManifestWriter(folder=output_path, matrix=df,
+                                                                 matrix_format=matrix_format))
+        store_writer = stack.enter_context(StoreWriter(folder=output_path)) if export_store else None
+        merged_writer = None
+        if single_excel:
+            merged_writer = MergedWorkbookWriter(path=os.path.join(output_folder, 'merged_data.xlsx'))
+        for i, (selection, info) in enumerate(yield_dataframes(input_df=df, samples=samples, markers=markers,
+                                                               reference=reference, cutoff_df=cutoff_df,
+                                                               cutoff_rule=cutoff_rule, marker_rule=marker_rule,
+                                                               non_outliers=non_outliers,
+                                                               bottom_outliers=bottom_outliers,
+                                                               sample_index=sample_index, masks=masks,
+                                                               select=select_mask), 1):
+            summary_df = add_scouts_data_to_summary(summary_df, i, info)
+            if manifest_writer is not None:
+                manifest_writer.add(number=i, rows=selection.rows, mask=selection.mask, info=info._asdict())
+            paths = []
+            if export_csv:
+                paths.append(os.path.join(output_path, '%04d.csv' % i))
+            if export_excel:
+                paths.append(os.path.join(output_path, '%04d.xlsx' % i))
+            if export_parquet:
+                paths.append(os.path.join(output_path, '%04d.parquet' % i))
+            if export_feather:
+                paths.append(os.path.join(output_path, '%04d.feather' % i))
+            positions = selection.rows[selection.mask]
+            catalog_writer.add(number=i, info=info._asdict(), rows=len(positions), paths=paths,
+                               sample_counts={sample: np.count_nonzero(sample_masks[sample][positions])
+                                              for sample in samples})
+            if paths or store_writer is not None or merged_writer is not None:
+                # the rows of a subset are only gathered to write it (stats come from the masks)
+                data = backend.take(df=df, positions=positions)
+                if store_writer is not None:
+                    store_writer.add(number=i, data=data, info=info._asdict())
+                if merged_writer is not None:
+                    merged_writer.add(number=i, data=data)
+                writer_pool.submit(data=data, paths=paths)
+            progress.advance(rows=len(positions))
+    progress.start_stage('tables')
+    if store_writer is not None:
+        progress.add_files([os.path.join(output_path, STORE_FILE), os.path.join(output_path, STORE_INDEX_FILE)])
+    catalog_writer.save()
+    summary_path = os.path.join(output_folder, f'summary.{table_format}')
     generate_summary_table(summary_df, summary_path)
-    stats_path = os.path.join(output_folder, 'stats.xlsx')
+    stats_path = os.path.join(output_folder, f'stats.{table_format}')
     generate_stats_table(stats_df_dict, stats_path)
-    cutoff_path = os.path.join(output_folder, 'cutoff_values.xlsx')
-    generate_cutoff_table(cutoff_df, cutoff_path)
+    cutoff_path = os.path.join(output_folder, f'cutoff_values.{table_format}')
+    generate_cutoff_table(cutoff_df, cutoff_path, cutoff_error_df=cutoff_error_df)
+    table_paths = [os.path.join(output_folder, CATALOG_FILE), summary_path, stats_path, cutoff_path]
     if export_gated:
-        gated_path = os.path.join(output_folder, 'gated_population.xlsx')
-        generate_gated_table(df, gated_path)
-    if single_excel:
-        merged_excel = merge_excel_files(output_path=output_path, summary_path=summary_path, excels=excel_file_list)
-        merged_path = os.path.join(output_folder, 'merged_data.xlsx')
-        merged_excel.save(merged_path)
+        table_paths.append(backend.save_gated(df=df, output_folder=output_folder, table_format=table_format))
+    if merged_writer is not None:
+        merged_writer.save(summary_df=summary_df)
+        table_paths.append(merged_writer.path)
+    progress.add_files(table_paths)
+
+
+def run_tukey_sweep(config: ScoutsConfig, run_input: RunInput, cutoff_df: pd.DataFrame, samples: List[str],
+                    markers: List[str], reference: Optional[str], progress: Optional[ProgressReporter] = None) -> None:
+    """Runs the subset stage (see run_subset_stage) once per Tukey factor in config.tukey_sweep, deriving the
+    cutoffs of each factor from the quartiles already in cutoff_df. The outputs of each factor are saved in their own
+    subfolder of the output folder (e.g. "tukey_1.5"), and the number of cells selected in each output file for each
+    factor is saved side by side in the tukey_sweep table."""
+    counts_df = None
+    for tukey in config.tukey_sweep:
+        factor_folder = os.path.join(config.output_folder, get_tukey_folder_name(tukey))
+        os.makedirs(factor_folder, exist_ok=True)
+        run_subset_stage(config=config.replace(output_folder=factor_folder), run_input=run_input,
+                         cutoff_df=get_tukey_cutoff_dataframe(cutoff_df=cutoff_df, tukey=tukey), samples=samples,
+                         markers=markers, reference=reference, progress=progress)
+        with RunCatalog(factor_folder) as catalog:
+            subsets_df = catalog.get_subsets()
+        if counts_df is None:
+            counts_df = subsets_df.drop(columns='rows')
+        counts_df[f'cells (tukey {tukey:g})'] = subsets_df['rows'].values
+    sweep_path = os.path.join(config.output_folder, f'tukey_sweep.{config.table_format}')
+    save_dataframe(df=counts_df, path=sweep_path, index=False)
+    if progress is not None:
+        progress.add_files([sweep_path])
+
+
+def count_subsets(markers: List[str], cutoff_rule: str, marker_rule: str, bottom_outliers: bool,
+                  non_outliers: bool) -> int:
+    """Returns the number of subsets (output files) that yield_dataframes yields for the given options."""
+    cutoff_sources = ('ref' in cutoff_rule) + ('sample' in cutoff_rule)
+    outliers_for = ('any' in marker_rule) + len(markers) * ('single' in marker_rule)
+    return cutoff_sources * outliers_for * (1 + bottom_outliers + non_outliers)
+
+
+def get_tukey_folder_name(tukey: float) -> str:
+    """Returns the name of the subfolder holding the outputs of a Tukey factor in a sweep."""
+    return f'tukey_{tukey:g}'
 
 
 def create_stats_dfs(markers: List[str], cutoff_rule: str, marker_rule: str, samples: List[str], bottom: bool,
                      non: bool) -> Dict[str, pd.DataFrame]:
     """Creates and returns a dictionary of DataFrames for keeping track of stats.xslx information,
-    since this information is calculated iteratively as SCOUTS analyses the input data."""
-    populations = ['whole population', 'top outliers']
-    if non is True:
-        populations += ['non-outliers']
-    if bottom is True:
-        populations += ['bottom outliers']
-    stats = ['#', 'mean', 'median', 'sd']
-    index = pd.MultiIndex.from_product([samples, populations, stats])
+    to be filled in iteratively (as done when streaming the input data in chunks)."""
+    populations = get_stats_populations(bottom=bottom, non=non)
+    index = pd.MultiIndex.from_product([samples, populations, STATS_FIELDS])
     df_dict = {}
     if 'sample' in cutoff_rule and 'any' in marker_rule:
         df_dict['OutS any marker'] = pd.DataFrame(columns=markers, index=index)
@@ -225,129 +1018,285 @@ def create_stats_dfs(markers: List[str], cutoff_rule: str, marker_rule: str, sam
     return df_dict
 
 
-def add_whole_population_to_stats_dfs(input_df: pd.DataFrame, stats_df_dict: Dict[str, pd.DataFrame],
-                                      samples: List[str]) -> None:
-    """Adds whole population info (divided by sample) to each stats DataFrame."""
-    for stats_df in stats_df_dict.values():
-        for sample in samples:
-            filtered_df = filter_df_by_sample_in_index(df=input_df, sample=sample)
-            values_df = filtered_df.describe().loc[['count', 'mean', '50%', 'std']]
-            values_df.index = ['#', 'mean', 'median', 'sd']
-            stats_df.loc[(sample, 'whole population')] = values_df.values
+def get_stats_populations(bottom: bool, non: bool) -> List[str]:
+    """Returns the populations listed for each sample in the stats tables, in order."""
+    populations = ['whole population', 'top outliers']
+    if non is True:
+        populations += ['non-outliers']
+    if bottom is True:
+        populations += ['bottom outliers']
+    return populations
+
+
+def get_stats_dfs(input_df: pd.DataFrame, masks: Dict[str, OutlierMasks], markers: List[str], cutoff_rule: str,
+                  marker_rule: str, samples: List[str], bottom: bool, non: bool,
+                  sample_index: Optional[SampleIndex] = None,
+                  sample_masks: Optional[Dict[str, np.ndarray]] = None,
+                  progress: Optional[ProgressReporter] = None) -> Dict[str, pd.DataFrame]:
+    """Calculates the stats tables (same keys and layout as create_stats_dfs) directly from the outlier masks,
+    instead of describing every yielded DataFrame. The values of each sample are gathered once per cutoff source,
+    and the stats of all markers of a population are calculated at once. Sample masks (see get_sample_masks)
+    are computed here if not given. The progress reporter (if any) advances once per sample and cutoff source."""
+    values = get_values(input_df)
+    populations = get_stats_populations(bottom=bottom, non=non)
+    index = pd.MultiIndex.from_product([samples, populations, STATS_FIELDS])
+    if sample_masks is None:
+        sample_masks = get_sample_masks(input_df=input_df, samples=samples, sample_index=sample_index)
+    whole_population = {sample: get_masked_stats(values=values[sample_masks[sample]], mask=np.True_)
+                        for sample in samples}
+    df_dict = {}
+    for cutoff_from, prefix in [('sample', 'OutS'), ('reference', 'OutR')]:
+        if cutoff_from not in masks:
+            continue
+        source_masks = masks[cutoff_from]
+        marker_rules = [rule for rule in ['any', 'single'] if rule in marker_rule]
+        arrays = {rule: np.empty((len(samples), len(populations), len(STATS_FIELDS), len(markers)))
+                  for rule in marker_rules}
+        for i, sample in enumerate(samples):
+            member = np.flatnonzero(sample_masks[sample][source_masks.rows])
+            sample_values = values[source_masks.rows[member]]
+            for rule, array in arrays.items():
+                array[i, 0] = whole_population[sample]
+                for j, population in enumerate(populations[1:], 1):
+                    mask = get_population_mask(masks=source_masks, population=population, member=member,
+                                               any_marker=rule == 'any')
+                    array[i, j] = get_masked_stats(values=sample_values, mask=mask)
+            if progress is not None:
+                progress.advance(rows=len(member))
+        for rule, array in arrays.items():
+            df_dict[f'{prefix} {rule} marker'] = pd.DataFrame(array.reshape(-1, len(markers)), index=index,
+                                                              columns=markers)
+    return df_dict
+
+
+def get_sample_masks(input_df: pd.DataFrame, samples: List[str],
+                     sample_index: Optional[SampleIndex] = None) -> Dict[str, np.ndarray]:
+    """Returns a boolean mask over the rows of the input DataFrame for each sample."""
+    sample_masks = {}
+    for sample in samples:
+        sample_mask = np.zeros(len(input_df), dtype=bool)
+        sample_mask[get_sample_rows(df=input_df, sample=sample, sample_index=sample_index)] = True
+        sample_masks[sample] = sample_mask
+    return sample_masks
+
+
+def get_population_mask(masks: OutlierMasks, population: str, member: np.ndarray, any_marker: bool) -> np.ndarray:
+    """Returns the mask of a population over the given positions of OutlierMasks.rows, with one column per marker
+    (or a single column that applies to all markers, if any_marker is True)."""
+    if population == 'non-outliers':
+        return masks.non_any[member, np.newaxis] if any_marker else masks.non[member]
+    mask = (masks.top if population == 'top outliers' else masks.bottom)[member]
+    return mask.any(axis=1, keepdims=True) if any_marker else mask
+
+
+def get_masked_stats(values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Calculates the count, mean, median and sample standard deviation of each column of values, using only
+    the cells where mask is True (NaNs are ignored, like in DataFrame.describe). Returns one row per statistic."""
+    selected = np.where(mask, values, np.nan)
+    with warnings.catch_warnings():  # empty or single-cell columns have NaN stats, like in DataFrame.describe
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.stack([np.count_nonzero(~np.isnan(selected), axis=0), np.nanmean(selected, axis=0),
+                         np.nanmedian(selected, axis=0), np.nanstd(selected, axis=0, ddof=1)])
+
+
+def select_rows(input_df: pd.DataFrame, masks: OutlierMasks, mask: np.ndarray) -> pd.DataFrame:
+    """Returns the rows of the input DataFrame selected by a boolean mask over OutlierMasks.rows."""
+    return input_df.iloc[masks.rows[mask]]
+
+
+def select_mask(input_df: pd.DataFrame, masks: OutlierMasks, mask: np.ndarray) -> Selection:
+    """Returns the selection of a boolean mask over OutlierMasks.rows without copying any rows of the input
+    DataFrame. Passed as "select" to the SCOUTS generators, which then yield Selections instead of DataFrames."""
+    return Selection(masks.rows, mask)
 
 
 def yield_dataframes(input_df: pd.DataFrame, samples: List[str], markers: List[str], reference: Optional[str],
                      cutoff_df: pd.DataFrame, cutoff_rule: str, marker_rule: str, non_outliers: bool,
-                     bottom_outliers: bool) -> Generator[pd.DataFrame, None, None]:
-    """ Yields dataframes, subsetting input dataframe according to user preferences in the SCOUTS interface."""
+                     bottom_outliers: bool, sample_index: Optional[SampleIndex] = None,
+                     masks: Optional[Dict[str, OutlierMasks]] = None,
+                     select: Callable[..., Any] = select_rows) -> Generator[pd.DataFrame, None, None]:
+    """ Yields dataframes, subsetting input dataframe according to user preferences in the SCOUTS interface.
+    With select=select_mask, Selections (row positions and masks) are yielded instead of DataFrames."""
+    if masks is None:
+        masks = {}
     if 'ref' in cutoff_rule:
         if 'any' in marker_rule:
             yield from scouts_by_reference_any_marker(input_df=input_df, cutoff_df=cutoff_df, reference=reference,
-                                                      bottom_outliers=bottom_outliers, non_outliers=non_outliers)
+                                                      bottom_outliers=bottom_outliers, non_outliers=non_outliers,
+                                                      masks=masks.get('reference'), select=select)
         if 'single' in marker_rule:
             yield from scouts_by_reference_single_marker(input_df=input_df, cutoff_df=cutoff_df, markers=markers,
                                                          reference=reference, bottom_outliers=bottom_outliers,
-                                                         non_outliers=non_outliers)
+                                                         non_outliers=non_outliers, masks=masks.get('reference'),
+                                                         select=select)
     if 'sample' in cutoff_rule:
         if 'any' in marker_rule:
             yield from scouts_by_sample_any_marker(input_df=input_df, cutoff_df=cutoff_df, samples=samples,
-                                                   bottom_outliers=bottom_outliers, non_outliers=non_outliers)
+                                                   bottom_outliers=bottom_outliers, non_outliers=non_outliers,
+                                                   sample_index=sample_index, masks=masks.get('sample'),
+                                                   select=select)
         if 'single' in marker_rule:
             yield from scouts_by_sample_single_marker(input_df=input_df, cutoff_df=cutoff_df, samples=samples,
                                                       markers=markers, bottom_outliers=bottom_outliers,
-                                                      non_outliers=non_outliers)
+                                                      non_outliers=non_outliers, sample_index=sample_index,
+                                                      masks=masks.get('sample'), select=select)
+
+
+def get_masks_by_cutoff_source(input_df: pd.DataFrame, cutoff_df: pd.DataFrame, cutoff_rule: str,
+                               samples: List[str], reference: Optional[str], bottom_outliers: bool,
+                               non_outliers: bool,
+                               sample_index: Optional[SampleIndex] = None) -> Dict[str, OutlierMasks]:
+    """Computes the outlier masks of each cutoff source ("reference" and/or "sample") selected by the user.
+    The input data is compared against the cutoffs only once per cutoff source."""
+    masks = {}
+    if 'ref' in cutoff_rule:
+        masks['reference'] = get_outlier_masks(input_df=input_df, cutoff_df=cutoff_df, cutoff_from='reference',
+                                               samples=[reference], bottom_outliers=bottom_outliers,
+                                               non_outliers=non_outliers)
+    if 'sample' in cutoff_rule:
+        masks['sample'] = get_outlier_masks(input_df=input_df, cutoff_df=cutoff_df, cutoff_from='sample',
+                                            samples=samples, bottom_outliers=bottom_outliers,
+                                            non_outliers=non_outliers, sample_index=sample_index)
+    return masks
+
+
+def get_outlier_masks(input_df: pd.DataFrame, cutoff_df: pd.DataFrame, cutoff_from: str, samples: List[str],
+                      bottom_outliers: bool, non_outliers: bool,
+                      sample_index: Optional[SampleIndex] = None) -> OutlierMasks:
+    """Compares every cell of the input DataFrame against its outlier cutoffs in a single pass. If cutoffs come from
+    the reference, all rows use the cutoffs of samples[0]; if they come from each sample, only the rows of each
+    sample are compared to its own cutoffs, and the rows of all samples are stacked in sample order.
+    The returned masks have one row per position in OutlierMasks.rows and one column per input column.
+    Bottom and non-outlier masks are None if they were not requested."""
+    values = get_values(input_df)
+    cutoff_array = get_cutoff_array(cutoff_df)
+    marker_positions = get_marker_positions(cutoff_df)
+    columns = [marker_positions[marker] for marker in input_df.columns]
+    all_rows = np.arange(len(input_df))
+    rows, top, bottom, non, non_any = [], [], [], [], []
+    for sample in samples:
+        if cutoff_from == 'reference':
+            sample_rows = all_rows
+            sample_values = values
+        else:
+            sample_rows = all_rows[get_sample_rows(df=input_df, sample=sample, sample_index=sample_index)]
+            sample_values = values[sample_rows]
+        cutoffs = cutoff_array[cutoff_df.index.get_loc(sample)][columns]
+        sample_masks = compare_to_cutoffs(values=sample_values, cutoffs=cutoffs, bottom_outliers=bottom_outliers,
+                                          non_outliers=non_outliers)
+        rows.append(sample_rows)
+        top.append(sample_masks.top)
+        bottom.append(sample_masks.bottom)
+        non.append(sample_masks.non)
+        non_any.append(sample_masks.non_any)
+    return concatenate_outlier_masks(rows=rows, top=top, bottom=bottom, non=non, non_any=non_any)
+
+
+def compare_to_cutoffs(values: np.ndarray, cutoffs: np.ndarray, bottom_outliers: bool,
+                       non_outliers: bool) -> OutlierMasks:
+    """Compares a 2D array of values against the cutoff statistics of each of its columns (one row of Stats fields
+    per column). Returns the outlier masks of the values, with no rows (bottom and non-outlier masks are None if
+    they were not requested)."""
+    with np.errstate(invalid='ignore'):
+        below_upper = values <= cutoffs[:, UPPER_CUTOFF]
+        above_lower = values >= cutoffs[:, LOWER_CUTOFF]
+        return OutlierMasks(rows=None, top=values > cutoffs[:, UPPER_CUTOFF],
+                            bottom=values < cutoffs[:, LOWER_CUTOFF] if bottom_outliers is True else None,
+                            non=below_upper & above_lower if non_outliers is True else None,
+                            non_any=below_upper.any(axis=1) & above_lower.any(axis=1) if non_outliers is True else None)
+
+
+def concatenate_outlier_masks(rows: List[np.ndarray], top: List[np.ndarray], bottom: List[Optional[np.ndarray]],
+                              non: List[Optional[np.ndarray]], non_any: List[Optional[np.ndarray]]) -> OutlierMasks:
+    """Stacks the rows and outlier masks of each sample (in sample order) into a single OutlierMasks. Bottom and
+    non-outlier masks are None if they are None for every sample."""
+    return OutlierMasks(rows=np.concatenate(rows), top=np.concatenate(top),
+                        bottom=np.concatenate(bottom) if bottom and bottom[0] is not None else None,
+                        non=np.concatenate(non) if non and non[0] is not None else None,
+                        non_any=np.concatenate(non_any) if non_any and non_any[0] is not None else None)
 
 
 def scouts_by_reference_any_marker(input_df: pd.DataFrame, cutoff_df: pd.DataFrame, reference: str,
-                                   bottom_outliers: bool, non_outliers: bool) -> Generator[pd.DataFrame, None, None]:
+                                   bottom_outliers: bool, non_outliers: bool,
+                                   masks: Optional[OutlierMasks] = None,
+                                   select: Callable[..., Any] = select_rows) -> Generator[pd.DataFrame, None, None]:
     """Subsets DataFrame by reference cutoff, selecting samples that have at least 1 marker above
     outlier cutoff value."""
-    upper_cutoffs = [stat.upper_cutoff for stat in cutoff_df.loc[reference]]
-    lower_cutoffs = [stat.lower_cutoff for stat in cutoff_df.loc[reference]]
+    if masks is None:
+        masks = get_outlier_masks(input_df=input_df, cutoff_df=cutoff_df, cutoff_from='reference',
+                                  samples=[reference], bottom_outliers=bottom_outliers, non_outliers=non_outliers)
     info_upper = Info('reference', reference, 'any marker', 'top outliers')
-    yield input_df.loc[(input_df > upper_cutoffs).any(axis=1)], info_upper
+    yield select(input_df, masks, masks.top.any(axis=1)), info_upper
     if bottom_outliers is True:
         info_lower = Info('reference', reference, 'any marker', 'bottom outliers')
-        yield input_df.loc[(input_df < lower_cutoffs).any(axis=1)], info_lower
+        yield select(input_df, masks, masks.bottom.any(axis=1)), info_lower
     if non_outliers is True:
         info_non = Info('reference', reference, 'any marker', 'non-outliers')
-        yield input_df.loc[(input_df <= upper_cutoffs).any(axis=1) &
-                           (input_df >= lower_cutoffs).any(axis=1)], info_non
+        yield select(input_df, masks, masks.non_any), info_non
 
 
 def scouts_by_reference_single_marker(input_df: pd.DataFrame, cutoff_df: pd.DataFrame, markers: List[str],
-                                      reference: str, bottom_outliers: bool,
-                                      non_outliers: bool) -> Generator[pd.DataFrame, None, None]:
+                                      reference: str, bottom_outliers: bool, non_outliers: bool,
+                                      masks: Optional[OutlierMasks] = None,
+                                      select: Callable[..., Any] = select_rows) -> Generator[pd.DataFrame, None, None]:
     """Subsets DataFrame by reference cutoff, selecting samples that are outliers for each marker (yields each
     dataframe separately)."""
+    if masks is None:
+        masks = get_outlier_masks(input_df=input_df, cutoff_df=cutoff_df, cutoff_from='reference',
+                                  samples=[reference], bottom_outliers=bottom_outliers, non_outliers=non_outliers)
     for marker in markers:
-        upper_cutoff = cutoff_df.loc[reference, marker].upper_cutoff
-        lower_cutoff = cutoff_df.loc[reference, marker].lower_cutoff
+        column = input_df.columns.get_loc(marker)
         info_upper = Info('reference', reference, marker, 'top outliers')
-        yield input_df.loc[input_df[marker] > upper_cutoff], info_upper
+        yield select(input_df, masks, masks.top[:, column]), info_upper
         if bottom_outliers is True:
             info_lower = Info('reference', reference, marker, 'bottom outliers')
-            yield input_df.loc[input_df[marker] < lower_cutoff], info_lower
+            yield select(input_df, masks, masks.bottom[:, column]), info_lower
         if non_outliers is True:
             info_non = Info('reference', reference, marker, 'non-outliers')
-            yield input_df.loc[(input_df[marker] <= upper_cutoff) &
-                               (input_df[marker] >= lower_cutoff)], info_non
+            yield select(input_df, masks, masks.non[:, column]), info_non
 
 
 def scouts_by_sample_any_marker(input_df: pd.DataFrame, cutoff_df: pd.DataFrame, samples: List[str],
-                                bottom_outliers: bool, non_outliers: bool) -> Generator[pd.DataFrame, None, None]:
+                                bottom_outliers: bool, non_outliers: bool, sample_index: Optional[SampleIndex] = None,
+                                masks: Optional[OutlierMasks] = None,
+                                select: Callable[..., Any] = select_rows) -> Generator[pd.DataFrame, None, None]:
     """Subsets DataFrame by sample cutoff, selecting samples that have at least 1 marker above
     outlier cutoff value."""
-    upper_dfs = []
-    lower_dfs = []
-    non_dfs = []
-    for sample in samples:
-        upper_cutoffs = [stat.upper_cutoff for stat in cutoff_df.loc[sample]]
-        lower_cutoffs = [stat.lower_cutoff for stat in cutoff_df.loc[sample]]
-        filtered_df = filter_df_by_sample_in_index(df=input_df, sample=sample)
-        upper_dfs.append(filtered_df.loc[(filtered_df > upper_cutoffs).any(axis=1)])
-        if bottom_outliers is True:
-            lower_dfs.append(filtered_df.loc[(filtered_df < lower_cutoffs).any(axis=1)])
-        if non_outliers is True:
-            non_dfs.append(filtered_df.loc[(filtered_df <= upper_cutoffs).any(axis=1) &
-                                           (filtered_df >= lower_cutoffs).any(axis=1)])
+    if masks is None:
+        masks = get_outlier_masks(input_df=input_df, cutoff_df=cutoff_df, cutoff_from='sample', samples=samples,
+                                  bottom_outliers=bottom_outliers, non_outliers=non_outliers,
+                                  sample_index=sample_index)
     info_upper = Info('sample', 'n/a', 'any marker', 'top outliers')
-    yield pd.concat(upper_dfs), info_upper
+    yield select(input_df, masks, masks.top.any(axis=1)), info_upper
     if non_outliers is True:
         info_non = Info('sample', 'n/a', 'any marker', 'non-outliers')
-        yield pd.concat(non_dfs), info_non
+        yield select(input_df, masks, masks.non_any), info_non
     if bottom_outliers is True:
         info_lower = Info('sample', 'n/a', 'any marker', 'bottom outliers')
-        yield pd.concat(lower_dfs), info_lower
+        yield select(input_df, masks, masks.bottom.any(axis=1)), info_lower
 
 
 def scouts_by_sample_single_marker(input_df: pd.DataFrame, cutoff_df: pd.DataFrame, samples: List[str],
-                                   markers: List[str], bottom_outliers: bool,
-                                   non_outliers: bool) -> Generator[pd.DataFrame, None, None]:
+                                   markers: List[str], bottom_outliers: bool, non_outliers: bool,
+                                   sample_index: Optional[SampleIndex] = None,
+                                   masks: Optional[OutlierMasks] = None,
+                                   select: Callable[..., Any] = select_rows) -> Generator[pd.DataFrame, None, None]:
     """Subsets DataFrame by sample cutoff, selecting samples that are outliers for each marker (yields each
     dataframe separately)."""
+    if masks is None:
+        masks = get_outlier_masks(input_df=input_df, cutoff_df=cutoff_df, cutoff_from='sample', samples=samples,
+                                  bottom_outliers=bottom_outliers, non_outliers=non_outliers,
+                                  sample_index=sample_index)
     for marker in markers:
-        upper_dfs = []
-        lower_dfs = []
-        non_dfs = []
-        for sample in samples:
-            upper_cutoff = cutoff_df.loc[sample, marker].upper_cutoff
-            lower_cutoff = cutoff_df.loc[sample, marker].lower_cutoff
-            filtered_df = filter_df_by_sample_in_index(df=input_df, sample=sample)
-            upper_dfs.append(filtered_df.loc[filtered_df[marker] > upper_cutoff])
-            if bottom_outliers is True:
-                lower_dfs.append(filtered_df.loc[filtered_df[marker] < lower_cutoff])
-            if non_outliers is True:
-                non_dfs.append(filtered_df.loc[(filtered_df[marker] <= upper_cutoff) &
-                                               (filtered_df[marker] >= lower_cutoff)])
+        column = input_df.columns.get_loc(marker)
         info_upper = Info('sample', 'n/a', marker, 'top outliers')
-        yield pd.concat(upper_dfs), info_upper
+        yield select(input_df, masks, masks.top[:, column]), info_upper
         if non_outliers is True:
             info_non = Info('sample', 'n/a', marker, 'non-outliers')
-            yield pd.concat(non_dfs), info_non
+            yield select(input_df, masks, masks.non[:, column]), info_non
         if bottom_outliers is True:
             info_lower = Info('sample', 'n/a', marker, 'bottom outliers')
-            yield pd.concat(lower_dfs), info_lower
+            yield select(input_df, masks, masks.bottom[:, column]), info_lower
 
 
 def add_scouts_data_to_summary(df: pd.DataFrame, i: int, info: Info) -> pd.DataFrame:
@@ -356,31 +1305,6 @@ def add_scouts_data_to_summary(df: pd.DataFrame, i: int, info: Info) -> pd.DataF
     return df.append(series)
 
 
-def add_scouts_data_to_stats(data: pd.DataFrame, samples: List[str], stats_df_dict: Dict[str, pd.DataFrame],
-                             info: Info) -> None:
-    """Adds info to the stats_df with each new yielded dataframe from SCOUTS."""
-    for sample in samples:
-        values_df = get_values_df_or_series(data, sample, info)
-        key = get_key_from_info(info)
-        df = stats_df_dict[key]
-        if 'any' in info.outliers_for:
-            df.loc[(sample, info.category)] = values_df.values
-        else:
-            df.loc[(sample, info.category), info.outliers_for] = values_df.values
-
-
-def get_values_df_or_series(data: pd.DataFrame, sample: str, info: Info) -> Union[pd.DataFrame, pd.Series]:
-    """Gets the corresponding values from the yielded DataFrame, in order to add them to the appropriate DataFrame
-    inside the stats_df dictionary."""
-    filtered_df = filter_df_by_sample_in_index(df=data, sample=sample)
-    if 'any' in info.outliers_for:
-        values_df = filtered_df.describe().loc[['count', 'mean', '50%', 'std']]
-    else:
-        values_df = filtered_df.describe().loc[['count', 'mean', '50%', 'std'], info.outliers_for]
-    values_df.index = ['#', 'mean', 'median', 'sd']
-    return values_df
-
-
 def get_key_from_info(info: Info) -> str:
     """Figures out which key from the stats_df dictionary the stats should be saved to."""
     if info.cutoff_from == 'sample':
@@ -398,67 +1322,62 @@ def get_key_from_info(info: Info) -> str:
 def generate_summary_table(summary_df: pd.DataFrame, summary_path: str) -> None:
     """Generates table with summary of each file generated by SCOUTS and their meaning
     (i.e. how they were generated)."""
+    if not summary_path.endswith('.xlsx'):
+        save_dataframe(df=summary_df, path=summary_path, index=False)
+        return
     summary_df.to_excel(summary_path, sheet_name='Summary', index=False)
 
 
 def generate_stats_table(stats_df_dict: Dict[str, pd.DataFrame], stats_path: str) -> None:
     """Generates table with stats (counts, mean, median and standard deviation) for each OutS/OutR and
-    any marker/single marker combination, as individual sheets."""
+    any marker/single marker combination, as individual sheets. Columnar formats have no sheets, so all stats
+    are saved to a single table, with the sheet name in the first column."""
+    if not stats_path.endswith('.xlsx'):
+        stats_df = pd.concat(stats_df_dict, names=['sheet', 'sample', 'population', 'statistic']).astype(float)
+        save_dataframe(df=stats_df, path=stats_path)
+        return
     writer = pd.ExcelWriter(stats_path)
     for name, df in stats_df_dict.items():
         df.to_excel(writer, sheet_name=name)
     writer.save()
 
 
-def generate_cutoff_table(cutoff_df: pd.DataFrame, cutoff_path: str) -> None:
-    """Generates table with cutoff values for each sample/marker combination (both high and low)."""
-    uppers = [f'{marker}_upper_cutoff' for marker in cutoff_df.columns]
-    lowers = [f'{marker}_lower_cutoff' for marker in cutoff_df.columns]
+def generate_cutoff_table(cutoff_df: pd.DataFrame, cutoff_path: str,
+                          cutoff_error_df: Optional[pd.DataFrame] = None) -> None:
+    """Generates table with cutoff values for each sample/marker combination (both high and low). If the cutoffs
+    were estimated by quantile sketches, their error bounds are saved in a second sheet."""
+    markers = list(get_marker_positions(cutoff_df))
+    uppers = [f'{marker}_upper_cutoff' for marker in markers]
+    lowers = [f'{marker}_lower_cutoff' for marker in markers]
     columns = [marker for marker in chain.from_iterable(zip(uppers, lowers))]
     output_cutoff_df = get_output_cutoff_df(cutoff_df=cutoff_df, columns=columns)
-    output_cutoff_df.to_excel(cutoff_path, sheet_name='Cutoff', index_label='Sample')
+    if not cutoff_path.endswith('.xlsx'):  # columnar formats have no sheets, so error bounds get their own file
+        save_dataframe(df=output_cutoff_df.rename_axis('Sample'), path=cutoff_path)
+        if cutoff_error_df is not None:
+            name, extension = os.path.splitext(cutoff_path)
+            save_dataframe(df=cutoff_error_df.rename_axis('Sample'), path=f'{name}_error_bound{extension}')
+        return
+    if cutoff_error_df is None:
+        output_cutoff_df.to_excel(cutoff_path, sheet_name='Cutoff', index_label='Sample')
+        return
+    writer = pd.ExcelWriter(cutoff_path)
+    output_cutoff_df.to_excel(writer, sheet_name='Cutoff', index_label='Sample')
+    cutoff_error_df.to_excel(writer, sheet_name='Error bound', index_label='Sample')
+    writer.save()
 
 
 def get_output_cutoff_df(cutoff_df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
-    """Gets a properly formatted cutoff DataFrame from the DataFrame containing Info instances,
-    including individual columns for low and high cutoff values."""
-    output_cutoff_df = pd.DataFrame(index=cutoff_df.index, columns=columns)
-    for sample in cutoff_df.index:
-        for marker in cutoff_df.columns:
-            output_cutoff_df.at[sample, f'{marker}_upper_cutoff'] = cutoff_df.at[sample, marker].upper_cutoff
-            output_cutoff_df.at[sample, f'{marker}_lower_cutoff'] = cutoff_df.at[sample, marker].lower_cutoff
-    return output_cutoff_df
+    """Gets a properly formatted cutoff DataFrame from the cutoff DataFrame, including individual columns for
+    high and low cutoff values (alternating for each marker, as in the columns argument)."""
+    cutoff_array = get_cutoff_array(cutoff_df)
+    values = cutoff_array[:, :, [UPPER_CUTOFF, LOWER_CUTOFF]].reshape(len(cutoff_df), -1)
+    return pd.DataFrame(values, index=cutoff_df.index, columns=columns)
 
 
 def generate_gated_table(gated_df: pd.DataFrame, gated_path: str) -> None:
     """Generates table with gated population, i.e. same as the input file except for the gated cells."""
+    if not gated_path.endswith('.xlsx'):
+        save_dataframe(df=gated_df, path=gated_path)
+        return
     gated_df.to_excel(gated_path, sheet_name='Gated Population')
 
-
-def merge_excel_files(output_path: str, summary_path: str, excels: List[str]) -> Workbook:
-    """Merges all Excel files created into a single file and saves it."""
-    wb = Workbook()
-    summary_sheet = wb.active
-    summary_sheet.title = 'Summary'
-    summary = read_excel_data(summary_path)
-    for row in summary:
-        wb['Summary'].append(row)
-    for index, file in enumerate(excels, 1):
-        data = read_excel_data(os.path.join(output_path, file))
-        sheet_name = "%04d" % index
-        wb.create_sheet(sheet_name)
-        for row in data:
-            wb[sheet_name].append(row)
-    return wb
-
-
-def read_excel_data(path: str) -> List[List[Optional[Union[str, float]]]]:
-    """Reads file from the first worksheet from an Excel workbook as a list of list of values."""
-    ws = load_workbook(path).active
-    rows = []
-    for row in ws.iter_rows():
-        cells = []
-        for cell in row:
-            cells.append(cell.value)
-        rows.append(cells)
-    return rows
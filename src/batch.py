@@ -0,0 +1,138 @@
+import glob
+import logging
+import os
+import signal
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from src.progress import CancellationToken
+from src.utils import InvalidConfigError, get_spawn_executor
+
+logger = logging.getLogger(__name__)
+
+# Name of the report (inside the batch output folder) with the status of every input file
+BATCH_REPORT_FILE = 'batch_report.csv'
+
+# Extensions of the files picked up from input folders (the formats SCOUTS can load)
+BATCH_INPUT_EXTENSIONS = ('.csv', '.xlsx', '.xls', '.parquet', '.feather', '.arrow')
+
+# Maximum number of seconds between two checks of the cancellation token while waiting for files to finish
+BATCH_POLL_INTERVAL = 0.5
+
+# Outcome of the run of one input file: its status is 'finished', 'failed' or 'cancelled' (not started)
+BatchResult = namedtuple('BatchResult', ['input_file', 'output_folder', 'status', 'seconds', 'error'])
+
+
+def get_batch_inputs(inputs: List[str]) -> List[str]:
+    """Returns the input files of a batch run, given as folders (whose files in a supported format are used),
+    glob patterns or file paths. Files are kept in the given order (sorted within each folder or pattern) and
+    repeated files are only used once. Raises an exception if a folder or pattern matches no file."""
+    input_files = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            paths = [os.path.join(entry, name) for name in sorted(os.listdir(entry))
+                     if name.endswith(BATCH_INPUT_EXTENSIONS)]
+        else:
+            paths = sorted(glob.glob(entry))
+        paths = [path for path in paths if os.path.isfile(path)]
+        if not paths:
+            raise InvalidConfigError(f'no input files found in {entry}')
+        input_files.extend(path for path in paths if path not in input_files)
+    return input_files
+
+
+def get_batch_output_folders(input_files: List[str], output_folder: str) -> List[str]:
+    """Returns the output folder of each input file: a folder named after the file (without its extension) inside
+    the batch output folder. Files with the same name (from different folders) get a numbered suffix."""
+    output_folders = []
+    for input_file in input_files:
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        folder, number = os.path.join(output_folder, name), 1
+        while folder in output_folders:
+            number += 1
+            folder = os.path.join(output_folder, f'{name}_{number}')
+        output_folders.append(folder)
+    return output_folders
+
+
+def ignore_interrupts() -> None:
+    """Initializer of the batch worker processes: Ctrl+C reaches every process of the terminal, but only the main
+    process should handle it (by not starting new files), so that the files being analysed are not cut short."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_batch_file(config: Dict[str, Any]) -> BatchResult:
+    """Runs SCOUTS on a single input file of a batch run, returning its outcome instead of raising an exception."""
+    from src.cli import ERROR_MESSAGES, run_from_config  # src.cli imports this module
+    start = time.perf_counter()
+    status, error = 'finished', None
+    try:
+        run_from_config(config)
+    except Exception as run_error:
+        status, error = 'failed', ERROR_MESSAGES.get(type(run_error), str(run_error) or type(run_error).__name__)
+    return BatchResult(input_file=config['input_file'], output_folder=config['output_folder'], status=status,
+                       seconds=time.perf_counter() - start, error=error)
+
+
+def save_batch_report(results: List[BatchResult], output_folder: str) -> str:
+    """Saves the status of every input file of a batch run as a CSV file in the batch output folder."""
+    path = os.path.join(output_folder, BATCH_REPORT_FILE)
+    pd.DataFrame(results, columns=BatchResult._fields).to_csv(path, index=False)
+    return path
+
+
+def get_future_result(future: Future, default: BatchResult) -> BatchResult:
+    """Returns the outcome of a finished batch file, logging it. Falls back to default (with the status 'failed')
+    if its worker process died, and returns default if the file was cancelled before it started."""
+    if future.cancelled():
+        return default
+    try:
+        result = future.result()
+    except Exception as error:  # e.g. the worker process was killed, which breaks the whole pool
+        result = default._replace(status='failed', error=str(error) or type(error).__name__)
+    if result.status == 'finished':
+        logger.info('%s: finished in %.1f s', result.input_file, result.seconds)
+    else:
+        logger.info('%s: %s (%s)', result.input_file, result.status, result.error)
+    return result
+
+
+def run_batch(config: Dict[str, Any], inputs: List[str], output_folder: str, workers: Optional[int] = None,
+              cancel_token: Optional[CancellationToken] = None) -> List[BatchResult]:
+    """Runs SCOUTS on every input file (see get_batch_inputs) with the same configuration, analysing up to
+    workers files at a time (one per CPU by default), each in its own process and output folder. The report of
+    the batch is updated every time a file finishes. Once cancel_token is cancelled, no new file is started and
+    the files being analysed are left to finish. Returns the outcome of every input file, in order."""
+    input_files = get_batch_inputs(inputs)
+    output_folders = get_batch_output_folders(input_files=input_files, output_folder=output_folder)
+    configs = [{**config, 'input_file': input_file, 'output_folder': folder}
+               for input_file, folder in zip(input_files, output_folders)]
+    from src.cli import parse_config  # src.cli imports this module
+    parse_config(configs[0])  # the configuration is shared, so it is checked once before starting any process
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise InvalidConfigError('the number of batch workers must be a positive integer')
+    os.makedirs(output_folder, exist_ok=True)
+    results = [BatchResult(input_file=run_config['input_file'], output_folder=run_config['output_folder'],
+                           status='cancelled', seconds=None, error=None) for run_config in configs]
+    with get_spawn_executor(max_workers=min(workers, len(configs)), initializer=ignore_interrupts) as executor:
+        futures = {executor.submit(run_batch_file, run_config): i for i, run_config in enumerate(configs)}
+        pending = set(futures)
+        while pending:
+            if cancel_token is not None and cancel_token.is_cancelled():
+                pending = {future for future in pending if not future.cancel()}
+            done, pending = wait(pending, timeout=BATCH_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[futures[future]] = get_future_result(future=future, default=results[futures[future]])
+            if done:
+                save_batch_report(results=results, output_folder=output_folder)
+    path = save_batch_report(results=results, output_folder=output_folder)
+    counts = pd.Series([result.status for result in results]).value_counts()
+    logger.info('batch finished: %s (report saved to %s)',
+                ', '.join(f'{count} {status}' for status, count in counts.items()), path)
+    return results
@@ -0,0 +1,271 @@
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+from collections import namedtuple
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.catalog import CATALOG_FILE, RunCatalog, get_file_size
+from src.profiling import PROFILE_FILE, get_clock, get_clock_difference, get_peak_rss
+from src.utils import get_project_root, get_spawn_executor
+
+# Names of the file (inside the benchmark folder) where results are appended, and of the folders for inputs/outputs
+BENCHMARK_RESULTS_FILE = 'benchmarks.jsonl'
+BENCHMARK_DATA_FOLDER = 'data'
+BENCHMARK_RUNS_FOLDER = 'runs'
+
+# Bumped whenever the layout of the benchmark results (or the synthetic data for a given seed) changes
+BENCHMARK_VERSION = 1
+
+# Seed used by the synthetic data generators, so that every commit is benchmarked on the same input
+BENCHMARK_SEED = 2020
+
+# Number of values generated (and written to the input file) at a time by the synthetic data generators
+BENCHMARK_BLOCK_VALUES = 10_000_000
+
+# Name of the reference sample of the synthetic data (the other samples are named T001, T002, ...)
+BENCHMARK_REFERENCE = 'Ct'
+
+# A benchmark case: the kind of synthetic data ('cytof' or 'rnaseq'), its size, and extra SCOUTS options
+BenchmarkCase = namedtuple('BenchmarkCase', ['name', 'kind', 'cells', 'markers', 'samples', 'options'])
+
+# SCOUTS options used for each kind of data, mirroring the GUI choices for each kind of experiment
+KIND_OPTIONS = {
+    'cytof': {'cutoff_rule': 'sample ref', 'marker_rule': 'single any', 'gating': 'cytof', 'gate_cutoff_value': 0.05},
+    'rnaseq': {'cutoff_rule': 'sample', 'marker_rule': 'single', 'gating': 'rnaseq', 'gate_cutoff_value': 0.0},
+}
+
+# Benchmark suites: 'quick' runs in a few seconds, 'full' covers 10^4-10^7 cells, 30-20,000 markers and 2-100 samples
+BENCHMARK_SUITES = {
+    'quick': [
+        BenchmarkCase('cytof-10k', 'cytof', 10_000, 30, 2, {}),
+        BenchmarkCase('rnaseq-10k', 'rnaseq', 10_000, 200, 4, {}),
+    ],
+    'full': [
+        BenchmarkCase('cytof-10k', 'cytof', 10_000, 30, 2, {}),
+        BenchmarkCase('cytof-100k', 'cytof', 100_000, 30, 10, {}),
+        BenchmarkCase('cytof-1m', 'cytof', 1_000_000, 30, 10, {}),
+        BenchmarkCase('cytof-1m-100-samples', 'cytof', 1_000_000, 30, 100, {}),
+        BenchmarkCase('cytof-10m', 'cytof', 10_000_000, 30, 10, {'stream_chunk_size': 1_000_000}),
+        BenchmarkCase('rnaseq-10k', 'rnaseq', 10_000, 200, 4, {}),
+        BenchmarkCase('rnaseq-10k-2k-markers', 'rnaseq', 10_000, 2_000, 4, {}),
+        BenchmarkCase('rnaseq-100k-2k-markers', 'rnaseq', 100_000, 2_000, 10, {}),
+        # Tables with more than 16,384 markers do not fit in an Excel sheet
+        BenchmarkCase('rnaseq-10k-20k-markers', 'rnaseq', 10_000, 20_000, 2, {'table_format': 'parquet'}),
+    ],
+}
+
+logger = logging.getLogger(__name__)
+
+
+def get_sample_names(samples: int) -> List[str]:
+    """Returns the names of the samples of the synthetic data. No name is a substring of a cell name from another
+    sample, so that samples can be matched by substring as in the SCOUTS templates."""
+    return [BENCHMARK_REFERENCE] + [f'T{number:03d}' for number in range(1, samples)]
+
+
+def get_cell_names(start: int, stop: int, cells: int, samples: List[str]) -> List[str]:
+    """Returns the names of cells start to stop - 1 (e.g. 'Ct_1'), cells being split evenly across the samples, in
+    order (like the rows of the SCOUTS templates)."""
+    sample_numbers = np.arange(start, stop) * len(samples) // cells
+    first_cells = -(-np.arange(len(samples)) * cells // len(samples))  # first cell of each sample (ceiling division)
+    return [f'{samples[sample]}_{cell - first_cells[sample] + 1}' for cell, sample in zip(range(start, stop),
+                                                                                        sample_numbers)]
+
+
+def yield_synthetic_blocks(kind: str, cells: int, markers: int, samples: int,
+                           seed: int = BENCHMARK_SEED) -> Generator[pd.DataFrame, None, None]:
+    """Yields synthetic single-cell data shaped like the SCOUTS templates, a block of rows at a time: cells named
+    after their sample ('Sample' index) and markers named Marker01, Marker02, ... The 'cytof' kind has arcsinh-like
+    values (mostly noise around zero, with a fraction of positive cells per marker), and the 'rnaseq' kind has
+    over-dispersed integer counts (mostly zeros). Samples other than the reference have shifted expression, so that
+    their outliers differ. The data only depends on its shape and seed."""
+    if kind not in KIND_OPTIONS:
+        raise ValueError(f'unknown kind of synthetic data: {kind}')
+    rng = np.random.default_rng([seed, markers])
+    columns = [f'Marker{number:0{max(2, len(str(markers)))}d}' for number in range(1, markers + 1)]
+    sample_names = get_sample_names(samples=samples)
+    sample_effects = 1 + rng.uniform(-0.5, 0.5, size=(samples, markers))
+    sample_effects[0] = 1.0
+    if kind == 'cytof':
+        positive_fractions = rng.uniform(0.05, 0.5, size=markers)
+        positive_means = rng.uniform(-2.0, 0.5, size=markers)
+    else:
+        mean_counts = rng.lognormal(mean=-1.0, sigma=1.5, size=markers)
+    block_cells = max(1, BENCHMARK_BLOCK_VALUES // markers)
+    for block, start in enumerate(range(0, cells, block_cells)):
+        stop = min(start + block_cells, cells)
+        block_rng = np.random.default_rng([seed, markers, cells, block])
+        effects = sample_effects[np.arange(start, stop) * samples // cells]
+        if kind == 'cytof':
+            values = block_rng.normal(0.0, 0.002, size=(stop - start, markers))
+            positive = block_rng.random(size=values.shape) < positive_fractions * effects
+            expression = block_rng.lognormal(mean=0.0, sigma=0.75, size=values.shape) * np.exp(positive_means) * effects
+            values += np.where(positive, expression, 0.0)
+        else:
+            rates = block_rng.gamma(shape=0.5, scale=2 * mean_counts * effects)
+            values = block_rng.poisson(rates).astype(np.int32)
+        index = pd.Index(get_cell_names(start=start, stop=stop, cells=cells, samples=sample_names), name='Sample')
+        yield pd.DataFrame(values, index=index, columns=columns)
+
+
+def write_synthetic_input(case: BenchmarkCase, folder: str, seed: int = BENCHMARK_SEED) -> str:
+    """Writes the synthetic input file of a benchmark case to a folder, unless it was already written by an earlier
+    benchmark, and returns its path. The file is written under a temporary name and renamed once complete."""
+    path = os.path.join(folder, f'{case.kind}-{case.cells}-{case.markers}-{case.samples}-{seed}'
+                                f'-v{BENCHMARK_VERSION}.csv')
+    if os.path.isfile(path):
+        return path
+    os.makedirs(folder, exist_ok=True)
+    logger.info('generating input data for %s', case.name)
+    with open(f'{path}.tmp', 'w', newline='') as input_file:
+        for block_number, block in enumerate(yield_synthetic_blocks(kind=case.kind, cells=case.cells,
+                                                                    markers=case.markers, samples=case.samples,
+                                                                    seed=seed)):
+            block.to_csv(input_file, header=block_number == 0, float_format='%.6g')
+    os.replace(f'{path}.tmp', path)
+    return path
+
+
+def get_case_config(case: BenchmarkCase, input_file: str, output_folder: str, trace_memory: bool = False,
+                    profile_calls: bool = False) -> Dict[str, Any]:
+    """Returns the configuration (see src.cli.run_from_config) used to run SCOUTS on a benchmark case."""
+    return {'input_file': input_file, 'output_folder': output_folder, 'samples': get_sample_names(case.samples),
+            'reference': BENCHMARK_REFERENCE, **KIND_OPTIONS[case.kind], **case.options,
+            'profile_memory': trace_memory, 'profile_calls': profile_calls}
+
+
+def run_benchmark_case(case: BenchmarkCase, folder: str, trace_memory: bool = False,
+                       profile_calls: bool = False) -> Dict[str, Any]:
+    """Runs SCOUTS on a benchmark case (generating its input if needed) and returns the per-stage profile of the
+    run (see src.profiling), followed by a 'violins' stage with the data path of a violin plot."""
+    from src.cli import run_from_config  # imported here, since src.cli imports this module
+    input_file = write_synthetic_input(case=case, folder=os.path.join(folder, BENCHMARK_DATA_FOLDER))
+    output_folder = os.path.join(folder, BENCHMARK_RUNS_FOLDER, case.name)
+    logger.info('running %s', case.name)
+    run_from_config(get_case_config(case=case, input_file=input_file, output_folder=output_folder,
+                                    trace_memory=trace_memory, profile_calls=profile_calls))
+    with open(os.path.join(output_folder, PROFILE_FILE)) as profile_file:
+        profile = json.load(profile_file)
+    violins_stage = benchmark_violins(case=case, input_file=input_file, output_folder=output_folder)
+    if violins_stage is not None:
+        profile['stages'].append(violins_stage)
+    profile['input_bytes'] = get_file_size(input_file)
+    return profile
+
+
+def benchmark_violins(case: BenchmarkCase, input_file: str, output_folder: str) -> Optional[Dict[str, Any]]:
+    """Times the data path of a violin plot (loading the input file, then gathering the first marker of the
+    reference and of another sample, for the whole population and its top outliers) on the output of a benchmark
+    case. Returns the stage in the same layout as the stages of the run profile, or None if the violin plot
+    dependencies (matplotlib and seaborn) are not installed."""
+    try:
+        from src.violins import ViolinGUI
+    except ImportError:
+        logger.info('skipping violins stage (matplotlib and seaborn are not installed)')
+        return None
+    start_clock = get_clock()
+    population_df = pd.read_csv(input_file, index_col=0)
+    catalog = RunCatalog(output_folder) if os.path.isfile(os.path.join(output_folder, CATALOG_FILE)) else None
+    summary_df = pd.read_excel(os.path.join(output_folder, 'summary.xlsx')) if catalog is None else None
+    try:
+        violin_df = ViolinGUI.get_violin_data(population_df=population_df, summary_df=summary_df,
+                                              summary_path=output_folder, catalog=catalog,
+                                              samples=get_sample_names(case.samples)[:2],
+                                              populations=['whole population', 'top outliers'],
+                                              marker=population_df.columns[0], cutoff_from_reference=False)
+    finally:
+        if catalog is not None:
+            catalog.close()
+    return {'stage': 'violins', **get_clock_difference(get_clock(), start_clock), 'peak_rss_bytes': get_peak_rss(),
+            'peak_traced_bytes': None, 'rows_processed': len(violin_df), 'files_written': 0, 'bytes_written': 0}
+
+
+def run_benchmarks(cases: List[BenchmarkCase], folder: str, trace_memory: bool = False, profile_calls: bool = False,
+                   isolate: bool = True) -> List[Dict[str, Any]]:
+    """Runs each benchmark case and appends its results (with the commit being benchmarked) to the results file
+    in the benchmark folder, which is kept across commits. With isolate, each case runs in a new process, so that
+    the peak memory of a case does not include the memory used by the previous ones. Returns the new results."""
+    os.makedirs(folder, exist_ok=True)
+    commit, dirty = get_commit()
+    results = []
+    for case in cases:
+        kwargs = {'case': case, 'folder': folder, 'trace_memory': trace_memory, 'profile_calls': profile_calls}
+        if isolate:
+            with get_spawn_executor(max_workers=1) as executor:
+                profile = executor.submit(run_benchmark_case, **kwargs).result()
+        else:
+            profile = run_benchmark_case(**kwargs)
+        result = {'version': BENCHMARK_VERSION, 'commit': commit, 'dirty': dirty,
+                  'date': datetime.datetime.now().isoformat(timespec='seconds'), 'machine': get_machine(),
+                  'case': case.name, 'kind': case.kind, 'cells': case.cells, 'markers': case.markers,
+                  'samples': case.samples, 'options': case.options, 'trace_memory': trace_memory, **profile}
+        with open(os.path.join(folder, BENCHMARK_RESULTS_FILE), 'a') as results_file:
+            results_file.write(json.dumps(result) + '\n')
+        logger.info('%s: %.2f s, peak memory %.1f MB', case.name, result['wall_seconds'],
+                    (result['peak_rss_bytes'] or 0) / 1e6)
+        results.append(result)
+    return results
+
+
+def get_commit() -> Tuple[Optional[str], Optional[bool]]:
+    """Returns the git commit of the SCOUTS source being benchmarked (None outside of a git repository), and whether
+    the source has uncommitted changes."""
+    root = get_project_root()
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True, check=True)
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.stdout.strip(), bool(status.stdout.strip())
+
+
+def get_machine() -> Dict[str, Any]:
+    """Returns a description of the machine running the benchmarks, since results are only comparable on one."""
+    return {'node': platform.node(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'cpus': os.cpu_count()}
+
+
+def load_benchmark_results(folder: str) -> pd.DataFrame:
+    """Returns the wall time, CPU time, peak memory and rows of each stage of every benchmark run saved in a
+    benchmark folder (one row per run and stage, plus a 'total' stage per run)."""
+    rows = []
+    with open(os.path.join(folder, BENCHMARK_RESULTS_FILE)) as results_file:
+        for line in results_file:
+            result = json.loads(line)
+            run = {key: result[key] for key in ('commit', 'dirty', 'date', 'case', 'status')}
+            for stage in result['stages'] + [{**result, 'stage': 'total', 'rows_processed': None}]:
+                rows.append({**run, 'stage': stage['stage'], 'wall_seconds': stage['wall_seconds'],
+                             'cpu_seconds': stage['cpu_seconds'], 'peak_rss_bytes': stage['peak_rss_bytes'],
+                             'peak_traced_bytes': stage.get('peak_traced_bytes'),
+                             'rows_processed': stage['rows_processed']})
+    return pd.DataFrame(rows, columns=['commit', 'dirty', 'date', 'case', 'status', 'stage', 'wall_seconds',
+                                       'cpu_seconds', 'peak_rss_bytes', 'peak_traced_bytes', 'rows_processed'])
+
+
+def compare_benchmarks(folder: str, base: str, head: Optional[str] = None) -> pd.DataFrame:
+    """Compares the wall time and peak memory of each case and stage between two benchmarked commits (given as a
+    prefix of their hash; by default, head is the latest benchmarked commit). The latest run of each case is used
+    for each commit. Ratios above 1 mean that head is slower or uses more memory than base."""
+    results = load_benchmark_results(folder=folder)
+    results = results.loc[results['status'] == 'finished']
+    if head is None:
+        head = results['commit'].iloc[-1]
+    runs = []
+    for commit in (base, head):
+        selected = results.loc[results['commit'].fillna('').str.startswith(commit)]
+        if selected.empty:
+            raise ValueError(f'no finished benchmarks found for commit {commit}')
+        latest_dates = selected.groupby('case')['date'].transform('max')
+        runs.append(selected.loc[selected['date'] == latest_dates].drop_duplicates(['case', 'stage'], keep='last')
+                    .set_index(['case', 'stage'])[['wall_seconds', 'peak_rss_bytes']])
+    comparison = runs[0].join(runs[1], how='inner', lsuffix='_base', rsuffix='_head')
+    comparison['wall_ratio'] = comparison['wall_seconds_head'] / comparison['wall_seconds_base']
+    comparison['memory_ratio'] = comparison['peak_rss_bytes_head'] / comparison['peak_rss_bytes_base']
+    return comparison
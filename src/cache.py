@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.utils import warn_on_error, write_sidecar_entry
+
+# Cache folder used by the SCOUTS GUI
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'scouts')
+
+# Bumped whenever the layout of cache entries changes, so that old entries are parsed again
+CACHE_VERSION = 2
+
+logger = logging.getLogger(__name__)
+
+
+def load_cached_dataframe(input_file: str, cache_folder: str, loader: Callable[..., pd.DataFrame],
+                          precision: str = 'float64') -> pd.DataFrame:
+    """Loads the input DataFrame (sample names as the index) from the cache folder if the input file was parsed
+    before with the same precision and has not changed since (same path, size, modification time and content hash).
+    The values are then memory-mapped (copy-on-write, so the cache is never modified) instead of parsed again.
+    Otherwise, the file is parsed by the loader function (called with the input file and precision) and saved to
+    the cache for the next runs. Each precision has its own cache entry."""
+    entry_folder = get_cache_entry_folder(input_file=input_file, cache_folder=cache_folder, precision=precision)
+    key = {**get_cache_key(input_file=input_file), 'precision': precision}
+    df = read_cache_entry(entry_folder=entry_folder, key=key)
+    if df is not None:
+        logger.info('loaded %s from cache', input_file)
+        return df
+    df = loader(input_file, precision=precision)
+    with warn_on_error(logger=logger, message=f'could not cache {input_file}'):
+        write_cache_entry(entry_folder=entry_folder, key={**key, 'hash': get_file_hash(input_file)}, df=df)
+    return df
+
+
+def get_cache_entry_folder(input_file: str, cache_folder: str, precision: str = 'float64') -> str:
+    """Returns the folder of the cache entry for an input file (one entry per input path and precision)."""
+    path_hash = hashlib.blake2b(os.path.abspath(input_file).encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_folder, f'{path_hash}-{precision}')
+
+
+def get_cache_key(input_file: str) -> Dict[str, Any]:
+    """Returns the information that must match for a cache entry to be used (except for the content hash,
+    which is only calculated when everything else matches)."""
+    stat = os.stat(input_file)
+    return {'version': CACHE_VERSION, 'path': os.path.abspath(input_file), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def get_file_hash(path: str) -> str:
+    """Returns the hash of the contents of a file, read 1 MB at a time."""
+    file_hash = hashlib.blake2b()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(2 ** 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def read_cache_entry(entry_folder: str, key: Dict[str, Any]) -> Optional[pd.DataFrame]:
+    """Returns the cached DataFrame, with its values memory-mapped, or None if the entry is missing or stale."""
+    sidecar = read_cache_sidecar(entry_folder=entry_folder)
+    if sidecar is None:
+        return None
+    if any(sidecar['key'].get(name) != value for name, value in key.items()):
+        return None
+    if sidecar['key'].get('hash') != get_file_hash(key['path']):
+        return None
+    return load_cache_entry(entry_folder=entry_folder, sidecar=sidecar)
+
+
+def read_cache_sidecar(entry_folder: str) -> Optional[Dict[str, Any]]:
+    """Returns the JSON sidecar of a cache entry, or None if it is missing or unreadable."""
+    try:
+        with open(os.path.join(entry_folder, 'sidecar.json')) as sidecar_file:
+            return json.load(sidecar_file)
+    except (OSError, ValueError):
+        return None
+
+
+def load_cache_entry(entry_folder: str, sidecar: Dict[str, Any]) -> pd.DataFrame:
+    """Loads the DataFrame of a cache entry described by its sidecar, with its values memory-mapped."""
+    values = np.load(os.path.join(entry_folder, 'values.npy'), mmap_mode='c')
+    index = pd.Index(sidecar['index'], name=sidecar['index_name'])
+    df = pd.DataFrame(values, index=index, columns=sidecar['columns'], copy=False)
+    if any(dtype != values.dtype.name for dtype in sidecar['dtypes']):  # mixed dtypes were saved as float
+        df = df.astype(dict(zip(sidecar['columns'], sidecar['dtypes'])))
+    return df
+
+
+def write_cache_entry(entry_folder: str, key: Dict[str, Any], df: pd.DataFrame) -> None:
+    """Saves the values of the DataFrame as a .npy file and its index and column names to a JSON sidecar (see
+    write_sidecar_entry). DataFrames with non-numeric values are not cached."""
+    if not all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in df.dtypes):
+        logger.info('input file has non-numeric values and was not cached')
+        return
+    sidecar = {'key': key, 'index_name': df.index.name, 'index': df.index.tolist(), 'columns': list(df.columns),
+               'dtypes': [dtype.name for dtype in df.dtypes]}
+    write_sidecar_entry(folder=entry_folder, sidecar=sidecar,
+                        write_data=lambda: np.save(os.path.join(entry_folder, 'values.npy'), df.to_numpy()))
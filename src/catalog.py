@@ -0,0 +1,139 @@
+import os
+import sqlite3
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+# Name of the run catalog, inside the output folder given to CatalogWriter/RunCatalog
+CATALOG_FILE = 'catalog.sqlite'
+
+# Bumped whenever the layout of the catalog changes
+CATALOG_VERSION = 1
+
+# Formats of the output files of a subset, from the quickest to the slowest to read back (see get_data_path)
+DATA_FORMAT_PREFERENCE = ['parquet', 'feather', 'csv', 'xlsx']
+
+CATALOG_SCHEMA = """
+CREATE TABLE subsets (file_number INTEGER PRIMARY KEY, cutoff_from TEXT, reference TEXT, outliers_for TEXT,
+                      category TEXT, rows INTEGER);
+CREATE TABLE files (file_number INTEGER, format TEXT, path TEXT, bytes INTEGER);
+CREATE TABLE sample_counts (file_number INTEGER, sample TEXT, rows INTEGER);
+CREATE INDEX subsets_by_info ON subsets (cutoff_from, outliers_for, category);
+CREATE INDEX files_by_number ON files (file_number);
+CREATE INDEX sample_counts_by_number ON sample_counts (file_number);
+"""
+
+
+class CatalogWriter:
+    """Writes a SQLite catalog of the subsets of a SCOUTS run: the Info fields, size and per-sample row counts of
+    each subset, plus the path (relative to the output folder), format and size in bytes of every file exported
+    for it. Subsets are kept in memory and the catalog is only written by save(), once all files were written."""
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.subsets: List[tuple] = []
+        self.files: List[tuple] = []
+        self.sample_counts: List[tuple] = []
+
+    def save(self) -> None:
+        """Writes the catalog (replacing any catalog from a previous run), reading the size of every file."""
+        path = os.path.join(self.folder, CATALOG_FILE)
+        if os.path.exists(path):
+            os.remove(path)
+        files = [(number, file_format, file_path, get_file_size(os.path.join(self.folder, file_path)))
+                 for number, file_format, file_path in self.files]
+        connection = sqlite3.connect(path)
+        try:
+            with connection:
+                connection.executescript(CATALOG_SCHEMA)
+                connection.execute(f'PRAGMA user_version = {CATALOG_VERSION}')
+                connection.executemany('INSERT INTO subsets VALUES (?, ?, ?, ?, ?, ?)', self.subsets)
+                connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', files)
+                connection.executemany('INSERT INTO sample_counts VALUES (?, ?, ?)', self.sample_counts)
+        finally:
+            connection.close()
+
+    def add(self, number: int, info: Dict[str, Any], rows: int, sample_counts: Dict[str, int],
+            paths: List[str]) -> None:
+        """Adds a subset under the given file number, along with the paths of the files exported for it."""
+        self.subsets.append((number, info['cutoff_from'], info['reference'], info['outliers_for'], info['category'],
+                             rows))
+        for path in paths:
+            relative_path = os.path.relpath(path, self.folder)
+            self.files.append((number, os.path.splitext(path)[1].lstrip('.'), relative_path))
+        self.sample_counts.extend((number, sample, int(count)) for sample, count in sample_counts.items())
+
+
+def get_file_size(path: str) -> Optional[int]:
+    """Returns the size of a file in bytes, or None if it does not exist."""
+    return os.path.getsize(path) if os.path.isfile(path) else None
+
+
+class RunCatalog:
+    """Reads the SQLite catalog written by SCOUTS (in the output folder), answering which subsets match a given
+    set of Info fields without scanning the summary table. Safe to use from a thread other than the one that
+    opened it (e.g. from a Qt worker), as long as it is not used by two threads at once."""
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        path = os.path.join(folder, CATALOG_FILE)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f'no run catalog found in {folder}')
+        self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOG_VERSION:
+            self.connection.close()
+            raise ValueError(f'unsupported run catalog version: {version}')
+
+    def __enter__(self) -> 'RunCatalog':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the catalog."""
+        self.connection.close()
+
+    def find(self, **info: Any) -> List[int]:
+        """Returns the file numbers of the subsets whose Info fields match all keyword arguments
+        (e.g. find(cutoff_from='reference', outliers_for='CD45', category='top outliers'))."""
+        unknown = [key for key in info if key not in ('cutoff_from', 'reference', 'outliers_for', 'category')]
+        if unknown:
+            raise ValueError(f'unknown Info fields: {", ".join(unknown)}')
+        query = 'SELECT file_number FROM subsets'
+        if info:
+            query += ' WHERE ' + ' AND '.join(f'{key} = ?' for key in info)
+        return [number for (number,) in self.connection.execute(query + ' ORDER BY file_number', list(info.values()))]
+
+    def get_subsets(self) -> pd.DataFrame:
+        """Returns the file number, Info fields and size of every subset, in file number order."""
+        cursor = self.connection.execute('SELECT * FROM subsets ORDER BY file_number')
+        columns = ['file number' if column[0] == 'file_number' else column[0] for column in cursor.description]
+        return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+    def get_info(self, number: int) -> Dict[str, Any]:
+        """Returns how a subset was selected (cutoff_from, reference, outliers_for and category) and its size."""
+        cursor = self.connection.execute('SELECT cutoff_from, reference, outliers_for, category, rows FROM subsets '
+                                         'WHERE file_number = ?', (number,))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(number)
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def get_paths(self, number: int) -> Dict[str, str]:
+        """Returns the full path of each file exported for a subset, keyed by format (e.g. 'csv')."""
+        cursor = self.connection.execute('SELECT format, path FROM files WHERE file_number = ?', (number,))
+        return {file_format: os.path.join(self.folder, path) for file_format, path in cursor}
+
+    def get_data_path(self, number: int) -> str:
+        """Returns the path of the output file of a subset that is quickest to read back (columnar formats first,
+        then .csv, then .xlsx). Raises an exception if no file was exported for the subset."""
+        paths = self.get_paths(number)
+        for file_format in DATA_FORMAT_PREFERENCE:
+            if file_format in paths:
+                return paths[file_format]
+        raise FileNotFoundError(f'no output file was exported for subset {number}')
+
+    def get_sample_counts(self, number: int) -> Dict[str, int]:
+        """Returns the number of rows of a subset that belong to each sample."""
+        cursor = self.connection.execute('SELECT sample, rows FROM sample_counts WHERE file_number = ?', (number,))
+        return dict(cursor.fetchall())
@@ -0,0 +1,350 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
+
+from src.analysis import PRECISIONS, QUANTILE_METHODS, SAMPLE_MATCH_MODES, TABLE_FORMATS, start_scouts
+from src.batch import BATCH_REPORT_FILE, run_batch
+from src.benchmark import BENCHMARK_SUITES, compare_benchmarks, run_benchmarks
+from src.config import DEFAULT_CONFIG, ScoutsConfig
+from src.progress import CancellationToken, Progress, format_progress
+from src.streaming import start_scouts_streaming
+from src.utils import (AnalysisCancelledError, InvalidConfigError, NoIOPathError, NoReferenceError, NoSampleError,
+                       PandasInputError, SampleNamingError)
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of seconds between two progress messages of the same stage in headless runs
+LOG_PROGRESS_INTERVAL = 10.0
+
+# Words allowed for the options that are passed to SCOUTS as strings
+CHOICES = {
+    'cutoff_rule': ['sample', 'ref'],
+    'marker_rule': ['single', 'any'],
+    'gating': ['no_gate', 'cytof', 'rnaseq'],
+    'sample_match': list(SAMPLE_MATCH_MODES),
+    'quantile_method': list(QUANTILE_METHODS),
+    'table_format': list(TABLE_FORMATS),
+    'precision': list(PRECISIONS),
+}
+
+# Options that accept more than one of the words above (e.g. cutoff_rule: "sample ref")
+MULTIPLE_CHOICE_OPTIONS = ['cutoff_rule', 'marker_rule']
+
+# Options that must be positive integers when given
+POSITIVE_INTEGER_OPTIONS = ['gate_chunk_size', 'writer_queue_depth', 'stream_chunk_size']
+
+# Options that must be zero or positive integers
+NON_NEGATIVE_INTEGER_OPTIONS = ['n_writers', 'sample_workers']
+
+# Options used by the streaming mode (set by "stream_chunk_size"), which only writes .csv files
+STREAMING_OPTIONS = ['input_file', 'output_folder', 'cutoff_rule', 'marker_rule', 'tukey_factor', 'export_csv',
+                     'sample_list', 'gating', 'gate_cutoff_value', 'export_gated', 'non_outliers', 'bottom_outliers',
+                     'sample_match', 'quantile_method', 'sketch_error', 'table_format', 'profile_memory',
+                     'profile_calls']
+
+# Options used by the sparse mode (set by "sparse"), which only supports scRNA-seq gating and .csv output files
+SPARSE_OPTIONS = ['input_file', 'output_folder', 'cutoff_rule', 'marker_rule', 'tukey_factor', 'export_csv',
+                  'sample_list', 'gate_cutoff_value', 'export_gated', 'non_outliers', 'bottom_outliers',
+                  'sample_match', 'precision', 'table_format', 'profile_memory', 'profile_calls']
+
+ERROR_MESSAGES = {
+    NoIOPathError: "no input file and/or output folder was provided in the configuration.",
+    NoReferenceError: ("no reference sample was found in the configuration, but analysis was set to reference. "
+                       "Please add a reference sample, or change the rule for cutoff calculation."),
+    NoSampleError: "no sample names were found in the configuration. Please add your sample names.",
+    PandasInputError: ("the input file could not be read (supported formats are: .csv, .xlsx, and .parquet, "
+                       ".feather or .arrow if pyarrow is installed)."),
+    SampleNamingError: ("your sample names were not found in the input file. Please make sure that the "
+                        "names were typed correctly (case-sensitive)."),
+    AnalysisCancelledError: "the analysis was cancelled.",
+}
+
+
+def load_config(path: str) -> Dict[str, Any]:
+    """Loads the configuration of a headless SCOUTS run from a .json or .yaml/.yml file."""
+    if not os.path.isfile(path):
+        raise InvalidConfigError(f'configuration file {path} does not exist')
+    with open(path) as config_file:
+        if path.endswith('.json'):
+            config = json.load(config_file)
+        elif path.endswith('.yaml') or path.endswith('.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise InvalidConfigError('reading .yaml configuration files requires PyYAML (pip install pyyaml)')
+            config = yaml.safe_load(config_file)
+        else:
+            raise InvalidConfigError('configuration file must be a .json, .yaml or .yml file')
+    if not isinstance(config, dict):
+        raise InvalidConfigError('configuration file must contain a mapping of option names to values')
+    return config
+
+
+def parse_config(config: Dict[str, Any]) -> ScoutsConfig:
+    """Validates a configuration dictionary and converts it into the options of a run (see src.config). Samples are
+    given as a list of names under "samples", and the reference sample (if any) as a name under "reference"."""
+    config = dict(config)
+    kwargs = dict(DEFAULT_CONFIG)
+    kwargs['input_file'] = config.pop('input_file', None)
+    kwargs['output_folder'] = config.pop('output_folder', None)
+    if not kwargs['input_file'] or not kwargs['output_folder']:
+        raise NoIOPathError
+    samples, reference = config.pop('samples', None), config.pop('reference', None)
+    kwargs['sample_list'] = get_sample_list(samples=samples, reference=reference)
+    for key, value in config.items():
+        if key not in DEFAULT_CONFIG:
+            raise InvalidConfigError(f'unknown option "{key}" in configuration')
+        kwargs[key] = value
+    validate_config_values(kwargs)
+    return ScoutsConfig(**kwargs)
+
+
+def get_sample_list(samples: Optional[List[str]], reference: Optional[str]) -> List[Tuple[str, str]]:
+    """Builds the sample table (same format as the one in the SCOUTS GUI) from the sample names and reference."""
+    if not samples:
+        raise NoSampleError
+    if isinstance(samples, str):
+        samples = [samples]
+    if reference is not None and reference not in samples:
+        raise InvalidConfigError(f'reference "{reference}" is not one of the samples')
+    return [(str(sample), 'yes' if sample == reference else 'no') for sample in samples]
+
+
+def validate_config_values(kwargs: Dict[str, Any]) -> None:
+    """Checks whether the options passed to start_scouts have valid values. Raises an exception if they don't."""
+    for key, allowed_words in CHOICES.items():
+        words = str(kwargs[key]).split()
+        if len(words) > 1 and key not in MULTIPLE_CHOICE_OPTIONS:
+            words = []
+        if not words or any(word not in allowed_words for word in words):
+            raise InvalidConfigError(f'invalid value "{kwargs[key]}" for option "{key}" (choose from {allowed_words})')
+    try:
+        kwargs['tukey_factor'] = float(kwargs['tukey_factor'])
+        if kwargs['gate_cutoff_value'] is not None:
+            kwargs['gate_cutoff_value'] = float(kwargs['gate_cutoff_value'])
+    except (TypeError, ValueError):
+        raise InvalidConfigError('options "tukey_factor" and "gate_cutoff_value" must be numbers')
+    try:
+        kwargs['sketch_error'] = float(kwargs['sketch_error'])
+    except (TypeError, ValueError):
+        kwargs['sketch_error'] = None
+    if kwargs['sketch_error'] is None or not 0 < kwargs['sketch_error'] < 1:
+        raise InvalidConfigError('option "sketch_error" must be a number between 0 and 1')
+    if kwargs['tukey_sweep'] is not None:
+        kwargs['tukey_sweep'] = get_tukey_sweep(kwargs['tukey_sweep'])
+        if kwargs['quantile_method'] != 'exact' or kwargs['stream_chunk_size'] is not None:
+            raise InvalidConfigError('option "tukey_sweep" requires exact quantiles and is not available in '
+                                     'streaming mode')
+    if kwargs['gating'] != 'no_gate' and kwargs['gate_cutoff_value'] is None:
+        raise InvalidConfigError(f'option "gate_cutoff_value" is required when gating is "{kwargs["gating"]}"')
+    for key, value in kwargs.items():
+        if isinstance(DEFAULT_CONFIG.get(key), bool) and not isinstance(value, bool):
+            raise InvalidConfigError(f'option "{key}" must be true or false')
+        if key in POSITIVE_INTEGER_OPTIONS and value is not None and (type(value) is not int or value < 1):
+            raise InvalidConfigError(f'option "{key}" must be a positive integer')
+        if key in NON_NEGATIVE_INTEGER_OPTIONS and (type(value) is not int or value < 0):
+            raise InvalidConfigError(f'option "{key}" must be zero or a positive integer')
+    if kwargs['stream_chunk_size'] is not None and any(kwargs[key] for key in ['export_excel', 'single_excel',
+                                                                               'export_parquet', 'export_feather',
+                                                                               'export_manifest', 'export_store']):
+        raise InvalidConfigError('only .csv output files are available in streaming mode '
+                                 '(when "stream_chunk_size" is set)')
+    if kwargs['stream_chunk_size'] is not None and kwargs['reuse_stages']:
+        raise InvalidConfigError('option "reuse_stages" is not available in streaming mode '
+                                 '(when "stream_chunk_size" is set)')
+    if kwargs['stream_chunk_size'] is None and kwargs['scratch_folder'] is not None:
+        raise InvalidConfigError('option "scratch_folder" is only used in streaming mode '
+                                 '(when "stream_chunk_size" is set)')
+    if kwargs['stream_chunk_size'] is not None and kwargs['precision'] != 'float64':
+        raise InvalidConfigError('option "precision" cannot be changed in streaming mode '
+                                 '(when "stream_chunk_size" is set)')
+    if kwargs['sparse']:
+        validate_sparse_config_values(kwargs)
+    if kwargs['sample_workers'] and ('sample' not in kwargs['cutoff_rule'] or kwargs['quantile_method'] != 'exact'
+                                     or kwargs['tukey_sweep'] is not None or kwargs['reuse_stages']
+                                     or kwargs['stream_chunk_size'] is not None):
+        raise InvalidConfigError('option "sample_workers" requires "cutoff_rule" to include "sample" and exact '
+                                 'quantiles, and is not available with "tukey_sweep", "reuse_stages" or in '
+                                 'streaming mode')
+    if kwargs['single_excel'] and kwargs['table_format'] != 'xlsx':
+        raise InvalidConfigError('option "single_excel" requires "table_format" to be "xlsx"')
+
+
+def validate_sparse_config_values(kwargs: Dict[str, Any]) -> None:
+    """Checks whether the options passed to start_scouts can be used in sparse mode (when "sparse" is true).
+    Raises an exception if they can't."""
+    if importlib.util.find_spec('scipy') is None:
+        raise InvalidConfigError('option "sparse" requires SciPy (pip install scipy)')
+    if kwargs['gating'] != 'rnaseq' or kwargs['gate_cutoff_value'] < 0:
+        raise InvalidConfigError('option "sparse" requires "gating" to be "rnaseq", with a "gate_cutoff_value" of '
+                                 'zero or more')
+    unsupported = [key for key, value in kwargs.items() if key not in SPARSE_OPTIONS + ['sparse', 'gating']
+                   and value != DEFAULT_CONFIG[key]]
+    if unsupported:
+        raise InvalidConfigError(f'option(s) {", ".join(unsupported)} are not available in sparse mode '
+                                 '(when "sparse" is true)')
+
+
+def get_tukey_sweep(tukey_sweep: Any) -> List[float]:
+    """Converts the "tukey_sweep" option (a list of Tukey factors) into a list of floats. Raises an exception if it
+    is empty, or if any factor is negative or repeated."""
+    message = 'option "tukey_sweep" must be a list of different, non-negative numbers'
+    if not isinstance(tukey_sweep, list) or not tukey_sweep:
+        raise InvalidConfigError(message)
+    try:
+        tukey_factors = [float(tukey) for tukey in tukey_sweep]
+    except (TypeError, ValueError):
+        raise InvalidConfigError(message)
+    if any(tukey < 0 for tukey in tukey_factors) or len(set(tukey_factors)) < len(tukey_factors):
+        raise InvalidConfigError(message)
+    return tukey_factors
+
+
+def run_from_config(config: Dict[str, Any], cancel_token: Optional[CancellationToken] = None,
+                    progress_callback: Optional[Callable[[Progress], None]] = None) -> None:
+    """Runs a full SCOUTS analysis (load, gate, cutoff, subset and export) from a configuration dictionary,
+    without a GUI. This is the entry point for running SCOUTS from Python scripts. If "stream_chunk_size" is set,
+    the input file is read in chunks of that many rows instead of being loaded into memory at once. If "sparse" is
+    true, the gated data is held as a sparse matrix (see src.sparse). The run can be stopped through cancel_token
+    and followed through progress_callback (see src.progress)."""
+    scouts_config = parse_config(config)
+    os.makedirs(scouts_config.output_folder, exist_ok=True)
+    if scouts_config.sparse:
+        from src.sparse import start_scouts_sparse  # SciPy is only imported when sparse mode is requested
+        start_scouts_sparse(cancel_token=cancel_token, progress_callback=progress_callback,
+                            **scouts_config.get_options(SPARSE_OPTIONS))
+    elif scouts_config.stream_chunk_size is None:
+        start_scouts(scouts_config, cancel_token=cancel_token, progress_callback=progress_callback)
+    else:
+        start_scouts_streaming(chunk_size=scouts_config.stream_chunk_size,
+                               scratch_folder=scouts_config.scratch_folder, cancel_token=cancel_token,
+                               progress_callback=progress_callback, **scouts_config.get_options(STREAMING_OPTIONS))
+
+
+def benchmark(args: argparse.Namespace) -> None:
+    """Runs the benchmark suite, or compares the results of two commits, from the parsed "benchmark" command."""
+    if args.compare is not None:
+        if len(args.compare) > 2:
+            sys.exit('scouts: error: --compare takes one or two commits')
+        try:
+            comparison = compare_benchmarks(args.folder, *args.compare)
+        except (OSError, ValueError) as error:
+            sys.exit(f'scouts: error: {error}')
+        print(comparison.to_string(float_format='{:.3f}'.format))
+        return
+    cases = BENCHMARK_SUITES[args.suite]
+    if args.cases:
+        unknown = [name for name in args.cases if name not in [case.name for case in cases]]
+        if unknown:
+            sys.exit(f'scouts: error: unknown benchmark case(s) in suite "{args.suite}": {", ".join(unknown)}')
+        cases = [case for case in cases if case.name in args.cases]
+    run_benchmarks(cases=cases, folder=args.folder, trace_memory=args.memory)
+
+
+class ProgressLogger:
+    """Progress callback for headless runs: logs the start of every stage, and the progress of the current stage
+    at most once every LOG_PROGRESS_INTERVAL seconds."""
+    def __init__(self, interval: float = LOG_PROGRESS_INTERVAL) -> None:
+        self.interval = interval
+        self.stage = None
+        self.last_log_time = 0.0
+
+    def __call__(self, progress: Progress) -> None:
+        now = time.monotonic()
+        if progress.stage != self.stage or now - self.last_log_time >= self.interval:
+            self.stage = progress.stage
+            self.last_log_time = now
+            logger.info(format_progress(progress))
+
+
+@contextmanager
+def cancel_on_signals(cancel_token: CancellationToken) -> Generator[None, None, None]:
+    """Cancels the token on the first SIGINT (Ctrl+C) or SIGTERM, so that the run stops at its next check instead
+    of being killed halfway through writing a file. A second signal stops the process right away."""
+    signal_numbers = [signal.SIGINT, signal.SIGTERM]
+    previous_handlers = {number: signal.getsignal(number) or signal.SIG_DFL for number in signal_numbers}
+
+    def handle_signal(number: int, _frame: Any) -> None:
+        logger.info('cancelling the analysis (send the signal again to stop immediately)')
+        cancel_token.cancel()
+        for signal_number, handler in previous_handlers.items():
+            signal.signal(signal_number, handler)
+
+    for number in signal_numbers:
+        signal.signal(number, handle_signal)
+    try:
+        yield
+    finally:
+        for number, handler in previous_handlers.items():
+            signal.signal(number, handler)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Entry point function for the SCOUTS command line. Starts the SCOUTS GUI if no command is given."""
+    parser = argparse.ArgumentParser(prog='scouts', description='SCOUTS - Single Cell Outlier Selector')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='run a SCOUTS analysis without the GUI')
+    run_parser.add_argument('--config', required=True, help='path to a .json or .yaml file with the run options')
+    run_parser.add_argument('--input', dest='input_file', help='input file (overrides the configuration file)')
+    run_parser.add_argument('--output', dest='output_folder', help='output folder (overrides the configuration file)')
+    run_parser.add_argument('--profile', action='store_true',
+                            help='also save a cProfile dump of the run (run_profile.pstats) in the output folder')
+    batch_parser = subparsers.add_parser('batch', help='run SCOUTS on many input files with the same options')
+    batch_parser.add_argument('inputs', nargs='+', metavar='INPUT',
+                              help='input file, folder of input files or glob pattern (e.g. "data/*.csv")')
+    batch_parser.add_argument('--config', required=True,
+                              help='path to a .json or .yaml file with the run options shared by all input files')
+    batch_parser.add_argument('--output', dest='output_folder', required=True,
+                              help='output folder (each input file gets a folder with its name inside it)')
+    batch_parser.add_argument('--workers', type=int, default=None,
+                              help='number of input files analysed at a time (default: number of CPUs)')
+    benchmark_parser = subparsers.add_parser('benchmark', help='benchmark SCOUTS on synthetic data')
+    benchmark_parser.add_argument('--folder', default='scouts-benchmarks',
+                                  help='folder for the synthetic inputs, outputs and results (kept across commits)')
+    benchmark_parser.add_argument('--suite', choices=list(BENCHMARK_SUITES), default='quick',
+                                  help='benchmark cases to run')
+    benchmark_parser.add_argument('--case', dest='cases', action='append',
+                                  help='only run the case with this name (can be repeated)')
+    benchmark_parser.add_argument('--memory', action='store_true',
+                                  help='also trace the memory allocated during each stage (makes runs much slower)')
+    benchmark_parser.add_argument('--compare', nargs='+', metavar='COMMIT',
+                                  help='compare the results of two commits (the latest one by default) instead of '
+                                       'running the benchmarks')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        from src.gui import main as gui_main  # PySide2 is only imported when the GUI is requested
+        gui_main()
+        return
+    logging.basicConfig(level=logging.INFO, format='scouts: %(message)s')
+    if args.command == 'benchmark':
+        benchmark(args)
+        return
+    try:
+        config = load_config(args.config)
+        for key in ('input_file', 'output_folder'):
+            if args.command == 'run' and getattr(args, key) is not None:
+                config[key] = getattr(args, key)
+        cancel_token = CancellationToken()
+        if args.command == 'batch':
+            with cancel_on_signals(cancel_token=cancel_token):
+                results = run_batch(config=config, inputs=args.inputs, output_folder=args.output_folder,
+                                    workers=args.workers, cancel_token=cancel_token)
+            failed = [result for result in results if result.status != 'finished']
+            if failed:
+                sys.exit(f'scouts: error: {len(failed)} of {len(results)} input files were not analysed '
+                         f'(see {os.path.join(args.output_folder, BATCH_REPORT_FILE)})')
+            return
+        if args.profile:
+            config['profile_calls'] = True
+        with cancel_on_signals(cancel_token=cancel_token):
+            run_from_config(config, cancel_token=cancel_token, progress_callback=ProgressLogger())
+    except (InvalidConfigError, *ERROR_MESSAGES) as error:
+        message = ERROR_MESSAGES.get(type(error), str(error))
+        sys.exit(f'scouts: error: {message}')
@@ -0,0 +1,65 @@
+from dataclasses import MISSING, dataclass, fields, replace
+from typing import Any, Dict, List, Optional, Tuple
+
+
+@dataclass
+class ScoutsConfig:
+    """Options of a SCOUTS run. Besides the input file, output folder and sample table, every option has the same
+    default as in the SCOUTS GUI. The options of the streaming mode (stream_chunk_size, scratch_folder) and of the
+    sparse mode (sparse) are only used by src.cli.run_from_config, which picks the function that runs SCOUTS."""
+    input_file: str
+    output_folder: str
+    sample_list: List[Tuple[str, str]]
+    cutoff_rule: str = 'sample'
+    marker_rule: str = 'single'
+    tukey_factor: float = 1.5
+    export_csv: bool = True
+    export_excel: bool = False
+    single_excel: bool = False
+    gating: str = 'no_gate'
+    gate_cutoff_value: Optional[float] = None
+    export_gated: bool = False
+    non_outliers: bool = False
+    bottom_outliers: bool = False
+    sample_match: str = 'substring'
+    contiguous_samples: bool = False
+    gate_chunk_size: Optional[int] = None
+    n_writers: int = 0
+    writer_queue_depth: Optional[int] = None
+    stream_chunk_size: Optional[int] = None
+    quantile_method: str = 'exact'
+    sketch_error: float = 0.01
+    export_parquet: bool = False
+    export_feather: bool = False
+    table_format: str = 'xlsx'
+    cache_folder: Optional[str] = None
+    precision: str = 'float64'
+    export_manifest: bool = False
+    export_store: bool = False
+    reuse_stages: bool = False
+    tukey_sweep: Optional[List[float]] = None
+    profile_memory: bool = False
+    profile_calls: bool = False
+    sparse: bool = False
+    sample_workers: int = 0
+    scratch_folder: Optional[str] = None
+
+    def replace(self, **options: Any) -> 'ScoutsConfig':
+        """Returns a copy of the configuration with some of its options changed."""
+        return replace(self, **options)
+
+    def get_options(self, names: List[str]) -> Dict[str, Any]:
+        """Returns the values of some options, by name (e.g. to call the functions of the streaming mode)."""
+        return {name: getattr(self, name) for name in names}
+
+
+# Values used for any option missing from a configuration (the defaults of ScoutsConfig)
+DEFAULT_CONFIG = {field.name: field.default for field in fields(ScoutsConfig) if field.default is not MISSING}
+
+
+def get_scouts_config(config: Optional[ScoutsConfig] = None, **options: Any) -> ScoutsConfig:
+    """Returns the configuration of a run given as a ScoutsConfig, as options (the fields of ScoutsConfig) or as a
+    ScoutsConfig with some of its options replaced."""
+    if config is None:
+        return ScoutsConfig(**options)
+    return config.replace(**options) if options else config
@@ -1,20 +1,21 @@
 import os
 import sys
-import time
 import traceback
 import webbrowser
 from typing import Callable, Dict, Generator, Tuple
 
 from PySide2.QtCore import QEvent, QObject, QRunnable, QThreadPool, Qt, Signal, Slot
 from PySide2.QtGui import QIcon, QKeySequence, QPixmap
-from PySide2.QtWidgets import (QApplication, QButtonGroup, QCheckBox, QDialog, QDoubleSpinBox, QFileDialog, QFormLayout,
-                               QFrame, QGridLayout, QHBoxLayout, QHeaderView, QLabel, QLineEdit, QMainWindow,
-                               QMessageBox, QPushButton, QRadioButton, QShortcut, QSizePolicy, QStackedWidget,
-                               QTableWidget, QTableWidgetItem, QVBoxLayout, QWidget)
+from PySide2.QtWidgets import (QApplication, QButtonGroup, QCheckBox, QComboBox, QDialog, QDoubleSpinBox, QFileDialog,
+                               QFormLayout, QFrame, QGridLayout, QHBoxLayout, QHeaderView, QLabel, QLineEdit,
+                               QMainWindow, QMessageBox, QProgressBar, QPushButton, QRadioButton, QShortcut,
+                               QSizePolicy, QStackedWidget, QTableWidget, QTableWidgetItem, QVBoxLayout, QWidget)
 
 from src.analysis import start_scouts
-from src.utils import (NoIOPathError, NoReferenceError, NoSampleError, PandasInputError, SampleNamingError,
-                       get_project_root)
+from src.cache import DEFAULT_CACHE_FOLDER
+from src.progress import CancellationToken, Progress, format_progress
+from src.utils import (AnalysisCancelledError, NoIOPathError, NoReferenceError, NoSampleError, PandasInputError,
+                       SampleNamingError, get_project_root)
 
 
 class SCOUTS(QMainWindow):
@@ -28,7 +29,8 @@ class SCOUTS(QMainWindow):
         'run button': 'QPushButton {font-size: 18pt; font-weight: 600}',
         'line edit': 'QLineEdit {font-size: 10pt}',
         'checkbox': 'QCheckBox {font-size: 10pt}',
-        'radio button': 'QRadioButton {font-size: 10pt}'
+        'radio button': 'QRadioButton {font-size: 10pt}',
+        'drop down': 'QComboBox {font-size: 10pt}'
     }
 
     def __init__(self) -> None:
@@ -42,6 +44,9 @@ class SCOUTS(QMainWindow):
         super().__init__()
         self.rootdir = get_project_root()
         self.threadpool = QThreadPool()
+        # Cancellation token of the running analysis (None while no analysis is running)
+        self.cancel_token = None
+        self.quitting = False
         # Sets values for QMainWindow
         self.setWindowTitle("SCOUTS")
         self.setWindowIcon(QIcon(os.path.abspath(os.path.join(self.rootdir, 'src', 'scouts.ico'))))
@@ -91,12 +96,25 @@ class SCOUTS(QMainWindow):
         self.input_button.setStyleSheet(self.style['button'])
         self.set_icon(self.input_button, 'x-office-spreadsheet')
         self.input_button.setObjectName('input')
-        self.input_button.setText(' Select input file (.xlsx or .csv)')
+        self.input_button.setText(' Select input file (.xlsx, .csv, .parquet or .feather)')
         self.input_button.clicked.connect(self.get_path)
         # Input path box
         self.input_path = QLineEdit(self.main_page)
         self.input_path.setObjectName('input_path')
         self.input_path.setStyleSheet(self.style['line edit'])
+        # Cache parsed input checkbox
+        self.input_cache = QCheckBox(self.main_page)
+        self.input_cache.setText('Cache parsed input file (faster re-runs)')
+        self.input_cache.setToolTip('Saves the parsed input file to a binary cache, so that later analyses of the\n'
+                                    'same (unchanged) input file skip reading it again.\nCache folder: '
+                                    f'{DEFAULT_CACHE_FOLDER}')
+        self.input_cache.setStyleSheet(self.style['checkbox'])
+        # Single precision checkbox
+        self.input_float32 = QCheckBox(self.main_page)
+        self.input_float32.setText('Load values as float32 (halves memory use)')
+        self.input_float32.setToolTip('Holds input values in single precision (float32) and sample names as\n'
+                                      'categories, which reduces memory use and speeds up large analyses.')
+        self.input_float32.setStyleSheet(self.style['checkbox'])
         # Go to sample naming page
         self.samples_button = QPushButton(self.main_page)
         self.samples_button.setStyleSheet(self.style['button'])
@@ -111,6 +129,8 @@ class SCOUTS(QMainWindow):
         self.gates_button.clicked.connect(self.goto_gates_page)
         # Add widgets above to input frame Layout
         self.input_frame.layout().addRow(self.input_button, self.input_path)
+        self.input_frame.layout().addRow(self.input_cache)
+        self.input_frame.layout().addRow(self.input_float32)
         self.input_frame.layout().addRow(self.samples_button)
         self.input_frame.layout().addRow(self.gates_button)
 
@@ -198,6 +218,13 @@ class SCOUTS(QMainWindow):
         self.tukey_high.setText('3.0')
         self.tukey_high.setStyleSheet(self.style['radio button'])
         self.tukey_group.addButton(self.tukey_high)
+        # Both Tukey values (sweep)
+        self.tukey_both = QRadioButton(self.main_page)
+        self.tukey_both.setText('both')
+        self.tukey_both.setToolTip('Runs SCOUTS for both Tukey factors at once (quartiles are only calculated once).\n'
+                                   'Outputs of each factor are saved in the "tukey_1.5" and "tukey_3" subfolders.')
+        self.tukey_both.setStyleSheet(self.style['radio button'])
+        self.tukey_group.addButton(self.tukey_both)
         # Add widgets above to analysis frame layout
         self.analysis_frame.layout().addWidget(self.cutoff_text)
         self.cutoff_buttons = QHBoxLayout()
@@ -213,7 +240,6 @@ class SCOUTS(QMainWindow):
         self.tukey_buttons = QHBoxLayout()
         for button in self.tukey_group.buttons():
             self.tukey_buttons.addWidget(button)
-        self.tukey_buttons.addWidget(QLabel())  # aligns row with 2 buttons
         self.analysis_frame.layout().addLayout(self.tukey_buttons)
 
         # ## Output section
@@ -247,21 +273,53 @@ class SCOUTS(QMainWindow):
         self.output_excel = QCheckBox(self.main_page)
         self.output_excel.setText('Export multiple Excel spreadsheets (.xlsx)')
         self.output_excel.setStyleSheet(self.style['checkbox'])
-        self.output_excel.clicked.connect(self.enable_single_excel)
+        # Generate Parquet and Feather checkboxes
+        self.output_parquet = QCheckBox(self.main_page)
+        self.output_parquet.setText('Export multiple Parquet files (.parquet)')
+        self.output_parquet.setToolTip('Compressed columnar files, much faster to save and load than .csv or .xlsx\n'
+                                       '(requires pyarrow)')
+        self.output_parquet.setStyleSheet(self.style['checkbox'])
+        self.output_feather = QCheckBox(self.main_page)
+        self.output_feather.setText('Export multiple Feather files (.feather)')
+        self.output_feather.setToolTip('Arrow IPC files, the fastest format to save and load (requires pyarrow)')
+        self.output_feather.setStyleSheet(self.style['checkbox'])
+        # Generate selection manifest checkbox
+        self.output_manifest = QCheckBox(self.main_page)
+        self.output_manifest.setText('Export selection manifest (row positions only)')
+        self.output_manifest.setToolTip('Saves the gated input once, plus the rows of each output file as a bitmap,\n'
+                                        'instead of a full copy of each output file')
+        self.output_manifest.setStyleSheet(self.style['checkbox'])
+        # Generate single results store checkbox
+        self.output_store = QCheckBox(self.main_page)
+        self.output_store.setText('Export all results into a single Parquet file')
+        self.output_store.setToolTip('Saves every output file into one indexed file (data/results.parquet), for\n'
+                                     'file systems that struggle with many small files (requires pyarrow)')
+        self.output_store.setStyleSheet(self.style['checkbox'])
+        # Reuse stages of previous runs checkbox
+        self.output_reuse = QCheckBox(self.main_page)
+        self.output_reuse.setText('Reuse gating, cutoffs and outliers of previous runs (faster re-runs)')
+        self.output_reuse.setToolTip('Saves the gated data, cutoffs and outliers in the output folder, so that\n'
+                                     'later runs with the same input file and options only redo what changed\n'
+                                     '(e.g. when only the marker rule or the output files are changed)')
+        self.output_reuse.setStyleSheet(self.style['checkbox'])
         # Generate single, large XLSX checkbox
         self.single_excel = QCheckBox(self.main_page)
-        self.single_excel.setText('Also save one multi-sheet Excel spreadsheet')
-        self.single_excel.setToolTip('After generating all Excel spreadsheets, SCOUTS combines them into '
-                                     'a single\nExcel spreadsheet where each sheet corresponds to an output'
-                                     'file from SCOUTS')
+        self.single_excel.setText('Save one multi-sheet Excel spreadsheet')
+        self.single_excel.setToolTip('SCOUTS saves all output files into a single Excel spreadsheet, where each '
+                                     'sheet\ncorresponds to an output file from SCOUTS (with or without the '
+                                     'individual\nExcel spreadsheets)')
         self.single_excel.setStyleSheet(self.style['checkbox'])
-        self.single_excel.setEnabled(False)
         self.single_excel.clicked.connect(self.memory_warning)
         # Add widgets above to output frame layout
         self.output_frame.layout().addRow(self.output_button, self.output_path)
         self.output_frame.layout().addRow(self.output_csv)
         self.output_frame.layout().addRow(self.output_excel)
         self.output_frame.layout().addRow(self.single_excel)
+        self.output_frame.layout().addRow(self.output_parquet)
+        self.output_frame.layout().addRow(self.output_feather)
+        self.output_frame.layout().addRow(self.output_manifest)
+        self.output_frame.layout().addRow(self.output_store)
+        self.output_frame.layout().addRow(self.output_reuse)
 
         # ## Run & help-quit section
         # Run button (stand-alone)
@@ -271,6 +329,28 @@ class SCOUTS(QMainWindow):
         self.run_button.setStyleSheet(self.style['run button'])
         self.main_layout.addWidget(self.run_button)
         self.run_button.clicked.connect(self.run)
+        # Progress frame (only visible while the analysis is running)
+        self.progress_frame = QFrame(self.main_page)
+        self.progress_frame.setLayout(QHBoxLayout())
+        self.progress_frame.layout().setMargin(0)
+        self.main_layout.addWidget(self.progress_frame)
+        # Progress bar
+        self.progress_bar = QProgressBar(self.progress_frame)
+        # Cancel button
+        self.cancel_button = QPushButton(self.progress_frame)
+        self.set_icon(self.cancel_button, 'process-stop')
+        self.cancel_button.setText(' Cancel')
+        self.cancel_button.setStyleSheet(self.style['button'])
+        self.cancel_button.clicked.connect(self.cancel_analysis)
+        # Add widgets above to progress frame layout
+        self.progress_frame.layout().addWidget(self.progress_bar)
+        self.progress_frame.layout().addWidget(self.cancel_button)
+        # Progress label (stage, files written and estimated time left)
+        self.progress_label = QLabel(self.main_page)
+        self.progress_label.setStyleSheet(self.style['label'])
+        self.main_layout.addWidget(self.progress_label)
+        self.progress_frame.hide()
+        self.progress_label.hide()
         # Help-quit frame (invisible)
         self.helpquit_frame = QFrame(self.main_page)
         self.helpquit_frame.setLayout(QHBoxLayout())
@@ -358,6 +438,25 @@ class SCOUTS(QMainWindow):
         self.sample_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeToContents)
         self.samples_layout.addWidget(self.sample_table)
 
+        # ## Sample name matching
+        # Sample matching frame (invisible)
+        self.sample_match_frame = QFrame(self.samples_page)
+        self.sample_match_frame.setLayout(QFormLayout())
+        self.sample_match_frame.layout().setMargin(0)
+        self.samples_layout.addWidget(self.sample_match_frame)
+        # Sample matching label
+        self.sample_match_label = QLabel(self.samples_page)
+        self.sample_match_label.setText('Find sample names in the first column by:')
+        self.sample_match_label.setStyleSheet(self.style['label'])
+        # Sample matching drop-down box
+        self.sample_match = QComboBox(self.samples_page)
+        self.sample_match.addItems(['substring', 'exact', 'regex'])
+        self.sample_match.setToolTip('substring: sample name is part of the cell name (default)\n'
+                                     'exact: sample name is the whole cell name (fastest)\n'
+                                     'regex: sample name is a regular expression matched against the cell name')
+        self.sample_match.setStyleSheet(self.style['drop down'])
+        self.sample_match_frame.layout().addRow(self.sample_match_label, self.sample_match)
+
         # ## Save & clear buttons
         # Save & clear frame (invisible)
         self.saveclear_frame = QFrame(self.samples_page)
@@ -547,14 +646,6 @@ class SCOUTS(QMainWindow):
         if query:
             getattr(self, f'{sender_name}_path').setText(query)
 
-    def enable_single_excel(self) -> None:
-        """Enables checkbox for generating a single Excel output."""
-        if self.output_excel.isChecked():
-            self.single_excel.setEnabled(True)
-        else:
-            self.single_excel.setEnabled(False)
-            self.single_excel.setChecked(False)
-
     # ###
     # ### SAMPLE NAME/SAMPLE TABLE GUI LOGIC
     # ###
@@ -633,8 +724,11 @@ class SCOUTS(QMainWindow):
             trace = traceback.format_exc()
             self.propagate_error((error, trace))
         else:
-            data['widget'] = self
+            self.cancel_token = CancellationToken()
+            data['cancel_token'] = self.cancel_token
             worker = Worker(func=start_scouts, **data)
+            worker.kwargs['progress_callback'] = worker.signals.progress.emit
+            worker.signals.progress.connect(self.show_progress)
             worker.signals.started.connect(self.analysis_has_started)
             worker.signals.finished.connect(self.analysis_has_finished)
             worker.signals.success.connect(self.success_message)
@@ -647,22 +741,34 @@ class SCOUTS(QMainWindow):
         input_dict = {'input_file': str(self.input_path.text()), 'output_folder': str(self.output_path.text())}
         if not input_dict['input_file'] or not input_dict['output_folder']:
             raise NoIOPathError
+        input_dict['cache_folder'] = DEFAULT_CACHE_FOLDER if self.input_cache.isChecked() else None
+        input_dict['precision'] = 'float32' if self.input_float32.isChecked() else 'float64'
         # Set cutoff by reference or by sample rule
         input_dict['cutoff_rule'] = self.cutoff_group.checkedButton().objectName()  # 'sample', 'ref', 'sample ref'
         # Outliers for each individual marker or any marker in row
         input_dict['marker_rule'] = self.markers_group.checkedButton().objectName()  # 'single', 'any', 'single any'
         # Tukey factor used for calculating cutoff
-        input_dict['tukey_factor'] = float(self.tukey_group.checkedButton().text())  # '1.5', '3.0'
+        if self.tukey_both.isChecked():
+            input_dict['tukey_factor'] = 1.5
+            input_dict['tukey_sweep'] = [1.5, 3.0]
+        else:
+            input_dict['tukey_factor'] = float(self.tukey_group.checkedButton().text())  # '1.5', '3.0'
         # Output settings
         input_dict['export_csv'] = True if self.output_csv.isChecked() else False
         input_dict['export_excel'] = True if self.output_excel.isChecked() else False
         input_dict['single_excel'] = True if self.single_excel.isChecked() else False
+        input_dict['export_parquet'] = True if self.output_parquet.isChecked() else False
+        input_dict['export_feather'] = True if self.output_feather.isChecked() else False
+        input_dict['export_manifest'] = True if self.output_manifest.isChecked() else False
+        input_dict['export_store'] = True if self.output_store.isChecked() else False
+        input_dict['reuse_stages'] = True if self.output_reuse.isChecked() else False
         # Retrieve samples from sample table
         input_dict['sample_list'] = []
         for tuples in self.yield_samples_from_table():
             input_dict['sample_list'].append(tuples)
         if not input_dict['sample_list']:
             raise NoSampleError
+        input_dict['sample_match'] = self.sample_match.currentText()  # 'substring', 'exact', 'regex'
         # Set gate cutoff (if any)
         input_dict['gating'] = self.gating_group.checkedButton().objectName()  # 'no_gate', 'cytof', 'rnaseq'
         input_dict['gate_cutoff_value'] = None
@@ -693,14 +799,42 @@ class SCOUTS(QMainWindow):
     # ###
 
     def analysis_has_started(self) -> None:
-        """Disables run button while SCOUTS analysis is underway."""
+        """Disables run button and shows the progress bar while SCOUTS analysis is underway."""
         self.run_button.setText(' Working...')
         self.run_button.setEnabled(False)
+        self.progress_bar.setRange(0, 0)
+        self.progress_label.setText('starting')
+        self.cancel_button.setEnabled(True)
+        self.progress_frame.show()
+        self.progress_label.show()
 
     def analysis_has_finished(self) -> None:
-        """Enables run button after SCOUTS analysis has finished."""
+        """Enables run button and hides the progress bar after SCOUTS analysis has finished (or quits SCOUTS, if the
+        user asked to quit while the analysis was running)."""
+        self.cancel_token = None
+        self.progress_frame.hide()
+        self.progress_label.hide()
         self.run_button.setEnabled(True)
         self.run_button.setText(' Run!')
+        if self.quitting is True:
+            QApplication.quit()
+
+    def show_progress(self, progress: Progress) -> None:
+        """Shows the progress of the running analysis (a busy indicator, if the size of the stage is unknown)."""
+        if progress.steps:
+            self.progress_bar.setRange(0, progress.steps)
+            self.progress_bar.setValue(min(progress.step, progress.steps))
+        else:
+            self.progress_bar.setRange(0, 0)
+        if self.cancel_button.isEnabled():
+            self.progress_label.setText(format_progress(progress))
+
+    def cancel_analysis(self) -> None:
+        """Asks the running analysis to stop. Called when the user clicks the "cancel" button."""
+        if self.cancel_token is not None:
+            self.cancel_token.cancel()
+            self.cancel_button.setEnabled(False)
+            self.progress_label.setText('cancelling...')
 
     def success_message(self) -> None:
         """Info message box used when SCOUTS finished without errors."""
@@ -709,12 +843,19 @@ class SCOUTS(QMainWindow):
         if self.stacked_pages.isEnabled() is True:
             QMessageBox.information(self, title, mes)
 
+    def cancelled_message(self) -> None:
+        """Info message box used when the user cancelled the analysis."""
+        title = "Analysis cancelled"
+        mes = "Your analysis was cancelled. Files written so far are still in the output folder."
+        if self.stacked_pages.isEnabled() is True:
+            QMessageBox.information(self, title, mes)
+
     def memory_warning(self) -> None:
         """Warning message box used when user wants to generate a single excel file."""
         if self.sender().isChecked():
-            title = 'Memory warning!'
-            mes = ("Depending on your dataset, this option can consume a LOT of memory and take"
-                   " a long time to process. Please make sure that your computer can handle it!")
+            title = 'Large file warning!'
+            mes = ("Depending on your dataset, this option can take a long time to process and create"
+                   " a very large Excel file. Please make sure that you have enough disk space for it!")
             QMessageBox.information(self, title, mes)
 
     def same_sample(self) -> None:
@@ -756,6 +897,8 @@ class SCOUTS(QMainWindow):
             self.pandas_input_error_message()
         elif isinstance(error[0], SampleNamingError):
             self.sample_naming_error_message()
+        elif isinstance(error[0], AnalysisCancelledError):
+            self.cancelled_message()
         else:
             self.generic_error_message(error)
 
@@ -786,7 +929,7 @@ class SCOUTS(QMainWindow):
         title = 'Error: unexpected input file'
         message = ("Sorry, the input file could not be read. Please make sure that "
                    "the data is save in a valid format (supported formats are: "
-                   ".csv, .xlsx).")
+                   ".csv, .xlsx, and .parquet, .feather or .arrow if pyarrow is installed).")
         QMessageBox.critical(self, title, message)
 
     def sample_naming_error_message(self) -> None:
@@ -822,14 +965,15 @@ class SCOUTS(QMainWindow):
         title = 'Quit SCOUTS'
         mes = "Are you sure you want to quit?"
         reply = QMessageBox.question(self, title, mes, QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply == QMessageBox.Yes and self.cancel_token is None:  # no analysis is running
+            event.accept()
+            return
         if reply == QMessageBox.Yes:
+            # Cancels the analysis, and quits once the Worker signals that it has finished
             self.stacked_pages.setEnabled(False)
-            message = self.quit_message()
-            waiter = Waiter(waiter_func=self.threadpool.activeThreadCount)
-            waiter.signals.started.connect(message.show)
-            waiter.signals.finished.connect(message.destroy)
-            waiter.signals.finished.connect(sys.exit)
-            self.threadpool.start(waiter)
+            self.quit_message().show()
+            self.quitting = True
+            self.cancel_token.cancel()
         event.ignore()
 
     def quit_message(self) -> QDialog:
@@ -869,32 +1013,18 @@ class Worker(QRunnable):
             self.signals.finished.emit()
 
 
-class Waiter(QRunnable):
-    """Wait until this is the last Worker running."""
-    def __init__(self, waiter_func: Callable) -> None:
-        super().__init__()
-        self.waiter_func = waiter_func
-        self.signals = WorkerSignals()
-
-    @Slot()
-    def run(self) -> None:
-        """Runs the Worker thread."""
-        self.signals.started.emit()
-        while self.waiter_func() > 1:
-            time.sleep(0.1)
-        self.signals.finished.emit()
-
-
 class WorkerSignals(QObject):
     """Defines the signals available from a running worker thread. Supported signals are:
          Started: Worker has begun working. Nothing is emitted.
          Finished: Worker has done executing (either naturally or by an Exception). Nothing is emitted.
          Success: Worker has finished executing without errors. Nothing is emitted.
-         Error: an Exception was raised. Emits a tuple containing an Exception object and the traceback as a string."""
+         Error: an Exception was raised. Emits a tuple containing an Exception object and the traceback as a string.
+         Progress: Worker has made progress. Emits a Progress (see src.progress)."""
     started = Signal()
     finished = Signal()
     success = Signal()
     error = Signal(Exception)
+    progress = Signal(object)
 
 
 def main() -> None:
@@ -0,0 +1,133 @@
+import json
+import os
+import zipfile
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.writers import save_dataframe
+
+# Names of the files of a selection manifest, inside the folder given to ManifestWriter/SelectionManifest
+MANIFEST_FILE = 'manifest.json'
+SELECTIONS_FILE = 'selections.npz'
+MATRIX_NAME = 'matrix'
+
+# Bumped whenever the layout of the manifest changes
+MANIFEST_VERSION = 1
+
+
+class ManifestWriter:
+    """Writes the subsets of a SCOUTS run as a selection manifest instead of copies of their rows: the (gated)
+    input matrix is saved once, and each subset is saved as a packed bitmap (1 bit per cell) over a row order
+    shared by all subsets of the same cutoff source. Row orders other than the matrix order are saved once each.
+    Bitmaps are written to SELECTIONS_FILE as soon as they are added, and MANIFEST_FILE only once all of them are."""
+    def __init__(self, folder: str, matrix: pd.DataFrame, matrix_format: str = 'csv') -> None:
+        self.folder = folder
+        self.matrix = matrix
+        self.matrix_format = matrix_format
+        self.archive: Optional[zipfile.ZipFile] = None
+        self.row_orders: Dict[int, Optional[str]] = {}
+        self.row_arrays: List[np.ndarray] = []  # keeps row orders alive, so that their ids are not reused
+        self.selections: Dict[str, Dict[str, Any]] = {}
+
+    def __enter__(self) -> 'ManifestWriter':
+        save_dataframe(df=self.matrix, path=os.path.join(self.folder, f'{MATRIX_NAME}.{self.matrix_format}'))
+        self.archive = zipfile.ZipFile(os.path.join(self.folder, SELECTIONS_FILE), 'w',
+                                       compression=zipfile.ZIP_DEFLATED)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.archive.close()
+        self.archive = None
+        if exc_type is not None:
+            return
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'matrix': f'{MATRIX_NAME}.{self.matrix_format}',
+            'rows': len(self.matrix),
+            'dtypes': [dtype.name for dtype in self.matrix.dtypes],
+            'selections': self.selections,
+        }
+        with open(os.path.join(self.folder, MANIFEST_FILE), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+
+    def add(self, number: int, rows: np.ndarray, mask: np.ndarray, info: Dict[str, Any]) -> None:
+        """Adds the subset made of rows[mask] of the matrix, under the given file number."""
+        row_order = self.get_row_order_name(rows=rows)
+        self.write_array(name=f'{number:04d}', array=np.packbits(mask))
+        self.selections[str(number)] = {'row_order': row_order, 'count': int(np.count_nonzero(mask)), **info}
+
+    def get_row_order_name(self, rows: np.ndarray) -> Optional[str]:
+        """Returns the name under which a row order was saved, saving it first if needed. Returns None for the
+        row order of the matrix itself, which is never saved."""
+        if id(rows) not in self.row_orders:
+            name = None
+            if not np.array_equal(rows, np.arange(len(self.matrix))):
+                name = f'rows_{len(self.row_arrays)}'
+                self.write_array(name=name, array=rows.astype(np.min_scalar_type(max(len(self.matrix) - 1, 0))))
+            self.row_orders[id(rows)] = name
+            self.row_arrays.append(rows)
+        return self.row_orders[id(rows)]
+
+    def write_array(self, name: str, array: np.ndarray) -> None:
+        """Writes an array to the selections file, in the same layout as numpy.savez."""
+        with self.archive.open(f'{name}.npy', 'w', force_zip64=True) as array_file:
+            np.lib.format.write_array(array_file, array, allow_pickle=False)
+
+
+class SelectionManifest:
+    """Reads a selection manifest written by SCOUTS (in the "data" subfolder of the output folder) and rebuilds
+    any of its subsets on demand. Subsets are identified by the file numbers listed in the summary table.
+    The matrix is only loaded when a subset is first requested."""
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST_FILE)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError(f'unsupported selection manifest version: {self.manifest.get("version")}')
+        self.selections = np.load(os.path.join(folder, SELECTIONS_FILE))
+        self.matrix: Optional[pd.DataFrame] = None
+
+    def __enter__(self) -> 'SelectionManifest':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the selections file."""
+        self.selections.close()
+
+    @property
+    def numbers(self) -> List[int]:
+        """File numbers of all subsets in the manifest."""
+        return sorted(int(number) for number in self.manifest['selections'])
+
+    def get_info(self, number: int) -> Dict[str, Any]:
+        """Returns how a subset was selected (cutoff_from, reference, outliers_for and category) and its size."""
+        return dict(self.manifest['selections'][str(number)])
+
+    def get_positions(self, number: int) -> np.ndarray:
+        """Returns the row positions of a subset in the matrix, in the same order as in exported subset files."""
+        selection = self.manifest['selections'][str(number)]
+        row_order = selection['row_order']
+        rows = np.arange(self.manifest['rows']) if row_order is None else self.selections[row_order].astype(np.intp)
+        mask = np.unpackbits(self.selections[f'{number:04d}'], count=len(rows)).astype(bool)
+        return rows[mask]
+
+    def get_matrix(self) -> pd.DataFrame:
+        """Returns the (gated) input matrix shared by all subsets, with sample names as the index."""
+        if self.matrix is None:
+            path = os.path.join(self.folder, self.manifest['matrix'])
+            if path.endswith('.csv'):
+                matrix = pd.read_csv(path, index_col=0)
+            else:
+                matrix = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_feather(path)
+                matrix.set_index(matrix.columns[0], inplace=True)
+            self.matrix = matrix.astype(dict(zip(matrix.columns, self.manifest['dtypes'])))
+        return self.matrix
+
+    def get_subset(self, number: int) -> pd.DataFrame:
+        """Rebuilds a subset, with the same rows as the file that SCOUTS would have exported for it."""
+        return self.get_matrix().iloc[self.get_positions(number)]
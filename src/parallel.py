@@ -0,0 +1,157 @@
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from src.analysis import (STATS_FIELDS, SampleIndex, build_cutoff_dataframe, compare_to_cutoffs,
+                          concatenate_outlier_masks, get_cutoff_values, get_masked_stats, get_population_mask,
+                          get_sample_rows, get_stats_populations, get_values)
+from src.progress import ProgressReporter
+from src.utils import get_spawn_executor
+
+# Values of the input matrix in a worker process of a SampleWorkerPool (set once, when the worker starts)
+_shared_memory: Optional[shared_memory.SharedMemory] = None
+_shared_values: Optional[np.ndarray] = None
+
+# Results of the "sample" cutoff source computed by worker processes: the cutoff DataFrame of all samples, their
+# outlier masks (stacked in sample order) and their stats tables (None if they must be computed by run_scouts)
+SampleResults = namedtuple('SampleResults', ['cutoff_df', 'masks', 'stats'])
+
+# Results of a single sample, as returned by a worker process: its cutoff statistics (one row per marker), outlier
+# masks (without rows), stats arrays (populations x stats fields x markers) for each marker rule and number of rows
+SampleResult = namedtuple('SampleResult', ['cutoff_values', 'masks', 'stats', 'rows'])
+
+
+class SampleWorkerPool:
+    """Runs per-sample work on a pool of worker processes. The values of the input matrix are copied once into
+    shared memory when the pool starts, and every worker reads the rows of its samples from there, instead of
+    receiving its own copy of them. Used as a context manager; the shared memory is released when it exits."""
+    def __init__(self, values: np.ndarray, n_workers: int) -> None:
+        if n_workers < 1:
+            raise ValueError('n_workers must be a positive integer')
+        self.values = values
+        self.n_workers = n_workers
+        self.shared_memory: Optional[shared_memory.SharedMemory] = None
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> 'SampleWorkerPool':
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=max(self.values.nbytes, 1))
+        try:
+            shared_values = np.ndarray(self.values.shape, dtype=self.values.dtype, buffer=self.shared_memory.buf)
+            shared_values[:] = self.values
+            del shared_values  # the shared memory can't be closed while an array still points to it
+            self.executor = get_spawn_executor(max_workers=self.n_workers, initializer=attach_shared_values,
+                                               initargs=(self.shared_memory.name, self.values.shape,
+                                                         self.values.dtype.str))
+        except BaseException:
+            self.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+        finally:
+            self.release()
+
+    def release(self) -> None:
+        """Closes and removes the shared memory block."""
+        if self.shared_memory is not None:
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.shared_memory = None
+
+    def map(self, function: Callable[..., Any], tasks: List[Dict[str, Any]],
+            on_result: Optional[Callable[[Any], None]] = None) -> List[Any]:
+        """Calls function with the keyword arguments of each task on the workers, returning the results in the order
+        of the tasks. If given, on_result is called with each result as soon as it (and every result before it) is
+        available; if it raises an exception, tasks that have not started yet are cancelled."""
+        futures: List[Future] = [self.executor.submit(function, **task) for task in tasks]
+        results = []
+        try:
+            for future in futures:
+                results.append(future.result())
+                if on_result is not None:
+                    on_result(results[-1])
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        return results
+
+
+def attach_shared_values(name: str, shape: tuple, dtype: str) -> None:
+    """Initializer of the worker processes of a SampleWorkerPool: maps the shared input matrix into the worker."""
+    global _shared_memory, _shared_values
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    _shared_values = np.ndarray(shape, dtype=np.dtype(dtype), buffer=_shared_memory.buf)
+
+
+def get_sample_results(rows: Union[slice, np.ndarray], tukey: float, bottom_outliers: bool, non_outliers: bool,
+                       populations: List[str], marker_rules: List[str]) -> SampleResult:
+    """Runs on a worker process: calculates the cutoffs of a sample (whose rows of the shared input matrix are
+    given), compares its values against them and calculates its stats for each marker rule in marker_rules, the
+    same way as get_cutoff, get_outlier_masks and get_stats_dfs do for every sample in turn."""
+    values = _shared_values[rows]
+    cutoff_values = get_cutoff_values(values=values, tukey=tukey)
+    masks = compare_to_cutoffs(values=values, cutoffs=cutoff_values, bottom_outliers=bottom_outliers,
+                               non_outliers=non_outliers)
+    stats = {}
+    if marker_rules:
+        whole_population = get_masked_stats(values=values, mask=np.True_)
+        member = np.arange(len(values))
+        for rule in marker_rules:
+            array = np.empty((len(populations), len(STATS_FIELDS), values.shape[1]))
+            array[0] = whole_population
+            for j, population in enumerate(populations[1:], 1):
+                mask = get_population_mask(masks=masks, population=population, member=member,
+                                           any_marker=rule == 'any')
+                array[j] = get_masked_stats(values=values, mask=mask)
+            stats[rule] = array
+    return SampleResult(cutoff_values=cutoff_values, masks=masks, stats=stats, rows=len(values))
+
+
+def get_parallel_sample_results(df: pd.DataFrame, samples: List[str], markers: List[str], tukey: float,
+                                marker_rule: str, bottom_outliers: bool, non_outliers: bool, n_workers: int,
+                                sample_index: Optional[SampleIndex] = None,
+                                progress: Optional[ProgressReporter] = None) -> SampleResults:
+    """Calculates the cutoffs, outlier masks and stats tables of the "sample" cutoff source with one task per
+    sample, run by n_workers processes sharing the values of df (see SampleWorkerPool). Results are gathered in
+    sample order, so they are the same as those of get_cutoff, get_outlier_masks and get_stats_dfs. If some rows
+    belong to more than one sample, the stats of a sample also depend on the masks of other samples, so they are
+    left to run_scouts (stats is None). The progress reporter (if any) advances once per sample."""
+    all_rows = np.arange(len(df))
+    sample_rows = [get_sample_rows(df=df, sample=sample, sample_index=sample_index) for sample in samples]
+    positions = [all_rows[rows] for rows in sample_rows]
+    stacked_rows = np.concatenate(positions)
+    shared_rows = len(np.unique(stacked_rows)) < len(stacked_rows)
+    populations = get_stats_populations(bottom=bottom_outliers, non=non_outliers)
+    marker_rules = [] if shared_rows else [rule for rule in ['any', 'single'] if rule in marker_rule]
+    tasks = [{'rows': rows, 'tukey': tukey, 'bottom_outliers': bottom_outliers, 'non_outliers': non_outliers,
+              'populations': populations, 'marker_rules': marker_rules} for rows in sample_rows]
+
+    def advance(result: SampleResult) -> None:
+        if progress is not None:
+            progress.advance(rows=result.rows)
+
+    with SampleWorkerPool(values=get_values(df), n_workers=min(n_workers, max(len(samples), 1))) as pool:
+        results = pool.map(get_sample_results, tasks=tasks, on_result=advance)
+    cutoff_array = np.stack([result.cutoff_values for result in results]).astype(float)  # float64, as in get_cutoff
+    cutoff_df = build_cutoff_dataframe(cutoff_array=cutoff_array, samples=samples, markers=markers)
+    sample_masks = [result.masks for result in results]
+    masks = concatenate_outlier_masks(rows=positions, top=[mask.top for mask in sample_masks],
+                                      bottom=[mask.bottom for mask in sample_masks],
+                                      non=[mask.non for mask in sample_masks],
+                                      non_any=[mask.non_any for mask in sample_masks])
+    if shared_rows:
+        return SampleResults(cutoff_df=cutoff_df, masks=masks, stats=None)
+    index = pd.MultiIndex.from_product([samples, populations, STATS_FIELDS])
+    stats = {f'OutS {rule} marker': pd.DataFrame(np.stack([result.stats[rule] for result in results])
+                                                 .reshape(-1, len(markers)), index=index, columns=markers)
+             for rule in marker_rules}
+    return SampleResults(cutoff_df=cutoff_df, masks=masks, stats=stats)
@@ -0,0 +1,133 @@
+import cProfile
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from src.utils import AnalysisCancelledError, warn_on_error
+
+try:
+    import resource
+except ImportError:  # not available on Windows, where peak memory is not recorded
+    resource = None
+
+# Names of the files written by RunProfiler, inside the output folder of a run
+PROFILE_FILE = 'run_profile.json'
+PSTATS_FILE = 'run_profile.pstats'
+
+# Bumped whenever the layout of PROFILE_FILE changes
+PROFILE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class RunProfiler:
+    """Records the wall time, CPU time (of SCOUTS and of its writer processes), peak memory, rows processed and
+    files/bytes written of each stage of a SCOUTS run, as reported by its ProgressReporter, and saves them as
+    PROFILE_FILE in the output folder when the run ends (also when it fails or is cancelled). Peak memory is the
+    peak resident set size of the process so far, and with trace_memory, also the peak memory allocated during each
+    stage as traced by tracemalloc (which makes runs several times slower). With profile_calls, the whole run is
+    also profiled with cProfile and the statistics are saved as PSTATS_FILE (readable with pstats or snakeviz)."""
+    def __init__(self, folder: str, trace_memory: bool = False, profile_calls: bool = False) -> None:
+        self.folder = folder
+        self.trace_memory = trace_memory
+        self.profile_calls = profile_calls
+        self.started_tracing = False
+        self.call_profiler = None
+        self.stages: List[Dict[str, Any]] = []
+        self.stage = None
+        self.start_time = None
+        self.start_clock = None
+
+    def start(self) -> None:
+        """Starts profiling the run."""
+        self.start_time = datetime.datetime.now().isoformat(timespec='seconds')
+        self.start_clock = get_clock()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        if self.profile_calls:
+            self.call_profiler = cProfile.Profile()
+            self.call_profiler.enable()
+
+    def start_stage(self, stage: str, rows_processed: int, files_written: int, bytes_written: int) -> None:
+        """Ends the current stage (with the rows it processed and the files written so far) and starts a new one."""
+        self.end_stage(rows_processed=rows_processed, files_written=files_written, bytes_written=bytes_written)
+        self.stage = {'stage': stage, 'clock': get_clock(), 'files_written': files_written,
+                      'bytes_written': bytes_written}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+    def end_stage(self, rows_processed: int, files_written: int, bytes_written: int) -> None:
+        """Ends the current stage (if any), recording how much time and memory it used."""
+        if self.stage is None:
+            return
+        clock = get_clock()
+        self.stages.append({
+            'stage': self.stage['stage'],
+            **get_clock_difference(clock, self.stage['clock']),
+            'peak_rss_bytes': get_peak_rss(),
+            'peak_traced_bytes': tracemalloc.get_traced_memory()[1] if self.trace_memory else None,
+            'rows_processed': rows_processed,
+            'files_written': files_written - self.stage['files_written'],
+            'bytes_written': bytes_written - self.stage['bytes_written'],
+        })
+        self.stage = None
+
+    def stop(self, rows_processed: int, files_written: int, bytes_written: int,
+             error: Optional[BaseException] = None) -> None:
+        """Ends the current stage, stops profiling and saves the profile (the error that ended the run, if any, is
+        recorded as its status)."""
+        self.end_stage(rows_processed=rows_processed, files_written=files_written, bytes_written=bytes_written)
+        if self.call_profiler is not None:
+            self.call_profiler.disable()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        if error is None:
+            status = 'finished'
+        elif isinstance(error, AnalysisCancelledError):
+            status = 'cancelled'
+        else:
+            status = f'failed ({type(error).__name__})'
+        profile = {
+            'version': PROFILE_VERSION,
+            'status': status,
+            'started': self.start_time,
+            **get_clock_difference(get_clock(), self.start_clock),
+            'peak_rss_bytes': get_peak_rss(),
+            'files_written': files_written,
+            'bytes_written': bytes_written,
+            'pstats_file': PSTATS_FILE if self.call_profiler is not None else None,
+            'stages': self.stages,
+        }
+        with warn_on_error(logger=logger, message='could not save run profile'):
+            with open(os.path.join(self.folder, PROFILE_FILE), 'w') as profile_file:
+                json.dump(profile, profile_file, indent=2)
+            if self.call_profiler is not None:
+                self.call_profiler.dump_stats(os.path.join(self.folder, PSTATS_FILE))
+
+
+def get_clock() -> Dict[str, float]:
+    """Returns the current wall time, CPU time of this process and CPU time of its finished child processes."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN) if resource is not None else None
+    return {'wall': time.perf_counter(), 'cpu': time.process_time(),
+            'child_cpu': children.ru_utime + children.ru_stime if children is not None else 0.0}
+
+
+def get_clock_difference(end: Dict[str, float], start: Dict[str, float]) -> Dict[str, float]:
+    """Returns the wall and CPU seconds elapsed between two clocks (see get_clock)."""
+    return {'wall_seconds': round(end['wall'] - start['wall'], 6), 'cpu_seconds': round(end['cpu'] - start['cpu'], 6),
+            'writer_cpu_seconds': round(end['child_cpu'] - start['child_cpu'], 6)}
+
+
+def get_peak_rss() -> Optional[int]:
+    """Returns the peak resident set size of this process so far in bytes, or None if it cannot be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, kilobytes on Linux
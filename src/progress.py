@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import namedtuple
+from typing import Callable, List, Optional
+
+from src.catalog import get_file_size
+from src.profiling import RunProfiler
+from src.utils import AnalysisCancelledError
+
+# Snapshot of a running analysis, passed to progress callbacks. "step" and "steps" count the units of work of the
+# current stage (rows, samples or subsets; steps is None if unknown), "rows_processed" counts the rows handled by
+# the current stage, files and bytes are counted since the start of the run, and "eta" is the estimated number of
+# seconds left in the current stage (None if unknown).
+Progress = namedtuple("Progress", ['stage', 'step', 'steps', 'rows_processed', 'files_written', 'bytes_written',
+                                   'elapsed', 'eta'])
+
+# Minimum number of seconds between two progress reports within a stage
+PROGRESS_INTERVAL = 0.1
+
+
+class CancellationToken:
+    """Asks a running analysis to stop. cancel() can be called from any thread (e.g. the GUI thread or a signal
+    handler); the analysis checks the token between units of work (a chunk of rows, a sample or a subset) and
+    raises AnalysisCancelledError at the next check."""
+    def __init__(self) -> None:
+        self.event = threading.Event()
+
+    def cancel(self) -> None:
+        """Asks the analysis to stop."""
+        self.event.set()
+
+    def is_cancelled(self) -> bool:
+        """Returns whether cancel() was called."""
+        return self.event.is_set()
+
+
+class ProgressReporter:
+    """Keeps track of the stage of a running analysis and of the files it has written, passing a Progress to the
+    callback (if any) whenever a stage starts, finishes or advances (at most once every PROGRESS_INTERVAL seconds
+    within a stage). Every update also checks the cancellation token (if any), raising AnalysisCancelledError
+    once it was cancelled. Files may be added from other threads (e.g. when writer processes finish).
+    If a RunProfiler is given, the reporter is used as a context manager around the run, and the profiler records
+    every stage and saves the profile when the run ends."""
+    def __init__(self, callback: Optional[Callable[[Progress], None]] = None,
+                 cancel_token: Optional[CancellationToken] = None, interval: float = PROGRESS_INTERVAL,
+                 profiler: Optional[RunProfiler] = None) -> None:
+        self.callback = callback
+        self.cancel_token = cancel_token
+        self.interval = interval
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.stage_start_time = self.start_time
+        self.last_report_time = None
+        self.stage = None
+        self.step = 0
+        self.steps = None
+        self.rows_processed = 0
+        self.files_written = 0
+        self.bytes_written = 0
+
+    def __enter__(self) -> 'ProgressReporter':
+        if self.profiler is not None:
+            self.profiler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self.profiler is not None:
+            self.profiler.stop(rows_processed=self.rows_processed, files_written=self.files_written,
+                               bytes_written=self.bytes_written, error=exc_value)
+
+    def check(self) -> None:
+        """Raises AnalysisCancelledError if the analysis was cancelled."""
+        if self.cancel_token is not None and self.cancel_token.is_cancelled():
+            raise AnalysisCancelledError
+
+    def start_stage(self, stage: str, steps: Optional[int] = None) -> None:
+        """Starts a new stage with the given number of units of work (None if unknown)."""
+        self.check()
+        if self.profiler is not None:
+            self.profiler.start_stage(stage=stage, rows_processed=self.rows_processed,
+                                      files_written=self.files_written, bytes_written=self.bytes_written)
+        self.stage, self.step, self.steps, self.rows_processed = stage, 0, steps, 0
+        self.stage_start_time = time.monotonic()
+        self.report(force=True)
+
+    def advance(self, steps: int = 1, rows: int = 0) -> None:
+        """Records that the current stage has done more units of work, handling the given number of rows."""
+        self.step += steps
+        self.rows_processed += rows
+        self.report(force=self.steps is not None and self.step >= self.steps)
+        self.check()
+
+    def add_files(self, paths: List[str]) -> None:
+        """Records that the given files were written."""
+        size = sum(get_file_size(path) or 0 for path in paths)
+        with self.lock:
+            self.files_written += len(paths)
+            self.bytes_written += size
+
+    def finish(self) -> None:
+        """Reports the end of the analysis."""
+        if self.profiler is not None:
+            self.profiler.end_stage(rows_processed=self.rows_processed, files_written=self.files_written,
+                                    bytes_written=self.bytes_written)
+        self.stage, self.step, self.steps, self.rows_processed = 'finished', 0, None, 0
+        self.report(force=True)
+
+    def get_progress(self) -> Progress:
+        """Returns the current progress."""
+        now = time.monotonic()
+        eta = None
+        if self.steps and self.step > 0:
+            eta = (now - self.stage_start_time) * max(self.steps - self.step, 0) / self.step
+        with self.lock:
+            files_written, bytes_written = self.files_written, self.bytes_written
+        return Progress(self.stage, self.step, self.steps, self.rows_processed, files_written, bytes_written,
+                        now - self.start_time, eta)
+
+    def report(self, force: bool = False) -> None:
+        """Passes the current progress to the callback, unless the last report was less than interval seconds ago
+        (or force is True)."""
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        if not force and self.last_report_time is not None and now - self.last_report_time < self.interval:
+            return
+        self.last_report_time = now
+        self.callback(self.get_progress())
+
+
+def format_progress(progress: Progress) -> str:
+    """Describes a Progress in one line, e.g. "subsets: 120/400, 360 files (12.5 MB) written, about 30 s left"."""
+    text = progress.stage
+    if progress.steps is not None:
+        text += f': {progress.step}/{progress.steps}'
+    if progress.files_written:
+        text += f', {progress.files_written} files ({progress.bytes_written / 1e6:.1f} MB) written'
+    if progress.eta is not None:
+        text += f', about {progress.eta:.0f} s left'
+    return text
@@ -0,0 +1,141 @@
+import math
+from typing import List, Optional
+
+import numpy as np
+
+# Largest number of values per sketch assumed when choosing the capacity of a sketch from its error bound
+MAX_SKETCH_COUNT = 2 ** 40
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch of the columns of a 2D array (rows are cells, columns are markers), with a
+    deterministic bound on the rank error of its quantiles. Values are kept in levels of sorted buffers; the
+    values at level h stand for 2 ** h input values each. Whenever a level holds capacity values, every other
+    value of the (sorted) level is promoted to the next level, which shifts the rank of any value by at most
+    2 ** h. These shifts are added up in rank_error, so the reported error is always a guaranteed bound.
+    All columns are compacted together, and missing values are sorted as +inf (and left out of the quantiles)."""
+    def __init__(self, capacity: int) -> None:
+        if capacity < 2:
+            raise ValueError('capacity of a quantile sketch must be at least 2')
+        self.capacity = capacity
+        self.levels: List[np.ndarray] = []
+        self.offsets: List[int] = []
+        self.count = 0
+        self.nan_count: Optional[np.ndarray] = None
+        self.rank_error = 0
+
+    @classmethod
+    def from_error(cls, error: float) -> 'QuantileSketch':
+        """Returns an empty sketch whose rank error stays below error * number of values (for fewer than
+        MAX_SKETCH_COUNT values)."""
+        return cls(capacity=get_sketch_capacity(error=error))
+
+    @property
+    def error(self) -> float:
+        """Guaranteed rank error of the sketch quantiles, as a fraction of the number of values."""
+        return self.rank_error / self.count if self.count else 0.0
+
+    def update(self, values: np.ndarray) -> None:
+        """Adds the rows of a 2D array of values to the sketch, capacity rows at a time."""
+        values = np.asarray(values, dtype=float)
+        for start in range(0, len(values), self.capacity):
+            block = values[start:start + self.capacity]
+            missing = np.isnan(block)
+            block_nan_count = np.count_nonzero(missing, axis=0)
+            self.nan_count = block_nan_count if self.nan_count is None else self.nan_count + block_nan_count
+            self.count += len(block)
+            self.add_to_level(0, np.where(missing, np.inf, block))
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        """Merges another sketch (e.g. from another chunk or worker) into this one. Both must have the same
+        capacity; the rank error of the result is the sum of both rank errors plus any new compactions."""
+        if other.capacity != self.capacity:
+            raise ValueError('only sketches with the same capacity can be merged')
+        if other.nan_count is None:
+            return
+        self.nan_count = other.nan_count.copy() if self.nan_count is None else self.nan_count + other.nan_count
+        self.count += other.count
+        self.rank_error += other.rank_error
+        for level_number, level in enumerate(other.levels):
+            self.add_to_level(level_number, level)
+
+    def add_to_level(self, level_number: int, values: np.ndarray) -> None:
+        """Adds values to a level, promoting half of the level to the next one if it reaches full capacity."""
+        while len(self.levels) <= level_number:
+            self.levels.append(np.empty((0, values.shape[1])))
+            self.offsets.append(0)
+        level = np.concatenate([self.levels[level_number], values])
+        if len(level) < self.capacity:
+            self.levels[level_number] = level
+            return
+        level = np.sort(level, axis=0)
+        compacted = len(level) - len(level) % 2
+        self.levels[level_number] = level[compacted:]
+        promoted = level[self.offsets[level_number]:compacted:2]
+        self.offsets[level_number] ^= 1  # alternates between even and odd values, so that errors tend to cancel
+        self.rank_error += 2 ** level_number
+        self.add_to_level(level_number + 1, promoted)
+
+    def quantiles(self, quantiles: List[float], rank_shift: float = 0.0) -> np.ndarray:
+        """Estimates quantiles of each column, with the same linear interpolation as get_quantiles (and the
+        same result, if no values were compacted yet). rank_shift moves every rank by that many values,
+        which is used for bracketing the quantiles by their error. Returns an array with one row per quantile
+        (all NaN for columns without any values)."""
+        if self.nan_count is None:
+            raise ValueError('quantile sketch is empty')
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** level_number)
+                                  for level_number, level in enumerate(self.levels)])
+        order = np.argsort(items, axis=0, kind='stable')
+        sorted_items = np.take_along_axis(items, order, axis=0)
+        cumulative_weights = np.cumsum(weights[order], axis=0)
+        counts = self.count - self.nan_count
+        finite_items = np.count_nonzero(np.isfinite(sorted_items), axis=0)
+        result = np.full((len(quantiles), items.shape[1]), np.nan)
+        for column in np.flatnonzero((counts > 0) & (finite_items > 0)):
+            last_rank = counts[column] - 1
+            for i, quantile in enumerate(quantiles):
+                position = min(max(last_rank * quantile + rank_shift, 0), last_rank)
+                lower_position = math.floor(position)
+                upper_position = math.ceil(position)
+                ranks = np.searchsorted(cumulative_weights[:, column], [lower_position, upper_position], side='right')
+                ranks = np.minimum(ranks, finite_items[column] - 1)  # missing values are never used as quantiles
+                lower_value, upper_value = sorted_items[ranks, column]
+                weight = position - lower_position
+                difference = upper_value - lower_value
+                if weight >= 0.5:
+                    result[i, column] = upper_value - difference * (1 - weight)
+                else:
+                    result[i, column] = lower_value + difference * weight
+        return result
+
+
+def get_sketch_capacity(error: float) -> int:
+    """Returns the smallest capacity whose worst-case rank error, (log2(n / capacity) + 1) / capacity,
+    is below error for up to MAX_SKETCH_COUNT values."""
+    if not 0 < error < 1:
+        raise ValueError('error of a quantile sketch must be between 0 and 1')
+    capacity = max(2, math.ceil(1 / error))
+    while (math.log2(MAX_SKETCH_COUNT / capacity) + 1) / capacity > error:
+        capacity = math.ceil(capacity * 1.05)
+    return capacity
+
+
+def get_sketch_cutoff_values(sketch: QuantileSketch, tukey: float) -> np.ndarray:
+    """Calculates the cutoff statistics (Q1, Q3, IQR, CUTOFF_LOW, CUTOFF_HIGH) of each column from a quantile
+    sketch, in the same layout as get_cutoff_values."""
+    from src.analysis import get_tukey_cutoff_values  # src.analysis imports this module
+    first_quartile, third_quartile = sketch.quantiles([0.25, 0.75])
+    return get_tukey_cutoff_values(first_quartile=first_quartile, third_quartile=third_quartile, tukey=tukey)
+
+
+def get_sketch_cutoff_error(sketch: QuantileSketch, tukey: float) -> np.ndarray:
+    """Calculates how far the lower and upper cutoffs of each column can be from their exact values, given the
+    rank error of the sketch. Returns an array with one row of (lower cutoff error, upper cutoff error) per column."""
+    quartiles = sketch.quantiles([0.25, 0.75])
+    below = sketch.quantiles([0.25, 0.75], rank_shift=-sketch.rank_error)
+    above = sketch.quantiles([0.25, 0.75], rank_shift=sketch.rank_error)
+    first_quartile_error, third_quartile_error = np.maximum(quartiles - below, above - quartiles)
+    lower_cutoff_error = first_quartile_error * (1 + tukey) + third_quartile_error * tukey
+    upper_cutoff_error = third_quartile_error * (1 + tukey) + first_quartile_error * tukey
+    return np.stack([lower_cutoff_error, upper_cutoff_error], axis=-1)
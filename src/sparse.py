@@ -0,0 +1,358 @@
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src.analysis import (LOWER_CUTOFF, STATS_FIELDS, UPPER_CUTOFF, DenseBackend, OutlierMasks, SampleIndex, Stats,
+                          build_cutoff_dataframe, get_all_sample_names, get_cutoff_array, get_marker_positions,
+                          get_reference_sample_name, get_stats_populations, get_tukey_cutoff_values,
+                          interpolate_quantile, run_scouts, validate_sample_names)
+from src.profiling import RunProfiler
+from src.progress import CancellationToken, Progress, ProgressReporter
+from src.utils import PandasInputError
+
+# Number of values converted at a time between the dense input/output files and sparse matrices
+SPARSE_BLOCK_VALUES = 10_000_000
+
+logger = logging.getLogger(__name__)
+
+
+class SparseFrame:
+    """Single-cell data held as a sparse CSR matrix (rows are cells, columns are markers), along with the labels of
+    its rows (sample names) and columns. Only values above the scRNA-seq gate cutoff are stored: any other value
+    (zeros, values at or below the cutoff and missing values) counts as missing, exactly like the NaNs left by
+    apply_rnaseq_gating, and cells without any stored value are dropped, like rnaseq gating does. Integer columns
+    where no value was gated are saved as integers, as they would be from the gated DataFrame. Used in place of the
+    input DataFrame by the SCOUTS generators (see SparseBackend)."""
+    def __init__(self, matrix: sparse.csr_matrix, index: pd.Index, columns: pd.Index,
+                 integer_columns: Optional[np.ndarray] = None) -> None:
+        self.matrix = matrix
+        self.index = index
+        self.columns = columns
+        self.integer_columns = integer_columns if integer_columns is not None else np.zeros(len(columns), dtype=bool)
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, cutoff: float, dtype: str = 'float64') -> 'SparseFrame':
+        """Gates a DataFrame (with sample names as its index) into a SparseFrame, keeping values above cutoff.
+        With dtype 'float32', values are held as float32 and no column is kept as integers (as with precision
+        'float32' in start_scouts)."""
+        values = df.to_numpy(dtype=float, copy=True)
+        with np.errstate(invalid='ignore'):
+            gated = ~(values > cutoff)  # gated at float64, as in start_scouts, before the values are converted
+        values = values.astype(dtype, copy=False)
+        integer_columns = np.array([pd.api.types.is_integer_dtype(column_dtype) for column_dtype in df.dtypes],
+                                   dtype=bool) & ~gated.any(axis=0) & (np.dtype(dtype) == np.float64)
+        values[gated] = 0
+        matrix = sparse.csr_matrix(values)
+        keep = np.diff(matrix.indptr) > 0
+        return cls(matrix=matrix[keep], index=df.index[keep], columns=df.columns, integer_columns=integer_columns)
+
+    @classmethod
+    def from_csv(cls, input_file: str, cutoff: float, dtype: str = 'float64',
+                 progress: Optional[ProgressReporter] = None) -> Tuple['SparseFrame', pd.Index]:
+        """Loads and gates a .csv input file (first column as the index) a block of rows at a time, so that its
+        dense values are never all in memory. The progress reporter (if any) advances once per block.
+        Returns the SparseFrame along with the index of the input file before gating."""
+        columns = pd.read_csv(input_file, header=0, index_col=0, nrows=0).columns
+        block_rows = max(1, SPARSE_BLOCK_VALUES // max(len(columns), 1))
+        frames, indexes = [], []
+        for chunk in pd.read_csv(input_file, header=0, index_col=0, chunksize=block_rows):
+            frames.append(cls.from_dataframe(df=chunk, cutoff=cutoff, dtype=dtype))
+            indexes.append(chunk.index)
+            if progress is not None:
+                progress.advance(rows=len(chunk))
+        if not frames:
+            empty_index = pd.Index([], name=columns.name)
+            return cls(matrix=sparse.csr_matrix((0, len(columns)), dtype=dtype), index=empty_index,
+                       columns=columns), empty_index
+        matrix = sparse.vstack([frame.matrix for frame in frames], format='csr')
+        index = frames[0].index.append([frame.index for frame in frames[1:]])
+        integer_columns = np.logical_and.reduce([frame.integer_columns for frame in frames])
+        return cls(matrix=matrix, index=index, columns=columns,
+                   integer_columns=integer_columns), indexes[0].append(indexes[1:])
+
+    def take(self, rows: np.ndarray) -> 'SparseFrame':
+        """Returns the given rows (as an array of positions) as a new SparseFrame."""
+        return SparseFrame(matrix=self.matrix[rows], index=self.index[rows], columns=self.columns,
+                           integer_columns=self.integer_columns)
+
+    def to_csv(self, path: str, index: bool = True) -> None:
+        """Saves the frame as a .csv file, just like DataFrame.to_csv saves the gated DataFrame (values that are
+        not stored are left empty). Only a block of rows at a time is converted to a dense DataFrame."""
+        block_rows = max(1, SPARSE_BLOCK_VALUES // max(len(self.columns), 1))
+        with open(path, 'w', newline='') as output_file:
+            for start in range(0, max(len(self), 1), block_rows):
+                block = self.matrix[start:start + block_rows].tocoo()
+                values = np.full(block.shape, np.nan, dtype=block.dtype)
+                values[block.row, block.col] = block.data
+                df = pd.DataFrame(values, index=self.index[start:start + block_rows], columns=self.columns)
+                if self.integer_columns.any():  # integer columns have no missing values, since none was gated
+                    df = df.astype({column: np.int64 for column in self.columns[self.integer_columns]})
+                df.to_csv(output_file, header=start == 0, index=index)
+
+
+class SparseMask:
+    """Boolean mask over the positions of OutlierMasks.rows and the markers, storing only its True entries. Supports
+    the two ways that the SCOUTS generators read outlier masks, mask[:, column] and mask.any(axis=1), which both
+    return a dense boolean array over the positions."""
+    def __init__(self, matrix: sparse.csc_matrix) -> None:
+        self.matrix = matrix
+
+    @classmethod
+    def from_entries(cls, rows: np.ndarray, columns: np.ndarray, shape: Tuple[int, int]) -> 'SparseMask':
+        """Builds a mask that is True at each (rows[i], columns[i]) position."""
+        return cls(sparse.csc_matrix((np.ones(len(rows), dtype=bool), (rows, columns)), shape=shape))
+
+    def __getitem__(self, key: Tuple[slice, int]) -> np.ndarray:
+        positions, column = key
+        if positions != slice(None):
+            raise IndexError('only whole columns can be selected from a SparseMask')
+        mask = np.zeros(self.matrix.shape[0], dtype=bool)
+        mask[self.matrix.indices[self.matrix.indptr[column]:self.matrix.indptr[column + 1]]] = True
+        return mask
+
+    def any(self, axis: int) -> np.ndarray:
+        """Returns whether each position is True for any marker (only axis=1 is supported)."""
+        if axis != 1:
+            raise ValueError('SparseMask.any only supports axis=1')
+        mask = np.zeros(self.matrix.shape[0], dtype=bool)
+        mask[self.matrix.indices] = True
+        return mask
+
+
+class SparseBackend(DenseBackend):
+    """Outlier masks, stats tables and subsets of run_scouts for a SparseFrame: masks are SparseMasks, stats only
+    describe the stored values, and subsets are SparseFrames, written to .csv files a block of rows at a time
+    without converting the whole data to a dense DataFrame."""
+    def get_masks(self, df: SparseFrame, cutoff_df: pd.DataFrame, cutoff_rule: str, samples: List[str],
+                  reference: Optional[str], bottom_outliers: bool, non_outliers: bool,
+                  sample_index: Optional[SampleIndex] = None) -> Dict[str, OutlierMasks]:
+        """Same as DenseBackend.get_masks (see get_sparse_masks_by_cutoff_source)."""
+        return get_sparse_masks_by_cutoff_source(frame=df, cutoff_df=cutoff_df, cutoff_rule=cutoff_rule,
+                                                 samples=samples, reference=reference,
+                                                 bottom_outliers=bottom_outliers, non_outliers=non_outliers,
+                                                 sample_index=sample_index)
+
+    def get_stats_dfs(self, df: SparseFrame, masks: Dict[str, OutlierMasks], markers: List[str], cutoff_rule: str,
+                      marker_rule: str, samples: List[str], bottom: bool, non: bool,
+                      sample_masks: Dict[str, np.ndarray],
+                      progress: Optional[ProgressReporter] = None) -> Dict[str, pd.DataFrame]:
+        """Same as DenseBackend.get_stats_dfs (see get_sparse_stats_dfs)."""
+        return get_sparse_stats_dfs(frame=df, masks=masks, markers=markers, cutoff_rule=cutoff_rule,
+                                    marker_rule=marker_rule, samples=samples, bottom=bottom, non=non,
+                                    sample_masks=sample_masks, progress=progress)
+
+    def take(self, df: SparseFrame, positions: np.ndarray) -> SparseFrame:
+        """Returns the rows of a subset as a SparseFrame (which the WriterPool saves with SparseFrame.to_csv)."""
+        return df.take(positions)
+
+    def save_gated(self, df: SparseFrame, output_folder: str, table_format: str) -> str:
+        """Saves the gated population as gated_population.csv, whatever the table format."""
+        gated_path = os.path.join(output_folder, 'gated_population.csv')
+        df.to_csv(gated_path)
+        return gated_path
+
+
+def start_scouts_sparse(input_file: str, output_folder: str, cutoff_rule: str, marker_rule: str,
+                        tukey_factor: float, export_csv: bool, sample_list: List[Tuple[str, str]],
+                        gate_cutoff_value: float, export_gated: bool, non_outliers: bool, bottom_outliers: bool,
+                        sample_match: str = 'substring', precision: str = 'float64', table_format: str = 'xlsx',
+                        cancel_token: Optional[CancellationToken] = None,
+                        progress_callback: Optional[Callable[[Progress], None]] = None,
+                        profile_memory: bool = False, profile_calls: bool = False) -> None:
+    """Runs SCOUTS with scRNA-seq gating on a .csv input file, holding the gated data as a sparse matrix (see
+    SparseFrame) instead of a dense DataFrame, so that data sets where most values are zero fit in memory. Cutoffs,
+    outliers and stats only use the stored (non-gated) values, and give the same results as start_scouts with
+    gating='rnaseq'. Output files are selected and written by run_scouts, through a SparseBackend (only .csv output
+    files, and the gated population is saved as gated_population.csv). Cancellation, progress reports and profiling
+    work as in start_scouts."""
+    if not input_file.endswith('.csv'):
+        raise PandasInputError
+    profiler = RunProfiler(folder=output_folder, trace_memory=profile_memory, profile_calls=profile_calls)
+    with ProgressReporter(callback=progress_callback, cancel_token=cancel_token, profiler=profiler) as progress:
+        samples = get_all_sample_names(sample_list=sample_list)
+        progress.start_stage('loading')
+        frame, input_index = SparseFrame.from_csv(input_file=input_file, cutoff=gate_cutoff_value, dtype=precision,
+                                                  progress=progress)
+        input_sample_index = SampleIndex.from_index(index=input_index, samples=samples, match_mode=sample_match)
+        validate_sample_names(samples=samples, df=frame, sample_index=input_sample_index)
+        logger.info('rnaseq gating dropped %d of %d rows (%d values stored)', len(input_index) - len(frame),
+                    len(input_index), frame.matrix.nnz)
+        sample_index = SampleIndex.from_index(index=frame.index, samples=samples, match_mode=sample_match)
+        markers = list(frame.columns)
+        reference = None
+        if 'ref' in cutoff_rule:
+            reference = get_reference_sample_name(sample_list=sample_list)
+        cutoff_samples = [reference] if cutoff_rule == 'ref' else samples
+        progress.start_stage('cutoffs', steps=len(cutoff_samples))
+        cutoff_df = get_sparse_cutoff_dataframe(frame=frame, samples=cutoff_samples, tukey=tukey_factor,
+                                                sample_index=sample_index, progress=progress)
+        run_scouts(df=frame, samples=samples, markers=markers, reference=reference, cutoff_df=cutoff_df,
+                   cutoff_rule=cutoff_rule, marker_rule=marker_rule, export_csv=export_csv, export_excel=False,
+                   single_excel=False, export_gated=export_gated, non_outliers=non_outliers,
+                   bottom_outliers=bottom_outliers, output_folder=output_folder, sample_index=sample_index,
+                   table_format=table_format, progress=progress, backend=SparseBackend())
+        progress.finish()
+
+
+def get_sparse_cutoff_dataframe(frame: SparseFrame, samples: List[str], tukey: float, sample_index: SampleIndex,
+                                progress: Optional[ProgressReporter] = None) -> pd.DataFrame:
+    """Same as get_cutoff, calculating the cutoffs of each sample from the stored values of its rows. The progress
+    reporter (if any) advances once per sample."""
+    cutoff_array = np.empty((len(samples), len(frame.columns), len(Stats._fields)))
+    for i, sample in enumerate(samples):
+        sample_matrix = frame.matrix[sample_index.get_rows(sample)]
+        first_quartile, third_quartile = get_column_quantiles(matrix=sample_matrix, quantiles=[0.25, 0.75])
+        cutoff_array[i] = get_tukey_cutoff_values(first_quartile=first_quartile, third_quartile=third_quartile,
+                                                  tukey=tukey)
+        if progress is not None:
+            progress.advance(rows=sample_matrix.shape[0])
+    return build_cutoff_dataframe(cutoff_array=cutoff_array, samples=samples, markers=list(frame.columns))
+
+
+def get_column_quantiles(matrix: sparse.spmatrix, quantiles: List[float]) -> np.ndarray:
+    """Same as get_quantiles, for the stored values of each column of a sparse matrix (values that are not stored
+    are missing). Returns an array with one row per quantile (all NaN for columns without any stored values)."""
+    matrix = sparse.csc_matrix(matrix)
+    counts = np.diff(matrix.indptr)
+    column_ids = np.repeat(np.arange(matrix.shape[1]), counts)
+    sorted_values = matrix.data[np.lexsort((matrix.data, column_ids))]  # columns stay in order, values get sorted
+    result = np.full((len(quantiles), matrix.shape[1]), np.nan)
+    has_values = counts > 0
+    starts = matrix.indptr[:-1][has_values]
+    for i, quantile in enumerate(quantiles):
+        position = (counts[has_values] - 1) * quantile
+        lower_position = np.floor(position).astype(int)
+        upper_position = np.ceil(position).astype(int)
+        result[i, has_values] = interpolate_quantile(lower_values=sorted_values[starts + lower_position],
+                                                     upper_values=sorted_values[starts + upper_position],
+                                                     weight=position - lower_position)
+    return result
+
+
+def get_sparse_masks_by_cutoff_source(frame: SparseFrame, cutoff_df: pd.DataFrame, cutoff_rule: str,
+                                      samples: List[str], reference: Optional[str], bottom_outliers: bool,
+                                      non_outliers: bool, sample_index: SampleIndex) -> Dict[str, OutlierMasks]:
+    """Same as get_masks_by_cutoff_source, for a SparseFrame."""
+    masks = {}
+    if 'ref' in cutoff_rule:
+        masks['reference'] = get_sparse_outlier_masks(frame=frame, cutoff_df=cutoff_df, cutoff_from='reference',
+                                                      samples=[reference], bottom_outliers=bottom_outliers,
+                                                      non_outliers=non_outliers, sample_index=sample_index)
+    if 'sample' in cutoff_rule:
+        masks['sample'] = get_sparse_outlier_masks(frame=frame, cutoff_df=cutoff_df, cutoff_from='sample',
+                                                   samples=samples, bottom_outliers=bottom_outliers,
+                                                   non_outliers=non_outliers, sample_index=sample_index)
+    return masks
+
+
+def get_sparse_outlier_masks(frame: SparseFrame, cutoff_df: pd.DataFrame, cutoff_from: str, samples: List[str],
+                             bottom_outliers: bool, non_outliers: bool, sample_index: SampleIndex) -> OutlierMasks:
+    """Same as get_outlier_masks, for a SparseFrame: only stored values are compared against the cutoffs (missing
+    values are never outliers nor non-outliers), and the top, bottom and non-outlier masks are SparseMasks.
+    Rows are compared a block at a time, so that temporary arrays stay small."""
+    cutoff_array = get_cutoff_array(cutoff_df)
+    marker_positions = get_marker_positions(cutoff_df)
+    columns = [marker_positions[marker] for marker in frame.columns]
+    all_rows = np.arange(len(frame))
+    block_rows = max(1, SPARSE_BLOCK_VALUES * len(frame) // max(frame.matrix.nnz, 1))
+    rows, non_any = [], []
+    entries = {'top': ([], []), 'bottom': ([], []), 'non': ([], [])}
+    offset = 0
+    for sample in samples:
+        sample_rows = all_rows if cutoff_from == 'reference' else all_rows[sample_index.get_rows(sample)]
+        cutoffs = cutoff_array[cutoff_df.index.get_loc(sample)][columns]
+        for start in range(0, len(sample_rows), block_rows):
+            block = frame.matrix[sample_rows[start:start + block_rows]].tocoo()
+            with np.errstate(invalid='ignore'):
+                below_upper = block.data <= cutoffs[block.col, UPPER_CUTOFF]
+                above_lower = block.data >= cutoffs[block.col, LOWER_CUTOFF]
+                selected = {'top': block.data > cutoffs[block.col, UPPER_CUTOFF]}
+                if bottom_outliers is True:
+                    selected['bottom'] = block.data < cutoffs[block.col, LOWER_CUTOFF]
+            if non_outliers is True:
+                selected['non'] = below_upper & above_lower
+                non_any.append((np.bincount(block.row[below_upper], minlength=block.shape[0]) > 0) &
+                               (np.bincount(block.row[above_lower], minlength=block.shape[0]) > 0))
+            for name, mask in selected.items():
+                entries[name][0].append(offset + start + block.row[mask])
+                entries[name][1].append(block.col[mask])
+        rows.append(sample_rows)
+        offset += len(sample_rows)
+    shape = (offset, len(frame.columns))
+    sparse_masks = {name: SparseMask.from_entries(rows=np.concatenate(mask_rows or [np.zeros(0, dtype=int)]),
+                                                  columns=np.concatenate(mask_columns or [np.zeros(0, dtype=int)]),
+                                                  shape=shape)
+                    for name, (mask_rows, mask_columns) in entries.items()}
+    return OutlierMasks(rows=np.concatenate(rows), top=sparse_masks['top'],
+                        bottom=sparse_masks['bottom'] if bottom_outliers is True else None,
+                        non=sparse_masks['non'] if non_outliers is True else None,
+                        non_any=np.concatenate(non_any or [np.zeros(0, dtype=bool)]) if non_outliers is True else None)
+
+
+def get_sparse_stats_dfs(frame: SparseFrame, masks: Dict[str, OutlierMasks], markers: List[str], cutoff_rule: str,
+                         marker_rule: str, samples: List[str], bottom: bool, non: bool,
+                         sample_masks: Dict[str, np.ndarray],
+                         progress: Optional[ProgressReporter] = None) -> Dict[str, pd.DataFrame]:
+    """Same as get_stats_dfs, for a SparseFrame (only stored values are described). The progress reporter
+    (if any) advances once per sample and cutoff source."""
+    populations = get_stats_populations(bottom=bottom, non=non)
+    index = pd.MultiIndex.from_product([samples, populations, STATS_FIELDS])
+    whole_population = {sample: get_sparse_column_stats(matrix=frame.matrix[sample_masks[sample]])
+                        for sample in samples}
+    df_dict = {}
+    for cutoff_from, prefix in [('sample', 'OutS'), ('reference', 'OutR')]:
+        if cutoff_from not in masks:
+            continue
+        source_masks = masks[cutoff_from]
+        marker_rules = [rule for rule in ['any', 'single'] if rule in marker_rule]
+        arrays = {rule: np.empty((len(samples), len(populations), len(STATS_FIELDS), len(markers)))
+                  for rule in marker_rules}
+        for i, sample in enumerate(samples):
+            member = np.flatnonzero(sample_masks[sample][source_masks.rows])
+            sample_matrix = frame.matrix[source_masks.rows[member]]
+            for rule, array in arrays.items():
+                array[i, 0] = whole_population[sample]
+                for j, population in enumerate(populations[1:], 1):
+                    array[i, j] = get_sparse_population_stats(matrix=sample_matrix, masks=source_masks,
+                                                              population=population, member=member,
+                                                              any_marker=rule == 'any')
+            if progress is not None:
+                progress.advance(rows=len(member))
+        for rule, array in arrays.items():
+            df_dict[f'{prefix} {rule} marker'] = pd.DataFrame(array.reshape(-1, len(markers)), index=index,
+                                                              columns=markers)
+    return df_dict
+
+
+def get_sparse_population_stats(matrix: sparse.csr_matrix, masks: OutlierMasks, population: str,
+                                member: np.ndarray, any_marker: bool) -> np.ndarray:
+    """Same as get_masked_stats with the mask of get_population_mask, for the rows of a sparse matrix at the given
+    positions of OutlierMasks.rows."""
+    if population == 'non-outliers' and any_marker:
+        return get_sparse_column_stats(matrix=matrix[masks.non_any[member]])
+    mask = {'top outliers': masks.top, 'bottom outliers': masks.bottom, 'non-outliers': masks.non}[population]
+    member_mask = mask.matrix[member]
+    if any_marker:
+        return get_sparse_column_stats(matrix=matrix[np.diff(sparse.csr_matrix(member_mask).indptr) > 0])
+    return get_sparse_column_stats(matrix=matrix.multiply(member_mask))
+
+
+def get_sparse_column_stats(matrix: sparse.spmatrix) -> np.ndarray:
+    """Same as get_masked_stats, for the stored values of each column of a sparse matrix. Returns one row per
+    statistic (count, mean, median and sample standard deviation)."""
+    matrix = sparse.csc_matrix(matrix)
+    counts = np.diff(matrix.indptr)
+    column_ids = np.repeat(np.arange(matrix.shape[1]), counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(column_ids, weights=matrix.data, minlength=matrix.shape[1]) / counts
+        squares = np.bincount(column_ids, weights=(matrix.data - mean[column_ids]) ** 2, minlength=matrix.shape[1])
+        sd = np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+    median = get_column_quantiles(matrix=matrix, quantiles=[0.5])[0]
+    return np.stack([counts, mean, median, sd])
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+from collections import namedtuple
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.cache import get_cache_key, get_file_hash, load_cache_entry, read_cache_sidecar, write_cache_entry
+from src.utils import warn_on_error, write_sidecar_entry
+
+# Folder (inside the output folder) where the results of each stage of a run are kept for later runs
+STAGE_CACHE_FOLDER = '.scouts-stages'
+
+# Bumped whenever the layout of stage entries changes, so that old entries are computed again
+STAGE_CACHE_VERSION = 2
+
+# Result of a stage, as saved by StageCache.save: named arrays, along with JSON-serializable info
+StageEntry = namedtuple('StageEntry', ['arrays', 'info'])
+
+logger = logging.getLogger(__name__)
+
+
+class StageCache:
+    """Keeps the result of each stage of a SCOUTS run (gated data, cutoffs, outlier masks) in a folder, along with
+    the input file fingerprint and the options that produced it (the stage key). A later run in the same output
+    folder reuses a stage if its key is unchanged, so that e.g. changing only the marker rule or the export options
+    skips loading, gating and cutoff calculation. Each stage keeps only its latest result."""
+    def __init__(self, folder: str, input_file: str) -> None:
+        self.folder = folder
+        self.input_key = {**get_cache_key(input_file=input_file), 'hash': get_file_hash(input_file)}
+
+    def get_entry_folder(self, stage: str) -> str:
+        """Returns the folder where a stage is kept."""
+        return os.path.join(self.folder, stage)
+
+    def get_key(self, key: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns the full key of a stage (input fingerprint and options), as saved in its JSON sidecar."""
+        return json.loads(json.dumps({'stage_version': STAGE_CACHE_VERSION, 'input': self.input_key, **key}))
+
+    def load_dataframe(self, stage: str, key: Dict[str, Any]) -> Optional[pd.DataFrame]:
+        """Returns the DataFrame saved for a stage (values memory-mapped), or None if it is missing or stale."""
+        entry_folder = self.get_entry_folder(stage=stage)
+        sidecar = read_cache_sidecar(entry_folder=entry_folder)
+        if sidecar is None or sidecar['key'] != self.get_key(key=key):
+            return None
+        logger.info('reusing %s stage from %s', stage, self.folder)
+        return load_cache_entry(entry_folder=entry_folder, sidecar=sidecar)
+
+    def save_dataframe(self, stage: str, key: Dict[str, Any], df: pd.DataFrame) -> None:
+        """Saves the DataFrame of a stage (only numeric DataFrames are saved, as in src.cache)."""
+        with warn_on_error(logger=logger, message=f'could not save {stage} stage'):
+            write_cache_entry(entry_folder=self.get_entry_folder(stage=stage), key=self.get_key(key=key), df=df)
+
+    def load(self, stage: str, key: Dict[str, Any]) -> Optional[StageEntry]:
+        """Returns the arrays and JSON info saved for a stage, or None if they are missing or stale. Arrays are read
+        without unpickling anything, so entries can't run code when loaded."""
+        entry_folder = self.get_entry_folder(stage=stage)
+        sidecar = read_cache_sidecar(entry_folder=entry_folder)
+        if sidecar is None or sidecar['key'] != self.get_key(key=key):
+            return None
+        try:
+            with np.load(os.path.join(entry_folder, 'arrays.npz'), allow_pickle=False) as array_file:
+                arrays = {name: array_file[name] for name in sidecar['arrays']}
+        except (OSError, ValueError, KeyError):
+            return None
+        logger.info('reusing %s stage from %s', stage, self.folder)
+        return StageEntry(arrays=arrays, info=sidecar['info'])
+
+    def save(self, stage: str, key: Dict[str, Any], arrays: Optional[Dict[str, np.ndarray]] = None,
+             info: Optional[Any] = None) -> None:
+        """Saves the result of a stage as numeric or boolean arrays (e.g. outlier masks) and JSON info (e.g. labels),
+        described by a JSON sidecar (see src.utils.write_sidecar_entry)."""
+        arrays = arrays if arrays is not None else {}
+        entry_folder = self.get_entry_folder(stage=stage)
+        errors = (OSError, TypeError, ValueError)  # info that can't be saved as JSON raises TypeError or ValueError
+        with warn_on_error(logger=logger, message=f'could not save {stage} stage', errors=errors):
+            sidecar = {'key': self.get_key(key=key), 'arrays': list(arrays), 'info': info}
+            write_sidecar_entry(folder=entry_folder, sidecar=sidecar,
+                                write_data=lambda: np.savez(os.path.join(entry_folder, 'arrays.npz'), **arrays))
+
+    def load_frames(self, stage: str, key: Dict[str, Any]) -> Optional[List[Optional[pd.DataFrame]]]:
+        """Returns the DataFrames saved for a stage (with save_frames), or None if they are missing or stale."""
+        entry = self.load(stage=stage, key=key)
+        if entry is None:
+            return None
+        frames = []
+        for i, frame_info in enumerate(entry.info):
+            if frame_info is None:
+                frames.append(None)
+                continue
+            columns = frame_info['columns']
+            if frame_info['column_names'] is not None:  # MultiIndex columns (e.g. marker, statistic)
+                columns = pd.MultiIndex.from_tuples([tuple(column) for column in columns],
+                                                    names=frame_info['column_names'])
+            frames.append(pd.DataFrame(entry.arrays[str(i)], index=pd.Index(frame_info['index']), columns=columns))
+        return frames
+
+    def save_frames(self, stage: str, key: Dict[str, Any], frames: List[Optional[pd.DataFrame]]) -> None:
+        """Saves DataFrames of numbers (e.g. cutoff tables) as the result of a stage: their values are saved as arrays,
+        and their index and column names as JSON. Frames that are None are saved as such."""
+        arrays, info = {}, []
+        for i, frame in enumerate(frames):
+            if frame is None:
+                info.append(None)
+                continue
+            arrays[str(i)] = frame.to_numpy(dtype=float)
+            multi_index = isinstance(frame.columns, pd.MultiIndex)
+            info.append({'index': frame.index.tolist(), 'columns': frame.columns.tolist(),
+                         'column_names': list(frame.columns.names) if multi_index else None})
+        self.save(stage=stage, key=key, arrays=arrays, info=info)
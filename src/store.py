@@ -0,0 +1,111 @@
+import os
+from typing import Any, Dict, List
+
+import pandas as pd
+
+from src.writers import save_dataframe
+
+# Names of the files of a results store, inside the folder given to StoreWriter/ResultsStore
+STORE_FILE = 'results.parquet'
+STORE_INDEX_FILE = 'results_index.parquet'
+
+# Columns of the store index, besides the fields of each subset's Info
+STORE_INDEX_COLUMNS = ['file number', 'first row', 'rows']
+
+
+class StoreWriter:
+    """Writes all subsets of a SCOUTS run into a single Parquet file (requires pyarrow), one after the other,
+    instead of one file per subset. Each subset starts a new row group, and its position in the file is saved
+    in an index (STORE_INDEX_FILE, written on exit), so that a single subset can be read without scanning the
+    rest of the store. Sample names are saved as the first column, just like in exported subset files."""
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.writer = None
+        self.schema = None
+        self.rows_written = 0
+        self.index_rows: List[Dict[str, Any]] = []
+
+    def __enter__(self) -> 'StoreWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if exc_type is None:
+            index_df = pd.DataFrame(self.index_rows, columns=STORE_INDEX_COLUMNS + self.get_info_columns())
+            save_dataframe(df=index_df, path=os.path.join(self.folder, STORE_INDEX_FILE), index=False)
+
+    def add(self, number: int, data: pd.DataFrame, info: Dict[str, Any]) -> None:
+        """Appends a subset to the store under the given file number."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(data.reset_index(), schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = pq.ParquetWriter(os.path.join(self.folder, STORE_FILE), self.schema, compression='zstd')
+        if len(table):
+            self.writer.write_table(table, row_group_size=len(table))
+        self.index_rows.append({'file number': number, 'first row': self.rows_written, 'rows': len(table), **info})
+        self.rows_written += len(table)
+
+    def get_info_columns(self) -> List[str]:
+        """Returns the Info fields saved in the index, in the order they were given."""
+        return [key for key in self.index_rows[0] if key not in STORE_INDEX_COLUMNS] if self.index_rows else []
+
+
+class ResultsStore:
+    """Reads the results store written by SCOUTS (in the "data" subfolder of the output folder). The index
+    attribute lists every subset, with its file number (as in the summary table), Info fields and size."""
+    def __init__(self, folder: str) -> None:
+        import pyarrow.parquet as pq
+        self.folder = folder
+        self.index = pd.read_parquet(os.path.join(folder, STORE_INDEX_FILE)).set_index('file number')
+        self.parquet_file = None
+        if os.path.isfile(os.path.join(folder, STORE_FILE)):  # not written if no subset was ever added
+            self.parquet_file = pq.ParquetFile(os.path.join(folder, STORE_FILE))
+        self.row_group_starts = self.get_row_group_starts()
+
+    def __enter__(self) -> 'ResultsStore':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the store file."""
+        if self.parquet_file is not None:
+            self.parquet_file.close()
+
+    def get_row_group_starts(self) -> List[int]:
+        """Returns the first row of each row group in the store (followed by the total number of rows)."""
+        starts = [0]
+        if self.parquet_file is not None:
+            for row_group in range(self.parquet_file.num_row_groups):
+                starts.append(starts[-1] + self.parquet_file.metadata.row_group(row_group).num_rows)
+        return starts
+
+    def find(self, **info: Any) -> List[int]:
+        """Returns the file numbers of the subsets whose Info fields match all keyword arguments
+        (e.g. find(outliers_for='Marker01', category='top outliers'))."""
+        selected = self.index
+        for key, value in info.items():
+            selected = selected.loc[selected[key] == value]
+        return list(selected.index)
+
+    def read(self, number: int) -> pd.DataFrame:
+        """Reads a single subset, with sample names as the index, reading only the row groups that hold it."""
+        first_row, rows = int(self.index.at[number, 'first row']), int(self.index.at[number, 'rows'])
+        if rows == 0 and self.parquet_file is None:
+            df = pd.DataFrame()
+        elif rows == 0:
+            df = self.parquet_file.schema_arrow.empty_table().to_pandas()
+        else:
+            row_groups = [row_group for row_group in range(len(self.row_group_starts) - 1)
+                          if self.row_group_starts[row_group] < first_row + rows
+                          and self.row_group_starts[row_group + 1] > first_row]
+            offset = first_row - self.row_group_starts[row_groups[0]]
+            df = self.parquet_file.read_row_groups(row_groups).to_pandas().iloc[offset:offset + rows]
+        if len(df.columns):
+            df = df.set_index(df.columns[0])
+        return df
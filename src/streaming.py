@@ -0,0 +1,338 @@
+import logging
+import os
+import tempfile
+from collections import namedtuple
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.analysis import (Info, SampleIndex, apply_cytof_gating, apply_rnaseq_gating, build_cutoff_dataframe,
+                          build_sketch_cutoff_dataframes, create_stats_dfs, generate_cutoff_table,
+                          generate_stats_table, generate_summary_table, get_all_sample_names, get_key_from_info,
+                          get_masks_by_cutoff_source, get_reference_sample_name, get_tukey_cutoff_values,
+                          interpolate_quantile, yield_dataframes)
+from src.profiling import RunProfiler
+from src.progress import CancellationToken, Progress, ProgressReporter
+from src.sketch import QuantileSketch
+from src.utils import PandasInputError, SampleNamingError
+
+RunningStats = namedtuple("RunningStats", ['count', 'mean', 'm2'])
+SpillFile = namedtuple("SpillFile", ['paths', 'rows', 'counts'])
+
+logger = logging.getLogger(__name__)
+
+# Number of bins that the candidate values of a quantile are counted in, on each pass over a spill file
+SPILL_SELECT_BINS = 1024
+
+
+def start_scouts_streaming(input_file: str, output_folder: str, cutoff_rule: str, marker_rule: str,
+                           tukey_factor: float, export_csv: bool, sample_list: List[Tuple[str, str]], gating: str,
+                           gate_cutoff_value: Optional[float], export_gated: bool, non_outliers: bool,
+                           bottom_outliers: bool, chunk_size: int, sample_match: str = 'substring',
+                           quantile_method: str = 'exact', sketch_error: float = 0.01,
+                           table_format: str = 'xlsx', scratch_folder: Optional[str] = None,
+                           cancel_token: Optional[CancellationToken] = None,
+                           progress_callback: Optional[Callable[[Progress], None]] = None,
+                           profile_memory: bool = False, profile_calls: bool = False) -> None:
+    """Runs SCOUTS on a .csv input file that may not fit in memory, reading it chunk_size rows at a time.
+    The first pass gates each chunk and saves the values of each sample to temporary files in scratch_folder (the
+    system temporary folder by default), from which exact cutoffs are calculated in bounded memory (see
+    get_streamed_cutoff_dataframe). The second pass gates and classifies each chunk again, appending its rows
+    to the output .csv files. Output files are numbered as in start_scouts, but rows inside each file follow the
+    order of the input file (instead of being grouped by sample), stats.xlsx has no median values and the gated
+    population is saved as gated_population.csv. With quantile_method='sketch', the first pass updates a quantile
+    sketch of each sample instead of saving its values, so cutoffs are estimated in bounded memory. Cancellation and
+    progress reports work as in start_scouts, with the token checked after every chunk, and so does profiling."""
+    if not input_file.endswith('.csv'):
+        raise PandasInputError
+    profiler = RunProfiler(folder=output_folder, trace_memory=profile_memory, profile_calls=profile_calls)
+    with ProgressReporter(callback=progress_callback, cancel_token=cancel_token, profiler=profiler) as progress:
+        samples = get_all_sample_names(sample_list=sample_list)
+        reference = None
+        if 'ref' in cutoff_rule:
+            reference = get_reference_sample_name(sample_list=sample_list)
+        cutoff_samples = [reference] if cutoff_rule == 'ref' else samples
+        gated_path = os.path.join(output_folder, 'gated_population.csv') if export_gated else None
+        cutoff_error_df = None
+        with tempfile.TemporaryDirectory(prefix='scouts-spill-', dir=scratch_folder) as spill_folder:
+            sketches = None
+            if quantile_method == 'sketch':
+                sketches = {sample: QuantileSketch.from_error(error=sketch_error) for sample in cutoff_samples}
+            progress.start_stage('first pass')
+            markers, spill_files = spill_sample_values(input_file=input_file, samples=samples,
+                                                       cutoff_samples=cutoff_samples, sample_match=sample_match,
+                                                       gating=gating, gate_cutoff_value=gate_cutoff_value,
+                                                       chunk_size=chunk_size, spill_folder=spill_folder,
+                                                       gated_path=gated_path, sketches=sketches, progress=progress)
+            input_rows = progress.rows_processed
+            progress.start_stage('cutoffs', steps=len(cutoff_samples))
+            if sketches is not None:
+                cutoff_df, cutoff_error_df = build_sketch_cutoff_dataframes(sketches=list(sketches.values()),
+                                                                            samples=cutoff_samples, markers=markers,
+                                                                            tukey=tukey_factor)
+            else:
+                cutoff_df = get_streamed_cutoff_dataframe(spill_files=spill_files, samples=cutoff_samples,
+                                                          markers=markers, tukey=tukey_factor, chunk_size=chunk_size,
+                                                          progress=progress)
+        progress.start_stage('second pass', steps=-(-input_rows // chunk_size))
+        run_scouts_streaming(input_file=input_file, samples=samples, markers=markers, reference=reference,
+                             cutoff_df=cutoff_df, cutoff_rule=cutoff_rule, marker_rule=marker_rule,
+                             export_csv=export_csv, non_outliers=non_outliers, bottom_outliers=bottom_outliers,
+                             output_folder=output_folder, gating=gating, gate_cutoff_value=gate_cutoff_value,
+                             sample_match=sample_match, chunk_size=chunk_size, cutoff_error_df=cutoff_error_df,
+                             table_format=table_format, progress=progress)
+        if gated_path is not None:
+            progress.add_files([gated_path])
+        progress.finish()
+
+
+def yield_gated_chunks(input_file: str, gating: str, gate_cutoff_value: Optional[float],
+                       chunk_size: int) -> Iterator[Tuple[pd.DataFrame, pd.Index]]:
+    """Reads the input .csv file chunk_size rows at a time (first column as the index), gating each chunk.
+    Yields each gated chunk along with its index before gating."""
+    for chunk in pd.read_csv(input_file, header=0, index_col=0, chunksize=chunk_size):
+        index_before_gating = chunk.index
+        if gating == 'cytof':
+            apply_cytof_gating(df=chunk, cutoff=gate_cutoff_value)
+        elif gating == 'rnaseq':
+            apply_rnaseq_gating(df=chunk, cutoff=gate_cutoff_value)
+        yield chunk, index_before_gating
+
+
+def spill_sample_values(input_file: str, samples: List[str], cutoff_samples: List[str], sample_match: str,
+                        gating: str, gate_cutoff_value: Optional[float], chunk_size: int, spill_folder: str,
+                        gated_path: Optional[str], sketches: Optional[Dict[str, QuantileSketch]] = None,
+                        progress: Optional[ProgressReporter] = None) -> Tuple[List[str], Dict[str, SpillFile]]:
+    """First pass over the input file: checks that all samples are present, gates each chunk and appends the
+    values of each sample in cutoff_samples to binary files (float64, one file per marker) in the spill folder,
+    counting the non-missing values of each marker.
+    If quantile sketches are given, they are updated with the values of their samples instead. The progress
+    reporter (if any) advances once per chunk.
+    Returns the marker names and the spill files of each sample (empty if sketches were updated)."""
+    markers = None
+    found = dict.fromkeys(samples, False)
+    spill_files = {}
+    rows_before, rows_after = 0, 0
+    for chunk_number, (chunk, index_before_gating) in enumerate(yield_gated_chunks(input_file=input_file, gating=gating,
+                                                                                 gate_cutoff_value=gate_cutoff_value,
+                                                                                 chunk_size=chunk_size)):
+        if markers is None:
+            markers = list(chunk)
+            if sketches is None:
+                spill_files = {sample: SpillFile([os.path.join(spill_folder, f'{i}_{j}.bin')
+                                                  for j in range(len(markers))], 0, np.zeros(len(markers), dtype=int))
+                               for i, sample in enumerate(cutoff_samples)}
+        rows_before += len(index_before_gating)
+        rows_after += len(chunk)
+        for sample, matches in zip(samples, get_sample_matches(index=index_before_gating, samples=samples,
+                                                               sample_match=sample_match)):
+            found[sample] = found[sample] or matches
+        sample_index = SampleIndex.from_index(index=chunk.index, samples=samples, match_mode=sample_match)
+        if gated_path is not None:
+            chunk.to_csv(gated_path, mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0)
+        values = chunk.to_numpy(dtype=float)
+        for sample, sketch in (sketches or {}).items():
+            sketch.update(values[sample_index.get_rows(sample)])
+        for sample, spill_file in spill_files.items():
+            sample_values = values[sample_index.get_rows(sample)]
+            for j, path in enumerate(spill_file.paths):
+                with open(path, 'ab') as binary_file:
+                    sample_values[:, j].tofile(binary_file)
+            spill_files[sample] = spill_file._replace(rows=spill_file.rows + len(sample_values),
+                                                      counts=spill_file.counts + np.count_nonzero(
+                                                          ~np.isnan(sample_values), axis=0))
+        if progress is not None:
+            progress.advance(rows=len(index_before_gating))
+    if markers is None or not all(found.values()):
+        # Samples are only known to be missing once the whole file has been read (this includes empty files)
+        raise SampleNamingError
+    if gating != 'no_gate':
+        logger.info('%s gating dropped %d of %d rows', gating, rows_before - rows_after, rows_before)
+    return markers, spill_files
+
+
+def get_sample_matches(index: pd.Index, samples: List[str], sample_match: str) -> List[bool]:
+    """Returns whether each sample matches at least one label of the index."""
+    sample_index = SampleIndex.from_index(index=index, samples=samples, match_mode=sample_match)
+    return [len(sample_index.get_positions(sample)) > 0 for sample in samples]
+
+
+def get_streamed_cutoff_dataframe(spill_files: Dict[str, SpillFile], samples: List[str], markers: List[str],
+                                  tukey: float, chunk_size: int,
+                                  progress: Optional[ProgressReporter] = None) -> pd.DataFrame:
+    """Calculates the exact cutoffs of each sample from its spill files, with the same quartiles as get_quantiles.
+    The values around each quartile are found with get_spilled_ranks, so that at most about chunk_size rows' worth
+    of values are in memory at any time, however many cells a sample has."""
+    block_values = max(1, chunk_size * len(markers))
+    cutoff_array = np.full((len(samples), len(markers), 5), np.nan)
+    for i, sample in enumerate(samples):
+        spill_file = spill_files[sample]
+        if progress is not None:
+            progress.advance(rows=spill_file.rows)
+        for j, (path, count) in enumerate(zip(spill_file.paths, spill_file.counts)):
+            if count == 0:
+                continue  # no cell of the sample has a value for the marker: cutoffs stay undefined (NaN)
+            position = (count - 1) * np.array([0.25, 0.75])
+            lower_position, upper_position = np.floor(position).astype(int), np.ceil(position).astype(int)
+            ranks = np.unique(np.concatenate([lower_position, upper_position]))
+            rank_values = dict(zip(ranks, get_spilled_ranks(path=path, ranks=ranks, block_values=block_values)))
+            first_quartile, third_quartile = interpolate_quantile(
+                lower_values=np.array([rank_values[rank] for rank in lower_position]),
+                upper_values=np.array([rank_values[rank] for rank in upper_position]),
+                weight=position - lower_position)
+            cutoff_array[i, j] = get_tukey_cutoff_values(first_quartile=first_quartile, third_quartile=third_quartile,
+                                                         tukey=tukey)
+    return build_cutoff_dataframe(cutoff_array=cutoff_array, samples=samples, markers=markers)
+
+
+def yield_spilled_values(path: str, block_values: int) -> Iterator[np.ndarray]:
+    """Yields the non-missing values of a spill file, reading block_values values at a time."""
+    with open(path, 'rb') as spill:
+        while True:
+            block = np.fromfile(spill, dtype=float, count=block_values)
+            if not len(block):
+                return
+            yield block[~np.isnan(block)]
+
+
+def get_spilled_ranks(path: str, ranks: np.ndarray, block_values: int) -> np.ndarray:
+    """Returns the values at the given ranks (0-based positions among the sorted non-missing values) of a spill
+    file, reading it block_values values at a time. Each rank is searched for within an interval (low, high]
+    of values: a pass over the file counts the values of the interval, and if there are too many of them to sort,
+    a second pass counts them in SPILL_SELECT_BINS bins and narrows the interval to the bin holding the rank.
+    Once the interval of a rank holds few enough values (or a single distinct value), they are gathered and sorted.
+    At most about block_values values (split between the ranks) are held in memory besides the block being read."""
+    limit = max(1, block_values // len(ranks))
+    result = np.full(len(ranks), np.nan)
+    low, high = np.full(len(ranks), -np.inf), np.full(len(ranks), np.inf)
+    below = np.zeros(len(ranks), dtype=int)  # number of values at or below low
+    pending = list(range(len(ranks)))
+    while pending:
+        counts = np.zeros(len(ranks), dtype=int)
+        minima, maxima = np.full(len(ranks), np.inf), np.full(len(ranks), -np.inf)
+        for values in yield_spilled_values(path=path, block_values=block_values):
+            for i in pending:
+                selected = values[(values > low[i]) & (values <= high[i])]
+                if len(selected):
+                    counts[i] += len(selected)
+                    minima[i], maxima[i] = min(minima[i], selected.min()), max(maxima[i], selected.max())
+        gathered = {i: [] for i in pending if counts[i] <= limit}
+        binned = {}
+        for i in pending:
+            if i not in gathered and minima[i] == maxima[i]:
+                result[i] = minima[i]
+            elif i not in gathered:
+                binned[i] = (np.linspace(minima[i], maxima[i], SPILL_SELECT_BINS + 1),
+                             np.zeros(SPILL_SELECT_BINS + 1, dtype=int))
+        for values in yield_spilled_values(path=path, block_values=block_values):
+            for i in list(gathered) + list(binned):
+                selected = values[(values > low[i]) & (values <= high[i])]
+                if i in gathered:
+                    gathered[i].append(selected)
+                else:  # bin k holds the values in (edges[k - 1], edges[k]], and bin 0 the minimum
+                    edges, bin_counts = binned[i]
+                    bin_counts += np.bincount(np.searchsorted(edges, selected, side='left'),
+                                              minlength=len(edges))
+        for i, arrays in gathered.items():
+            result[i] = np.sort(np.concatenate(arrays))[ranks[i] - below[i]]
+        for i, (edges, bin_counts) in binned.items():
+            cumulative = below[i] + np.cumsum(bin_counts)
+            k = int(np.searchsorted(cumulative, ranks[i], side='right'))
+            below[i] = cumulative[k - 1] if k > 0 else below[i]
+            low[i], high[i] = (edges[k - 1] if k > 0 else low[i]), edges[k]
+        pending = list(binned)
+    return result
+
+
+def run_scouts_streaming(input_file: str, samples: List[str], markers: List[str], reference: Optional[str],
+                         cutoff_df: pd.DataFrame, cutoff_rule: str, marker_rule: str, export_csv: bool,
+                         non_outliers: bool, bottom_outliers: bool, output_folder: str, gating: str,
+                         gate_cutoff_value: Optional[float], sample_match: str, chunk_size: int,
+                         cutoff_error_df: Optional[pd.DataFrame] = None, table_format: str = 'xlsx',
+                         progress: Optional[ProgressReporter] = None) -> None:
+    """Second pass over the input file: subsets each gated chunk with the same routines as run_scouts, appending
+    the result to the output .csv files, and keeps running stats of every subset for stats.xlsx. The progress
+    reporter (if any) advances once per chunk, and then goes through the tables stage."""
+    if progress is None:
+        progress = ProgressReporter()
+    output_path = os.path.join(output_folder, 'data')
+    if not os.path.exists(output_path):
+        os.mkdir(output_path)
+    infos = []
+    whole_population_stats = {}
+    subset_stats = {}
+    csv_paths = []
+    for chunk_number, (chunk, index_before_gating) in enumerate(yield_gated_chunks(input_file=input_file, gating=gating,
+                                                                 gate_cutoff_value=gate_cutoff_value,
+                                                                 chunk_size=chunk_size)):
+        sample_index = SampleIndex.from_index(index=chunk.index, samples=samples, match_mode=sample_match)
+        masks = get_masks_by_cutoff_source(input_df=chunk, cutoff_df=cutoff_df, cutoff_rule=cutoff_rule,
+                                           samples=samples, reference=reference, bottom_outliers=bottom_outliers,
+                                           non_outliers=non_outliers, sample_index=sample_index)
+        for sample in samples:
+            values = sample_index.filter(chunk, sample).to_numpy(dtype=float)
+            whole_population_stats[sample] = update_running_stats(whole_population_stats.get(sample), values)
+        for i, (data, info) in enumerate(yield_dataframes(input_df=chunk, samples=samples, markers=markers,
+                                                          reference=reference, cutoff_df=cutoff_df,
+                                                          cutoff_rule=cutoff_rule, marker_rule=marker_rule,
+                                                          non_outliers=non_outliers, bottom_outliers=bottom_outliers,
+                                                          sample_index=sample_index, masks=masks), 1):
+            if chunk_number == 0:
+                infos.append(info)
+            for sample in samples:
+                values = sample_index.filter(data, sample).to_numpy(dtype=float)
+                subset_stats[(i, sample)] = update_running_stats(subset_stats.get((i, sample)), values)
+            if export_csv:
+                csv_path = os.path.join(output_path, '%04d.csv' % i)
+                data.to_csv(csv_path, mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0)
+                if chunk_number == 0:
+                    csv_paths.append(csv_path)
+        progress.advance(rows=len(index_before_gating))
+    progress.start_stage('tables')
+    summary_df = pd.DataFrame([[i, *info] for i, info in enumerate(infos, 1)],
+                              columns=['file number'] + list(Info._fields))
+    table_paths = [os.path.join(output_folder, f'{table}.{table_format}')
+                   for table in ['summary', 'stats', 'cutoff_values']]
+    generate_summary_table(summary_df, table_paths[0])
+    stats_df_dict = create_stats_dfs(markers=markers, cutoff_rule=cutoff_rule, marker_rule=marker_rule,
+                                     samples=samples, bottom=bottom_outliers, non=non_outliers)
+    for stats_df in stats_df_dict.values():
+        for sample in samples:
+            stats_df.loc[(sample, 'whole population')] = get_stats_values(whole_population_stats[sample])
+    for i, info in enumerate(infos, 1):
+        stats_df = stats_df_dict[get_key_from_info(info)]
+        for sample in samples:
+            values = get_stats_values(subset_stats[(i, sample)])
+            if 'any' in info.outliers_for:
+                stats_df.loc[(sample, info.category)] = values
+            else:
+                stats_df.loc[(sample, info.category), info.outliers_for] = values[:, markers.index(info.outliers_for)]
+    generate_stats_table(stats_df_dict, table_paths[1])
+    generate_cutoff_table(cutoff_df, table_paths[2], cutoff_error_df=cutoff_error_df)
+    progress.add_files(csv_paths + table_paths)
+
+
+def update_running_stats(running: Optional[RunningStats], values: np.ndarray) -> RunningStats:
+    """Merges the count, mean and sum of squared deviations of each column of values (ignoring missing values)
+    into the running stats, using the pairwise update of Chan et al."""
+    count = np.count_nonzero(~np.isnan(values), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=0) / count
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+        if running is None:
+            return RunningStats(count, mean, m2)
+        total = running.count + count
+        delta = np.where(count > 0, mean, 0) - np.where(running.count > 0, running.mean, 0)
+        merged_mean = np.where(running.count > 0, running.mean, 0) + delta * count / total
+        merged_m2 = running.m2 + m2 + delta ** 2 * running.count * count / total
+    return RunningStats(total, np.where(total > 0, merged_mean, np.nan), np.where(total > 0, merged_m2, 0.0))
+
+
+def get_stats_values(running: RunningStats) -> np.ndarray:
+    """Returns an array with the rows of stats.xlsx ('#', 'mean', 'median', 'sd') from the running stats.
+    Medians cannot be calculated from running stats, so they are left empty."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.where(running.count > 1, np.sqrt(running.m2 / (running.count - 1)), np.nan)
+    median = np.full(len(running.count), np.nan)
+    return np.vstack([running.count, running.mean, median, sd])
@@ -1,4 +1,10 @@
+import json
+import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generator, Optional, Tuple, Type
 
 
 def get_project_root():
@@ -6,6 +12,39 @@ def get_project_root():
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 
 
+def get_spawn_executor(max_workers: int, initializer: Optional[Callable[..., Any]] = None,
+                       initargs: Tuple[Any, ...] = ()) -> ProcessPoolExecutor:
+    """Returns a pool of max_workers worker processes, each set up by calling initializer(*initargs) (if given).
+    Workers are spawned instead of forked, since the caller may be a multithreaded (Qt) process."""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=initializer, initargs=initargs)
+
+
+def write_sidecar_entry(folder: str, write_data: Callable[[], None], sidecar: Dict[str, Any]) -> None:
+    """Writes an entry made of data files (written by calling write_data) and a JSON sidecar describing them to a
+    folder. The sidecar is removed first and written last (under a temporary name, then renamed), so that an
+    interrupted write never leaves an entry that looks complete."""
+    os.makedirs(folder, exist_ok=True)
+    sidecar_path = os.path.join(folder, 'sidecar.json')
+    if os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+    write_data()
+    with open(f'{sidecar_path}.tmp', 'w') as sidecar_file:
+        json.dump(sidecar, sidecar_file)
+    os.replace(f'{sidecar_path}.tmp', sidecar_path)
+
+
+@contextmanager
+def warn_on_error(logger: logging.Logger, message: str,
+                  errors: Tuple[Type[Exception], ...] = (OSError,)) -> Generator[None, None, None]:
+    """Logs errors raised by the block as a warning (message, followed by the error) instead of raising them. Used
+    for optional files (caches, stages, profiles), which should never stop or hide the outcome of an analysis."""
+    try:
+        yield
+    except errors as error:
+        logger.warning('%s: %s', message, error)
+
+
 class NoIOPathError(Exception):
     """Exception raised when no input file/output folder is provided."""
     def __init__(self):
@@ -34,3 +73,15 @@ class SampleNamingError(Exception):
     """Exception raised when samples cannot be found in the input file."""
     def __init__(self):
         super().__init__()
+
+
+class InvalidConfigError(Exception):
+    """Exception raised when the configuration for a headless SCOUTS run cannot be read or has invalid values."""
+    def __init__(self, message: str = ''):
+        super().__init__(message)
+
+
+class AnalysisCancelledError(Exception):
+    """Exception raised when a running analysis is cancelled (see src.progress.CancellationToken)."""
+    def __init__(self):
+        super().__init__()
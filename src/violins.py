@@ -1,7 +1,7 @@
 import os
 import sys
 import traceback
-from typing import Callable, Generator, List, Tuple
+from typing import Callable, Generator, List, Optional, Tuple
 
 import pandas as pd
 import seaborn as sns
@@ -15,6 +15,8 @@ from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 from xlrd import XLRDError
 
+from src.analysis import load_indexed_dataframe
+from src.catalog import CATALOG_FILE, RunCatalog
 from src.utils import get_project_root
 
 set_backend('Qt5Agg')
@@ -51,6 +53,7 @@ class ViolinGUI(QMainWindow):
         self.population_df = None  # DataFrame of whole population (raw data)
         self.summary_df = None  # DataFrame indicating which SCOUTS output corresponds to which rule
         self.summary_path = None  # path to all DataFrames generated by SCOUTS
+        self.catalog = None  # RunCatalog of the SCOUTS output, used instead of summary_df when available
 
         self.main_layout = QVBoxLayout(self.page)
 
@@ -245,13 +248,21 @@ class ViolinGUI(QMainWindow):
 
     def load_scouts_results(self, query: str) -> None:
         """Loads the SCOUTS summary file into memory, in order to dynamically locate SCOUTS output files later when
-        the user chooses which data to plot."""
-        self.summary_df = pd.read_excel(os.path.join(query, 'summary.xlsx'), index_col=None)
+        the user chooses which data to plot. If the output has a run catalog, it is used instead of the summary file."""
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
+        if os.path.isfile(os.path.join(query, CATALOG_FILE)):
+            self.catalog = RunCatalog(query)
+            self.summary_df = None
+        else:
+            self.summary_df = pd.read_excel(os.path.join(query, 'summary.xlsx'), index_col=None)
         self.summary_path = query
 
     def enable_plot(self) -> None:
         """Enables plot button if all necessary files are placed in memory."""
-        if isinstance(self.summary_df, pd.DataFrame) and isinstance(self.population_df, pd.DataFrame):
+        results_loaded = isinstance(self.summary_df, pd.DataFrame) or self.catalog is not None
+        if results_loaded and isinstance(self.population_df, pd.DataFrame):
             self.plot_button.setEnabled(True)
 
     def run_plot(self) -> None:
@@ -265,39 +276,17 @@ class ViolinGUI(QMainWindow):
         """Logic for plotting data based on user selection of populations, markers, etc."""
         # Clear figure currently on plot
         self.dynamic_canvas.axes.cla()
-        # Initialize values and get parameters from GUI
-        columns = ['sample', 'marker', 'population', 'expression']
+        # Get parameters from GUI
         samples = self.parse_sample_names()
-        pop_01 = self.drop_down_01.currentText()
-        pop_02 = self.drop_down_02.currentText()
-        pops_to_analyse = [pop_01, pop_02]
+        pops_to_analyse = [self.drop_down_01.currentText(), self.drop_down_02.currentText()]
         marker = self.drop_down_03.currentText()
         cutoff_from_reference = True if self.drop_down_04.currentText() == 'OutR' else False
-        violin_df = pd.DataFrame(columns=columns)
-        # Start fetching data from files
-        # Whole population
-        for pop in pops_to_analyse:
-            if pop == 'whole population':
-                for partial_df in self.yield_violin_values(df=self.population_df, population='whole population',
-                                                           samples=samples, marker=marker, columns=columns):
-                    violin_df = violin_df.append(partial_df)
-        # Other comparisons
-            elif pop != 'none':
-                for file_number in self.yield_selected_file_numbers(summary_df=self.summary_df, population=pop,
-                                                                    cutoff_from_reference=cutoff_from_reference,
-                                                                    marker=marker):
-                    df_path = os.path.join(self.summary_path, 'data', f'{"%04d" % file_number}.')
-                    try:
-                        sample_df = pd.read_excel(df_path + 'xlsx', index_col=0)
-                    except FileNotFoundError:
-                        sample_df = pd.read_csv(df_path + 'csv', index_col=0)
-                    if not sample_df.empty:
-                        for partial_df in self.yield_violin_values(df=sample_df, population=pop, samples=samples,
-                                                                   marker=marker, columns=columns):
-                            violin_df = violin_df.append(partial_df)
+        violin_df = self.get_violin_data(population_df=self.population_df, summary_df=self.summary_df,
+                                         summary_path=self.summary_path, catalog=self.catalog, samples=samples,
+                                         populations=pops_to_analyse, marker=marker,
+                                         cutoff_from_reference=cutoff_from_reference)
         # Plot data
         pops_to_analyse = [p for p in pops_to_analyse if p != 'none']
-        violin_df = violin_df[violin_df['marker'] == marker]
         for pop in pops_to_analyse:
             pop_subset = violin_df.loc[violin_df['population'] == pop]
             for sample in samples:
@@ -331,6 +320,47 @@ class ViolinGUI(QMainWindow):
         else:
             event.ignore()
 
+    @staticmethod
+    def get_violin_data(population_df: pd.DataFrame, summary_df: Optional[pd.DataFrame], summary_path: str,
+                        catalog: Optional[RunCatalog], samples: List[str], populations: List[str], marker: str,
+                        cutoff_from_reference: bool) -> pd.DataFrame:
+        """Returns the expression values of a marker to be plotted, for each sample and population ('whole population'
+        values come from the SCOUTS input data, others from the SCOUTS output files). Does not depend on the GUI, so
+        that the data path of a plot can be used (and benchmarked) without it."""
+        columns = ['sample', 'marker', 'population', 'expression']
+        violin_df = pd.DataFrame(columns=columns)
+        for pop in populations:
+            # Whole population
+            if pop == 'whole population':
+                for partial_df in ViolinGUI.yield_violin_values(df=population_df, population='whole population',
+                                                                samples=samples, marker=marker, columns=columns):
+                    violin_df = violin_df.append(partial_df)
+            # Other comparisons
+            elif pop != 'none':
+                for file_number in ViolinGUI.yield_selected_file_numbers(summary_df=summary_df, population=pop,
+                                                                         cutoff_from_reference=cutoff_from_reference,
+                                                                         marker=marker, catalog=catalog):
+                    sample_df = ViolinGUI.load_subset(summary_path=summary_path, catalog=catalog,
+                                                      file_number=file_number)
+                    if not sample_df.empty:
+                        for partial_df in ViolinGUI.yield_violin_values(df=sample_df, population=pop,
+                                                                        samples=samples, marker=marker,
+                                                                        columns=columns):
+                            violin_df = violin_df.append(partial_df)
+        return violin_df[violin_df['marker'] == marker]
+
+    @staticmethod
+    def load_subset(summary_path: str, catalog: Optional[RunCatalog], file_number: int) -> pd.DataFrame:
+        """Loads the output file of a subset, with sample names as the index. Its path (and format) comes from the
+        run catalog if there is one; older output folders without a catalog only have .xlsx or .csv files."""
+        if catalog is not None:
+            return load_indexed_dataframe(input_file=catalog.get_data_path(file_number))
+        df_path = os.path.join(summary_path, 'data', f'{"%04d" % file_number}.')
+        try:
+            return pd.read_excel(df_path + 'xlsx', index_col=0)
+        except FileNotFoundError:
+            return pd.read_csv(df_path + 'csv', index_col=0)
+
     @staticmethod
     def yield_violin_values(df: pd.DataFrame, population: str, samples: List[str], marker: str,
                             columns: List[str]) -> pd.DataFrame:
@@ -342,16 +372,21 @@ class ViolinGUI(QMainWindow):
                                columns=columns)
 
     @staticmethod
-    def yield_selected_file_numbers(summary_df: pd.DataFrame, population: str, cutoff_from_reference: bool,
-                                    marker: str) -> Generator[pd.DataFrame, None, None]:
+    def yield_selected_file_numbers(summary_df: Optional[pd.DataFrame], population: str,
+                                    cutoff_from_reference: bool, marker: str,
+                                    catalog: Optional[RunCatalog] = None) -> Generator[int, None, None]:
         """Yields file numbers from DataFrames resulting from SCOUTS analysis. DataFrames are yielded based on
-        global values, i.e. the comparisons the user wants to perform."""
+        global values, i.e. the comparisons the user wants to perform. The run catalog is queried if given,
+        otherwise the summary DataFrame is filtered."""
         cutoff = 'sample'
         if cutoff_from_reference is True:
             cutoff = 'reference'
-        for index, (file_number, cutoff_from, reference, outliers_for, category) in summary_df.iterrows():
-            if cutoff_from == cutoff and outliers_for == marker and category == population:
-                yield file_number
+        if catalog is not None:
+            yield from catalog.find(cutoff_from=cutoff, outliers_for=marker, category=population)
+            return
+        cutoff_from, outliers_for, category = summary_df.iloc[:, 1], summary_df.iloc[:, 3], summary_df.iloc[:, 4]
+        selected = (cutoff_from == cutoff) & (outliers_for == marker) & (category == population)
+        yield from summary_df.iloc[:, 0][selected.values]
 
 
 class DynamicCanvas(FigureCanvas):
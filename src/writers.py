@@ -0,0 +1,147 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, Callable, Deque, Generator, List, Optional
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+from src.utils import get_spawn_executor
+
+# Number of rows converted at a time when streaming a DataFrame into a write-only workbook
+EXCEL_BLOCK_ROWS = 10000
+
+
+def write_subset(data: pd.DataFrame, paths: List[str]) -> None:
+    """Writes a SCOUTS subset to each of the paths given (one per output format)."""
+    for path in paths:
+        save_dataframe(df=data, path=path)
+
+
+def save_dataframe(df: pd.DataFrame, path: str, index: bool = True) -> None:
+    """Saves a DataFrame in the format given by the extension of path (.csv, .xlsx, .parquet or .feather).
+    In columnar formats (which require pyarrow), the index is saved as the first column(s), so that output
+    files can be read back as SCOUTS input."""
+    if path.endswith('.csv'):
+        df.to_csv(path, index=index)
+    elif path.endswith('.xlsx'):
+        df.to_excel(path, index=index)
+    elif path.endswith('.parquet'):
+        (df.reset_index() if index else df).to_parquet(path, index=False, compression='zstd')
+    elif path.endswith('.feather'):
+        (df.reset_index() if index else df.reset_index(drop=True)).to_feather(path)
+    else:
+        raise ValueError(f'unsupported output format: {path}')
+
+
+class WriterPool:
+    """Writes SCOUTS subsets to disk. With n_writers > 0, files are written concurrently by a pool of worker
+    processes, and at most queue_depth subsets are waiting to be written at any time (submitting a subset blocks
+    until a slot is free), which bounds the memory used by the pool. With n_writers = 0, each subset is written
+    on the calling thread as soon as it is submitted. File names are chosen by the caller, so the numbering of
+    output files does not depend on the order in which the workers finish. If given, on_written is called with
+    the paths of each subset once they were written (from another thread, when n_writers > 0)."""
+    def __init__(self, n_writers: int = 0, queue_depth: Optional[int] = None,
+                 on_written: Optional[Callable[[List[str]], None]] = None) -> None:
+        if n_writers < 0:
+            raise ValueError('n_writers must be zero or a positive integer')
+        if queue_depth is None:
+            queue_depth = 2 * n_writers
+        if n_writers > 0 and queue_depth < 1:
+            raise ValueError('queue_depth must be a positive integer')
+        self.n_writers = n_writers
+        self.queue_depth = queue_depth
+        self.on_written = on_written
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.pending: Deque[Future] = deque()
+
+    def __enter__(self) -> 'WriterPool':
+        if self.n_writers > 0:
+            self.executor = get_spawn_executor(max_workers=self.n_writers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:  # an error was raised while subsetting: nothing else should be written
+            self.cancel()
+        try:
+            while self.pending:
+                future = self.pending.popleft()
+                if exc_type is None:
+                    future.result()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def submit(self, data: pd.DataFrame, paths: List[str]) -> None:
+        """Queues a subset to be written to each of the paths given (one per output format)."""
+        if not paths:
+            return
+        if self.executor is None:
+            write_subset(data=data, paths=paths)
+            if self.on_written is not None:
+                self.on_written(paths)
+            return
+        while len(self.pending) >= self.queue_depth:
+            self.collect_finished(block=True)
+        future = self.executor.submit(write_subset, data, paths)
+        if self.on_written is not None:
+            future.add_done_callback(lambda done: self.report_written(future=done, paths=paths))
+        self.pending.append(future)
+
+    def report_written(self, future: Future, paths: List[str]) -> None:
+        """Passes the paths of a subset to on_written, if its job finished without errors."""
+        if not future.cancelled() and future.exception() is None:
+            self.on_written(paths)
+
+    def collect_finished(self, block: bool) -> None:
+        """Removes finished jobs from the queue, raising any exception that happened while writing them.
+        If block is True, waits for at least one job to finish first."""
+        if block:
+            wait(self.pending, return_when=FIRST_COMPLETED)
+        for future in [future for future in self.pending if future.done()]:
+            self.pending.remove(future)
+            future.result()
+
+    def cancel(self) -> None:
+        """Cancels all queued jobs that have not started yet (e.g. when the user exits the GUI)."""
+        for future in self.pending:
+            future.cancel()
+        self.pending = deque(future for future in self.pending if not future.cancelled())
+
+
+class MergedWorkbookWriter:
+    """Writes the single Excel spreadsheet with all SCOUTS subsets (a "Summary" sheet followed by one sheet per
+    subset) while the subsets are produced. The workbook is write-only, so rows are streamed to temporary files
+    instead of being kept in memory, and the .xlsx files of each subset never need to be read back."""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.summary_sheet = self.workbook.create_sheet('Summary')
+
+    def add(self, number: int, data: pd.DataFrame) -> None:
+        """Adds a subset as a new sheet, in the same layout as an .xlsx subset file."""
+        sheet = self.workbook.create_sheet('%04d' % number)
+        for row in get_excel_rows(df=data, index=True):
+            sheet.append(row)
+
+    def save(self, summary_df: pd.DataFrame) -> None:
+        """Fills the Summary sheet (same layout as the summary table) and saves the workbook."""
+        for row in get_excel_rows(df=summary_df, index=False):
+            self.summary_sheet.append(row)
+        self.workbook.save(self.path)
+
+
+def get_excel_rows(df: pd.DataFrame, index: bool) -> Generator[List[Any], None, None]:
+    """Yields the rows of a DataFrame (header first) as lists of cell values, the way DataFrame.to_excel writes
+    them: missing values become empty cells and infinite values become "inf"/"-inf". Values are converted
+    EXCEL_BLOCK_ROWS rows at a time."""
+    yield ([df.index.name] if index else []) + list(df.columns)
+    for start in range(0, len(df), EXCEL_BLOCK_ROWS):
+        block = df.iloc[start:start + EXCEL_BLOCK_ROWS]
+        values = block.to_numpy(dtype=object)
+        values[pd.isna(block).to_numpy()] = None
+        for row, column in zip(*np.nonzero(block.isin([np.inf, -np.inf]).to_numpy())):
+            values[row, column] = 'inf' if values[row, column] > 0 else '-inf'
+        for label, row_values in zip(block.index, values.tolist()):
+            yield [label, *row_values] if index else row_values
@@ -1,8 +1,42 @@
+import json
+import logging
+import os
+import pstats
+import subprocess
+import sys
+import tempfile
+import tracemalloc
 import unittest
 from itertools import product
+from multiprocessing import shared_memory
 from unittest.mock import MagicMock, patch
 
 from src.analysis import *
+from src.batch import BATCH_REPORT_FILE, get_batch_inputs, get_batch_output_folders, run_batch
+from src.benchmark import (BENCHMARK_RESULTS_FILE, BENCHMARK_SUITES, BenchmarkCase, compare_benchmarks,
+                           get_cell_names, load_benchmark_results, run_benchmarks, write_synthetic_input,
+                           yield_synthetic_blocks)
+from src.cache import get_cache_entry_folder, load_cached_dataframe, read_cache_sidecar
+from src.catalog import CATALOG_FILE, CatalogWriter, RunCatalog
+from src.cli import load_config, main, parse_config, run_from_config
+from src.config import DEFAULT_CONFIG, ScoutsConfig, get_scouts_config
+from src.manifest import MANIFEST_FILE, SELECTIONS_FILE, ManifestWriter, SelectionManifest
+from src.parallel import SampleWorkerPool, get_parallel_sample_results, get_sample_results
+from src.profiling import PROFILE_FILE, PSTATS_FILE, RunProfiler
+from src.progress import CancellationToken, Progress, ProgressReporter, format_progress
+from src.sketch import QuantileSketch, get_sketch_capacity, get_sketch_cutoff_error
+from src.sparse import (SparseFrame, SparseMask, get_column_quantiles, get_sparse_column_stats,
+                        start_scouts_sparse)
+from src.stages import STAGE_CACHE_FOLDER, StageCache
+from src.store import ResultsStore, StoreWriter
+from src.streaming import get_spilled_ranks, get_stats_values, start_scouts_streaming, update_running_stats
+from src.utils import (AnalysisCancelledError, InvalidConfigError, NoIOPathError, NoSampleError, PandasInputError,
+                       SampleNamingError, warn_on_error, write_sidecar_entry)
+from src.writers import MergedWorkbookWriter, WriterPool, get_excel_rows, save_dataframe, write_subset
+
+# Test case files, found next to this module (so that tests can be run from any folder)
+TEST_CASE_XLSX = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-case.xlsx')
+TEST_CASE_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-case.csv')
 
 
 class TestSCOUTSAnalysis(unittest.TestCase):
@@ -17,22 +51,22 @@ class TestSCOUTSAnalysis(unittest.TestCase):
         cls.markers = ['Marker01', 'Marker02', 'Marker03', 'Marker04', 'Marker05']
         cls.tukey = 1.5
         # Test data from test-case.xlsx spreadsheet
-        cls._backup_df = pd.read_excel('test-case.xlsx', sheet_name='raw data')
-        cls.description_df = pd.read_excel('test-case.xlsx', sheet_name='raw data description',
+        cls._backup_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='raw data')
+        cls.description_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='raw data description',
                                            index_col=[0, 1])
-        cls.cytof_df = pd.read_excel('test-case.xlsx', sheet_name='cytof gate 1.5').set_index('Sample')
-        cls.cytof_description_df = pd.read_excel('test-case.xlsx', sheet_name='cytof gate 1.5 description',
+        cls.cytof_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='cytof gate 1.5').set_index('Sample')
+        cls.cytof_description_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='cytof gate 1.5 description',
                                                  index_col=[0, 1])
-        cls.rnaseq_df = pd.read_excel('test-case.xlsx', sheet_name='rnaseq gate 2.0').set_index('Sample')
-        cls.rnaseq_description_df = pd.read_excel('test-case.xlsx', sheet_name='rnaseq gate 2.0 description',
+        cls.rnaseq_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='rnaseq gate 2.0').set_index('Sample')
+        cls.rnaseq_description_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='rnaseq gate 2.0 description',
                                                   index_col=[0, 1])
-        cls.output_cutoff_df = pd.read_excel('test-case.xlsx', sheet_name='raw data cutoff table').set_index('Sample')
-        cls.quantiles_df = pd.read_excel('test-case.xlsx', sheet_name='quantiles', index_col=[0, 1])
-        cls.outr_any_df = pd.read_excel('test-case.xlsx', sheet_name='OutR any', index_col=[0])
-        cls.outr_mk2_df = pd.read_excel('test-case.xlsx', sheet_name='OutR Marker02', index_col=[0])
-        cls.outs_any_df = pd.read_excel('test-case.xlsx', sheet_name='OutS any', index_col=[0])
-        cls.outs_mk2_df = pd.read_excel('test-case.xlsx', sheet_name='OutS Marker02', index_col=[0])
-        cls.stats_df = pd.read_excel('test-case.xlsx', sheet_name='raw data stats', index_col=[0, 1, 2])
+        cls.output_cutoff_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='raw data cutoff table').set_index('Sample')
+        cls.quantiles_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='quantiles', index_col=[0, 1])
+        cls.outr_any_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='OutR any', index_col=[0])
+        cls.outr_mk2_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='OutR Marker02', index_col=[0])
+        cls.outs_any_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='OutS any', index_col=[0])
+        cls.outs_mk2_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='OutS Marker02', index_col=[0])
+        cls.stats_df = pd.read_excel(TEST_CASE_XLSX, sheet_name='raw data stats', index_col=[0, 1, 2])
         # Test data from internal functions
         cls.cutoff_df = cls.get_cutoff_df(cls.description_df)
         cls.cytof_cutoff_df = cls.get_cutoff_df(cls.cytof_description_df)
@@ -41,11 +75,13 @@ class TestSCOUTSAnalysis(unittest.TestCase):
 
     @classmethod
     def get_cutoff_df(cls, df: pd.DataFrame) -> pd.DataFrame:
-        """Used internally for construction of cutoff df, which contains Stats instances."""
-        cutoff_df = pd.DataFrame(columns=cls.markers, index=cls.samples)
+        """Used internally for construction of cutoff df, which contains the values of Stats instances."""
+        columns = pd.MultiIndex.from_product([cls.markers, Stats._fields], names=['marker', 'statistic'])
+        cutoff_df = pd.DataFrame(columns=columns, index=cls.samples, dtype=float)
         for sample in cls.samples:
             for marker in cls.markers:
-                cutoff_df.loc[sample, marker] = cls.build_stats(df=df, sample=sample, marker=marker)
+                stats = cls.build_stats(df=df, sample=sample, marker=marker)
+                cutoff_df.loc[sample, [(marker, field) for field in Stats._fields]] = list(stats)
         return cutoff_df
 
     @staticmethod
@@ -82,11 +118,11 @@ class TestSCOUTSAnalysis(unittest.TestCase):
             self.assertTrue(hasattr(info, attr))
             self.assertEqual(getattr(info, attr), value)
 
+    @patch('src.analysis.RunProfiler')
     @patch('src.analysis.run_scouts')
-    def test_function_start_scouts_marker_and_cutoff_rules(self, mock_run_scouts: MagicMock) -> None:
+    def test_function_start_scouts_marker_and_cutoff_rules(self, mock_run_scouts: MagicMock, _: MagicMock) -> None:
         start_scouts_kwargs = {
-            'widget': 'QMainWindow',
-            'input_file': 'test-case.xlsx',
+            'input_file': TEST_CASE_XLSX,
             'output_folder': '.',
             'cutoff_rule': 'INPUT_VALUE',
             'marker_rule': 'INPUT_VALUE',
@@ -102,7 +138,6 @@ class TestSCOUTSAnalysis(unittest.TestCase):
             'bottom_outliers': False
         }
         expected_kwargs = {
-            'widget': 'QMainWindow',
             'df': self.indexed_df,
             'cutoff_df': 'TEST_CASE',
             'samples': self.samples,
@@ -138,11 +173,11 @@ class TestSCOUTSAnalysis(unittest.TestCase):
             start_scouts(**start_scouts_kwargs)
             self.start_scouts_kwargs_test(expected_kwargs=expected_kwargs, actual_kwargs=mock_run_scouts.call_args[1])
 
+    @patch('src.analysis.RunProfiler')
     @patch('src.analysis.run_scouts')
-    def test_function_start_scouts_gating_rules(self, mock_run_scouts: MagicMock) -> None:
+    def test_function_start_scouts_gating_rules(self, mock_run_scouts: MagicMock, _: MagicMock) -> None:
         start_scouts_kwargs = {
-            'widget': 'QMainWindow',
-            'input_file': 'test-case.xlsx',
+            'input_file': TEST_CASE_XLSX,
             'output_folder': '.',
             'cutoff_rule': 'sample',
             'marker_rule': 'single',
@@ -157,7 +192,6 @@ class TestSCOUTSAnalysis(unittest.TestCase):
             'non_outliers': False,
             'bottom_outliers': False}
         expected_kwargs = {
-            'widget': 'QMainWindow',
             'df': 'TEST_CASE',
             'cutoff_df': 'TEST_CASE',
             'samples': self.samples,
@@ -199,13 +233,56 @@ class TestSCOUTSAnalysis(unittest.TestCase):
                 self.assertEqual(expected_arg, actual_arg)
 
     def test_function_load_dataframe(self) -> None:
-        pd.testing.assert_frame_equal(self.raw_df, load_dataframe('test-case.xlsx'), check_dtype=False)
-        pd.testing.assert_frame_equal(self.raw_df, load_dataframe('test-case.csv'), check_dtype=False)
+        pd.testing.assert_frame_equal(self.raw_df, load_dataframe(TEST_CASE_XLSX), check_dtype=False)
+        pd.testing.assert_frame_equal(self.raw_df, load_dataframe(TEST_CASE_CSV), check_dtype=False)
         with self.assertRaises(FileNotFoundError):
             load_dataframe('this-file-does-not-exist.xlsx')
         with self.assertRaises(PandasInputError):
             load_dataframe('test-case.wrong_extension')
 
+    def test_function_load_indexed_dataframe_float32(self) -> None:
+        for input_file in (TEST_CASE_CSV, TEST_CASE_XLSX):
+            df = load_indexed_dataframe(input_file=input_file, precision='float32')
+            df = set_dataframe_precision(df=df, precision='float32')
+            self.assertTrue(all(dtype == np.float32 for dtype in df.dtypes))
+            self.assertIsInstance(df.index, pd.CategoricalIndex)
+            df.index = df.index.astype(str)
+            pd.testing.assert_frame_equal(df, self.indexed_df, check_dtype=False)
+            self.assertEqual(get_values(df).dtype, np.float32)
+        self.assertIs(set_dataframe_precision(df=self.indexed_df, precision='float64'), self.indexed_df)
+        with self.assertRaises(ValueError):
+            set_dataframe_precision(df=self.indexed_df, precision='float16')
+
+    def test_function_get_gated_input_float32(self) -> None:
+        df = pd.DataFrame({'Sample': ['ct_1', 'ct_2', 'treat_1', 'treat_2'], 'Marker01': [0.1, 1.0, 0.1, 2.0],
+                           'Marker02': [0.1, 3.0, 0.1, 4.0]})  # rows 1 and 3 average exactly 0.1 (float64 only)
+        with tempfile.TemporaryDirectory() as folder:
+            input_file = os.path.join(folder, 'gating.csv')
+            df.to_csv(input_file, index=False)
+            config = ScoutsConfig(input_file=input_file, output_folder=folder, sample_list=[('ct', 'yes')],
+                                  gating='cytof', gate_cutoff_value=0.1, gate_chunk_size=3)
+            expected = get_gated_input(config=config, samples=['ct', 'treat'], progress=ProgressReporter()).df
+            self.assertEqual(list(expected.index), ['ct_2', 'treat_2'])
+            for options in ({}, {'cache_folder': os.path.join(folder, 'cache')}):  # gated while loading, then not
+                run_input = get_gated_input(config=config.replace(precision='float32', **options),
+                                            samples=['ct', 'treat'], progress=ProgressReporter())
+                self.assertTrue(all(dtype == np.float32 for dtype in run_input.df.dtypes))
+                self.assertEqual(run_input.labels, ['ct_1', 'ct_2', 'treat_1', 'treat_2'])
+                pd.testing.assert_frame_equal(run_input.df, set_dataframe_precision(df=expected, precision='float32'))
+
+    def test_function_get_cutoff_dataframe_float32(self) -> None:
+        df = set_dataframe_precision(df=self.indexed_df, precision='float32')
+        sample_index = SampleIndex.from_index(index=df.index, samples=self.samples)
+        cutoff_df = get_cutoff_dataframe(df=df, samples=self.samples, markers=self.markers, reference=None,
+                                         cutoff_rule='sample', tukey=self.tukey, sample_index=sample_index)
+        pd.testing.assert_frame_equal(cutoff_df, self.cutoff_df, check_dtype=False)
+        masks = get_outlier_masks(input_df=df, cutoff_df=cutoff_df, cutoff_from='sample', samples=self.samples,
+                                  bottom_outliers=True, non_outliers=True, sample_index=sample_index)
+        expected_masks = get_outlier_masks(input_df=self.indexed_df, cutoff_df=self.cutoff_df, cutoff_from='sample',
+                                           samples=self.samples, bottom_outliers=True, non_outliers=True)
+        for mask, expected_mask in zip(masks, expected_masks):
+            np.testing.assert_array_equal(mask, expected_mask)
+
     def test_function_get_marker_names(self) -> None:
         marker_names = get_marker_names(df=self.indexed_df)
         self.assertEqual(marker_names, self.markers)
@@ -222,6 +299,9 @@ class TestSCOUTSAnalysis(unittest.TestCase):
         for bad_sample in invalid_samples:
             with self.assertRaises(SampleNamingError):
                 validate_sample_names(samples=[bad_sample], df=self.indexed_df)
+            sample_index = SampleIndex.from_index(index=self.indexed_df.index, samples=[bad_sample])
+            with self.assertRaises(SampleNamingError):
+                validate_sample_names(samples=[bad_sample], df=self.indexed_df, sample_index=sample_index)
 
     def test_function_get_reference_sample_name(self) -> None:
         reference_name = get_reference_sample_name(self.sample_table_data)
@@ -231,9 +311,29 @@ class TestSCOUTSAnalysis(unittest.TestCase):
         apply_cytof_gating(df=self.indexed_df, cutoff=1.5)
         pd.testing.assert_frame_equal(self.indexed_df, self.cytof_df, check_dtype=False)
 
+    def test_function_apply_cytof_gating_by_chunks(self) -> None:
+        for chunk_size in (1, 4, 100):
+            df = self._backup_df.set_index('Sample')
+            report = apply_cytof_gating(df=df, cutoff=1.5, chunk_size=chunk_size)
+            pd.testing.assert_frame_equal(df, self.cytof_df, check_dtype=False)
+            self.assertEqual(report.rows_before, len(self._backup_df))
+            self.assertEqual(report.rows_dropped, len(self._backup_df) - len(self.cytof_df))
+            self.assertGreaterEqual(report.seconds, 0)
+
+    def test_function_apply_cytof_gating_duplicated_labels(self) -> None:
+        df = pd.DataFrame({'Marker01': [0.0, 5.0, 1.0, np.nan]}, index=['ct', 'ct', 'treat', 'treat'])
+        report = apply_cytof_gating(df=df, cutoff=1.0)
+        pd.testing.assert_frame_equal(df, pd.DataFrame({'Marker01': [5.0, np.nan]}, index=['ct', 'treat']))
+        self.assertEqual(report.rows_dropped, 2)
+
+    def test_function_get_cytof_gate_mask(self) -> None:
+        values = np.array([[1.0, 2.0], [0.0, 1.0], [np.nan, 3.0], [np.nan, np.nan]])
+        np.testing.assert_array_equal(get_cytof_gate_mask(values=values, cutoff=1.0), [True, False, True, True])
+
     def test_function_apply_rnaseq_gating(self) -> None:
-        apply_rnaseq_gating(df=self.indexed_df, cutoff=2.0)
+        report = apply_rnaseq_gating(df=self.indexed_df, cutoff=2.0)
         pd.testing.assert_frame_equal(self.indexed_df, self.rnaseq_df, check_dtype=False)
+        self.assertEqual(report.rows_dropped, len(self._backup_df) - len(self.rnaseq_df))
 
     def test_function_get_cutoff_dataframe(self) -> None:
         cutoff = get_cutoff_dataframe(df=self.indexed_df, samples=self.samples, markers=self.markers,
@@ -257,22 +357,160 @@ class TestSCOUTSAnalysis(unittest.TestCase):
             sample_cutoff = get_sample_cutoff(df=self.indexed_df, sample=sample, tukey=self.tukey)
             for index, marker in enumerate(self.markers):
                 stats_instance = sample_cutoff[index]
-                self.assertEqual(stats_instance, self.cutoff_df.loc[sample, marker])
-
-    def test_function_filter_df_by_sample_in_index(self) -> None:
+                self.assertEqual(stats_instance, Stats(*self.cutoff_df.loc[sample, marker]))
+        sorted_values = SortedSampleValues.from_dataframe(df=self.indexed_df, samples=self.samples)
         for sample in self.samples:
-            filtered_df = filter_df_by_sample_in_index(df=self.indexed_df, sample=sample)
-            self.assertTrue(all(sample in i for i in filtered_df.index))
-            for other_sample_name in [s for s in self.samples if s != sample]:
-                self.assertFalse(any(other_sample_name in i for i in filtered_df.index))
+            self.assertEqual(get_sample_cutoff(df=self.indexed_df, sample=sample, tukey=self.tukey,
+                                               sorted_values=sorted_values),
+                             get_sample_cutoff(df=self.indexed_df, sample=sample, tukey=self.tukey))
 
-    def test_function_get_marker_statistics(self) -> None:
+    def test_class_sorted_sample_values(self) -> None:
+        sorted_values = SortedSampleValues.from_dataframe(df=self.indexed_df, samples=self.samples)
+        self.assertEqual(sorted_values.markers, self.markers)
+        quantiles = [0.0, 0.1, 0.25, 0.5, 0.75, 1.0]
+        masks = get_outlier_masks(input_df=self.indexed_df, cutoff_df=self.cutoff_df, cutoff_from='sample',
+                                  samples=self.samples, bottom_outliers=True, non_outliers=False)
         for sample in self.samples:
+            sample_df = self.indexed_df.loc[self.indexed_df.index.str.contains(sample)]
+            np.testing.assert_array_equal(sorted_values.get_quantiles(sample=sample, quantiles=quantiles),
+                                          get_quantiles(values=sample_df.to_numpy(dtype=float), quantiles=quantiles))
+            sample_rows = self.indexed_df.iloc[masks.rows].index.str.contains(sample)
+            top, bottom = sorted_values.count_outliers(sample=sample, tukey=self.tukey)
+            np.testing.assert_array_equal(top, masks.top[sample_rows].sum(axis=0))
+            np.testing.assert_array_equal(bottom, masks.bottom[sample_rows].sum(axis=0))
             for marker in self.markers:
-                marker_series = self.quantiles_df.loc[sample, marker]
-                stats = get_marker_statistics(tukey=self.tukey, marker_series=marker_series)
-                self.assertEqual(stats.lower_cutoff, self.description_df.loc[sample].loc['Lower Tukey fence', marker])
-                self.assertEqual(stats.upper_cutoff, self.description_df.loc[sample].loc['Upper Tukey fence', marker])
+                for value in (-np.inf, sample_df[marker].min(), sample_df[marker].median(), 1e9):
+                    self.assertEqual(sorted_values.count_above(sample=sample, marker=marker, value=value),
+                                     (sample_df[marker] > value).sum())
+                    self.assertEqual(sorted_values.count_below(sample=sample, marker=marker, value=value),
+                                     (sample_df[marker] < value).sum())
+                    self.assertEqual(sorted_values.get_rank(sample=sample, marker=marker, value=value),
+                                     (sample_df[marker] <= value).mean())
+                self.assertEqual(sorted_values.count_above(sample=sample, marker=marker, value=np.nan), 0)
+
+    def test_function_get_sketch_cutoff_dataframe(self) -> None:
+        cutoff_df, cutoff_error_df = get_sketch_cutoff_dataframe(df=self.indexed_df, samples=self.samples,
+                                                                 markers=self.markers, reference=self.reference,
+                                                                 cutoff_rule='sample', tukey=self.tukey, error=0.01)
+        pd.testing.assert_frame_equal(cutoff_df, self.cutoff_df, check_exact=False)
+        self.assertEqual(list(cutoff_error_df.index), self.samples)
+        self.assertEqual(list(cutoff_error_df.columns[:3]), ['rank error', 'Marker01_upper_cutoff',
+                                                             'Marker01_lower_cutoff'])
+        self.assertTrue((cutoff_error_df == 0).all().all())  # small samples are never compacted
+        cutoff_df, _ = get_sketch_cutoff_dataframe(df=self.indexed_df, samples=self.samples, markers=self.markers,
+                                                   reference=self.reference, cutoff_rule='ref', tukey=self.tukey,
+                                                   error=0.01)
+        self.assertEqual(list(cutoff_df.index), [self.reference])
+
+    def test_function_get_cutoff_values(self) -> None:
+        values = self.indexed_df.to_numpy(dtype=float)
+        for tukey in (1.5, 3.0):
+            cutoff_values = get_cutoff_values(values=values, tukey=tukey)
+            first_quartile, third_quartile = self.indexed_df.quantile([0.25, 0.75]).to_numpy()
+            np.testing.assert_array_equal(cutoff_values, get_tukey_cutoff_values(first_quartile=first_quartile,
+                                                                                 third_quartile=third_quartile,
+                                                                                 tukey=tukey))
+
+    def test_function_get_quantiles(self) -> None:
+        rng = np.random.default_rng(0)
+        values = rng.normal(size=(101, 4))
+        values[rng.random(values.shape) < 0.3] = np.nan
+        values[:, 3] = np.nan
+        quantiles = [0.0, 0.1, 0.25, 0.5, 0.75, 1.0]
+        expected = pd.DataFrame(values).quantile(quantiles).to_numpy()
+        np.testing.assert_array_equal(get_quantiles(values=values, quantiles=quantiles), expected)
+
+    def test_function_get_cutoff_array(self) -> None:
+        cutoff_array = get_cutoff_array(self.cutoff_df)
+        self.assertEqual(cutoff_array.shape, (len(self.samples), len(self.markers), len(Stats._fields)))
+        for i, sample in enumerate(self.samples):
+            for j, marker in enumerate(self.markers):
+                self.assertEqual(Stats(*cutoff_array[i, j]), Stats(*self.cutoff_df.loc[sample, marker]))
+
+    def test_function_get_tukey_cutoff_dataframe(self) -> None:
+        for tukey in [0.0, 1.5, 3.0]:
+            expected = get_cutoff_dataframe(df=self.indexed_df, samples=self.samples, markers=self.markers,
+                                            reference=None, cutoff_rule='sample', tukey=tukey)
+            pd.testing.assert_frame_equal(get_tukey_cutoff_dataframe(cutoff_df=self.cutoff_df, tukey=tukey), expected,
+                                          check_exact=True)
+
+    @patch('src.analysis.get_cutoff_dataframe', side_effect=get_cutoff_dataframe)
+    def test_function_run_tukey_sweep(self, mock_cutoff: MagicMock) -> None:
+        config = {'input_file': TEST_CASE_CSV, 'samples': self.samples, 'reference': self.reference,
+                  'cutoff_rule': 'sample ref', 'marker_rule': 'single any', 'bottom_outliers': True}
+        with tempfile.TemporaryDirectory() as output_folder:
+            run_from_config({**config, 'output_folder': output_folder, 'tukey_sweep': [3.0, 1.5, 0.5]})
+            mock_cutoff.assert_called_once()
+            sweep_df = pd.read_excel(os.path.join(output_folder, 'tukey_sweep.xlsx'), keep_default_na=False)
+            self.assertEqual(list(sweep_df.columns[-3:]), ['cells (tukey 3)', 'cells (tukey 1.5)', 'cells (tukey 0.5)'])
+            for tukey in [3.0, 1.5, 0.5]:
+                factor_folder = os.path.join(output_folder, get_tukey_folder_name(tukey))
+                expected_folder = os.path.join(output_folder, f'expected_{tukey}')
+                os.mkdir(expected_folder)
+                run_from_config({**config, 'output_folder': expected_folder, 'tukey_factor': tukey})
+                for name in ['summary.xlsx', 'cutoff_values.xlsx', 'stats.xlsx']:
+                    for sheet_name, expected in pd.read_excel(os.path.join(expected_folder, name), None).items():
+                        pd.testing.assert_frame_equal(pd.read_excel(os.path.join(factor_folder, name), sheet_name),
+                                                      expected)
+                summary_df = pd.read_excel(os.path.join(expected_folder, 'summary.xlsx'), keep_default_na=False)
+                pd.testing.assert_frame_equal(sweep_df[summary_df.columns], summary_df)
+                for number in summary_df['file number']:
+                    expected = pd.read_csv(os.path.join(expected_folder, 'data', '%04d.csv' % number))
+                    pd.testing.assert_frame_equal(pd.read_csv(os.path.join(factor_folder, 'data', '%04d.csv' % number)),
+                                                  expected)
+                    self.assertEqual(sweep_df.loc[number - 1, f'cells (tukey {tukey:g})'], len(expected))
+
+    def test_function_count_subsets(self) -> None:
+        for cutoff_rule, marker_rule, bottom, non in product(['ref', 'sample', 'ref sample'],
+                                                             ['any', 'single', 'any single'], [True, False],
+                                                             [True, False]):
+            subsets = yield_dataframes(input_df=self.indexed_df, samples=self.samples, markers=self.markers,
+                                       reference=self.reference, cutoff_df=self.cutoff_df, cutoff_rule=cutoff_rule,
+                                       marker_rule=marker_rule, non_outliers=non, bottom_outliers=bottom,
+                                       select=select_mask)
+            self.assertEqual(count_subsets(markers=self.markers, cutoff_rule=cutoff_rule, marker_rule=marker_rule,
+                                           bottom_outliers=bottom, non_outliers=non), len(list(subsets)))
+
+    def test_class_sample_index(self) -> None:
+        index = pd.Index(['ct_1', 'ct_2', 'treat_1', 'ct_3', 'ct', 'treat.2', 'other'])
+        expected_positions = {
+            'exact': {'ct': [4], 'treat.': []},
+            'substring': {'ct': [0, 1, 3, 4], 'treat.': [5]},
+            'regex': {'ct': [0, 1, 3, 4], 'treat.': [2, 5]},
+        }
+        for match_mode, positions in expected_positions.items():
+            sample_index = SampleIndex.from_index(index=index, samples=list(positions), match_mode=match_mode)
+            for sample, sample_positions in positions.items():
+                np.testing.assert_array_equal(sample_index.get_positions(sample), sample_positions)
+        with self.assertRaises(ValueError):
+            SampleIndex.from_index(index=index, samples=['ct'], match_mode='fuzzy')
+        with self.assertRaises(InvalidConfigError):
+            SampleIndex.from_index(index=index, samples=['a('], match_mode='regex')
+
+    def test_method_sample_index_make_contiguous(self) -> None:
+        df = self.indexed_df.iloc[[0, 5, 10, 1, 6, 11, 2, 7, 12, 3, 8, 13, 4, 9, 14]]
+        sample_index = SampleIndex.from_index(index=df.index, samples=self.samples)
+        self.assertIsNone(sample_index.get_slice('ct'))
+        reordered_df, reordered_index = sample_index.make_contiguous(df)
+        pd.testing.assert_frame_equal(reordered_df, self.indexed_df)
+        for sample in self.samples:
+            self.assertIsNotNone(reordered_index.get_slice(sample))
+            pd.testing.assert_frame_equal(reordered_index.filter(df=reordered_df, sample=sample),
+                                          sample_index.filter(df=df, sample=sample))
+        overlapping_index = SampleIndex.from_index(index=df.index, samples=['ct', 'ct_1'])
+        with self.assertRaises(InvalidConfigError):
+            overlapping_index.make_contiguous(df)
+
+    def test_function_get_tukey_cutoff_values(self) -> None:
+        for sample in self.samples:
+            first_quartile, third_quartile = self.quantiles_df.loc[sample, self.markers].to_numpy(dtype=float)
+            stats = get_tukey_cutoff_values(first_quartile=first_quartile, third_quartile=third_quartile,
+                                            tukey=self.tukey)
+            description = self.description_df.loc[sample]
+            np.testing.assert_array_equal(stats[:, LOWER_CUTOFF],
+                                          description.loc['Lower Tukey fence', self.markers].to_numpy(dtype=float))
+            np.testing.assert_array_equal(stats[:, UPPER_CUTOFF],
+                                          description.loc['Upper Tukey fence', self.markers].to_numpy(dtype=float))
 
     def test_function_run_scouts(self) -> None:
         # TODO: how to test this? (central function)
@@ -312,15 +550,48 @@ class TestSCOUTSAnalysis(unittest.TestCase):
                                                                        'OutR any marker']))
         self.assertEqual(len(df_dict['OutR single marker']), 4 * len(self.samples) * 4)
 
-    def test_function_add_whole_population_to_stats_dfs(self) -> None:
-        # OutS any marker, no bottom, no non
-        df_dict = create_stats_dfs(markers=self.markers, cutoff_rule='sample', marker_rule='any',
-                                   samples=self.samples, bottom=True, non=False)
-        for sample in self.samples:
-            self.assertTrue(df.loc[sample].loc['whole population'].isnull().all() for df in df_dict.values())
-        add_whole_population_to_stats_dfs(input_df=self.indexed_df, stats_df_dict=df_dict, samples=self.samples)
-        for sample in self.samples:
-            self.assertTrue(not df.loc[sample].loc['whole population'].isnull().all() for df in df_dict.values())
+    def test_function_get_stats_populations(self) -> None:
+        self.assertEqual(get_stats_populations(bottom=False, non=False), ['whole population', 'top outliers'])
+        self.assertEqual(get_stats_populations(bottom=True, non=True),
+                         ['whole population', 'top outliers', 'non-outliers', 'bottom outliers'])
+
+    def test_function_get_stats_dfs(self) -> None:
+        kwargs = {'input_df': self.indexed_df, 'cutoff_df': self.cutoff_df, 'cutoff_rule': 'sample ref',
+                  'samples': self.samples, 'bottom_outliers': True, 'non_outliers': True}
+        masks = get_masks_by_cutoff_source(reference=self.samples[0], **kwargs)
+        df_dict = get_stats_dfs(input_df=self.indexed_df, masks=masks, markers=self.markers,
+                                cutoff_rule='sample ref', marker_rule='single any', samples=self.samples,
+                                bottom=True, non=True)
+        self.assertEqual(list(df_dict), ['OutS any marker', 'OutS single marker', 'OutR any marker',
+                                         'OutR single marker'])
+        empty_dict = create_stats_dfs(markers=self.markers, cutoff_rule='sample ref', marker_rule='single any',
+                                      samples=self.samples, bottom=True, non=True)
+        for key, df in df_dict.items():
+            pd.testing.assert_index_equal(df.index, empty_dict[key].index)
+            pd.testing.assert_index_equal(df.columns, empty_dict[key].columns)
+        for population in ['whole population', 'top outliers', 'bottom outliers']:  # non-outliers are incomplete
+            pd.testing.assert_frame_equal(df_dict['OutS single marker'].xs(population, level=1),
+                                          self.stats_df.xs(population, level=1).loc[self.samples],
+                                          check_dtype=False, check_names=False)
+        for data, info in yield_dataframes(input_df=self.indexed_df, samples=self.samples, markers=self.markers,
+                                           reference=self.samples[0], cutoff_df=self.cutoff_df,
+                                           cutoff_rule='sample ref', marker_rule='single any', non_outliers=True,
+                                           bottom_outliers=True):
+            columns = self.markers if 'any' in info.outliers_for else [info.outliers_for]
+            for sample in self.samples:
+                description = data.loc[data.index.str.contains(sample)].describe()
+                values = description.loc[['count', 'mean', '50%', 'std'], columns].values.astype(float)
+                stats = df_dict[get_key_from_info(info)].loc[(sample, info.category), columns].values
+                np.testing.assert_allclose(stats, values)
+
+    def test_function_get_masked_stats(self) -> None:
+        values = np.array([[1.0, np.nan], [2.0, 5.0], [6.0, 7.0]])
+        mask = np.array([[True, True], [True, False], [False, True]])
+        expected = np.array([[2, 1], [1.5, 7.0], [1.5, 7.0], [np.sqrt(0.5), np.nan]])
+        np.testing.assert_allclose(get_masked_stats(values=values, mask=mask), expected)
+        stats = get_masked_stats(values=values, mask=np.zeros((3, 1), dtype=bool))
+        np.testing.assert_array_equal(stats[0], [0, 0])
+        self.assertTrue(np.isnan(stats[1:]).all())
 
     @patch('src.analysis.scouts_by_sample_single_marker')
     @patch('src.analysis.scouts_by_sample_any_marker')
@@ -391,6 +662,48 @@ class TestSCOUTSAnalysis(unittest.TestCase):
         self.assertEqual(info, Info(cutoff_from='sample', reference='n/a', outliers_for='Marker02',
                                     category='top outliers'))
 
+    def test_function_get_outlier_masks(self) -> None:
+        masks = get_outlier_masks(input_df=self.indexed_df, cutoff_df=self.cutoff_df, cutoff_from='sample',
+                                  samples=self.samples, bottom_outliers=True, non_outliers=True)
+        index = self.indexed_df.index
+        stacked_df = pd.concat([self.indexed_df.loc[index.str.contains(sample)] for sample in self.samples])
+        pd.testing.assert_frame_equal(self.indexed_df.iloc[masks.rows], stacked_df)
+        for i, sample in enumerate(self.samples):
+            sample_rows = self.indexed_df.iloc[masks.rows].index.str.contains(sample)
+            sample_df = stacked_df.loc[sample_rows]
+            lower = self.cutoff_df.loc[sample, (slice(None), 'lower_cutoff')].values
+            upper = self.cutoff_df.loc[sample, (slice(None), 'upper_cutoff')].values
+            np.testing.assert_array_equal(masks.top[sample_rows], sample_df > upper)
+            np.testing.assert_array_equal(masks.bottom[sample_rows], sample_df < lower)
+            np.testing.assert_array_equal(masks.non[sample_rows], (sample_df <= upper) & (sample_df >= lower))
+        masks = get_outlier_masks(input_df=self.indexed_df, cutoff_df=self.cutoff_df, cutoff_from='reference',
+                                  samples=[self.reference], bottom_outliers=False, non_outliers=False)
+        np.testing.assert_array_equal(masks.rows, np.arange(len(self.indexed_df)))
+        self.assertIsNone(masks.bottom)
+        self.assertIsNone(masks.non)
+
+    def test_function_scouts_subsets_from_shared_masks(self) -> None:
+        masks = get_masks_by_cutoff_source(input_df=self.indexed_df, cutoff_df=self.cutoff_df,
+                                           cutoff_rule='sample ref', samples=self.samples, reference=self.reference,
+                                           bottom_outliers=True, non_outliers=True)
+        self.assertEqual(sorted(masks), ['reference', 'sample'])
+        kwargs = {'input_df': self.indexed_df, 'samples': self.samples, 'markers': self.markers,
+                  'reference': self.reference, 'cutoff_df': self.cutoff_df, 'cutoff_rule': 'sample ref',
+                  'marker_rule': 'single any', 'non_outliers': True, 'bottom_outliers': True}
+        expected = list(yield_dataframes(**kwargs))
+        with patch('src.analysis.get_outlier_masks') as mock_get_outlier_masks:
+            result = list(yield_dataframes(**kwargs, masks=masks))
+            mock_get_outlier_masks.assert_not_called()
+        self.assertEqual(len(result), len(expected))
+        for (expected_df, expected_info), (df, info) in zip(expected, result):
+            pd.testing.assert_frame_equal(expected_df, df)
+            self.assertEqual(expected_info, info)
+        bottom_df, _ = list(scouts_by_reference_single_marker(input_df=self.indexed_df, cutoff_df=self.cutoff_df,
+                                                              markers=['Marker02'], reference=self.reference,
+                                                              bottom_outliers=True, non_outliers=False))[1]
+        lower = self.cutoff_df.loc[self.reference, ('Marker02', 'lower_cutoff')]
+        pd.testing.assert_frame_equal(bottom_df, self.indexed_df.loc[self.indexed_df['Marker02'] < lower])
+
     def test_function_add_scouts_data_to_summary(self) -> None:
         columns = ['file number'] + list(Info._fields)
         df = pd.DataFrame(columns=columns)
@@ -404,30 +717,6 @@ class TestSCOUTSAnalysis(unittest.TestCase):
             df = add_scouts_data_to_summary(df=df, i=i, info=info)
             self.assertTrue(len(df), i)
 
-    def test_function_add_scouts_data_to_stats(self) -> None:
-        df_dict = create_stats_dfs(markers=self.markers, cutoff_rule='sample', marker_rule='single',
-                                   samples=self.samples, bottom=False, non=False)
-        data, info = list(scouts_by_sample_single_marker(input_df=self.indexed_df, cutoff_df=self.cutoff_df,
-                                                         samples=self.samples, markers=['Marker02'],
-                                                         bottom_outliers=False, non_outliers=False))[0]
-        add_scouts_data_to_stats(data=data, samples=self.samples, stats_df_dict=df_dict, info=info)
-        df = df_dict['OutS single marker']
-        for sample in self.samples:
-            values = get_values_df_or_series(data, sample, info)
-            pd.testing.assert_series_equal(df.loc[(sample, info.category), info.outliers_for], values,
-                                           check_dtype=False)
-            pd.testing.assert_series_equal(self.stats_df.loc[(sample, info.category), info.outliers_for], values,
-                                           check_dtype=False)
-
-    def test_function_get_values_df(self) -> None:
-        data, info = list(scouts_by_sample_single_marker(input_df=self.indexed_df, cutoff_df=self.cutoff_df,
-                                                         samples=self.samples, markers=['Marker02'],
-                                                         bottom_outliers=False, non_outliers=False))[0]
-        for sample in self.samples:
-            values = get_values_df_or_series(data=data, sample=sample, info=info)
-            pd.testing.assert_series_equal(self.stats_df.loc[(sample, info.category), info.outliers_for], values,
-                                           check_dtype=False)
-
     def test_function_get_key_from_info(self) -> None:
         info = Info(cutoff_from='sample', reference='', outliers_for='any marker', category='')
         self.assertEqual('OutS any marker', get_key_from_info(info))
@@ -466,6 +755,17 @@ class TestSCOUTSAnalysis(unittest.TestCase):
         expected_kwargs = {'sheet_name': 'Cutoff', 'index_label': 'Sample'}
         mock_to_excel.assert_called_with(*expected_args, **expected_kwargs)
 
+    def test_function_generate_cutoff_table_with_error_bound(self) -> None:
+        cutoff_df, cutoff_error_df = get_sketch_cutoff_dataframe(df=self.indexed_df, samples=self.samples,
+                                                                 markers=self.markers, reference=self.reference,
+                                                                 cutoff_rule='sample', tukey=self.tukey, error=0.01)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'cutoff_values.xlsx')
+            generate_cutoff_table(cutoff_df=cutoff_df, cutoff_path=path, cutoff_error_df=cutoff_error_df)
+            sheets = pd.read_excel(path, sheet_name=None, index_col=0)
+        self.assertEqual(list(sheets), ['Cutoff', 'Error bound'])
+        pd.testing.assert_frame_equal(sheets['Error bound'], cutoff_error_df, check_names=False, check_dtype=False)
+
     def test_function_get_output_cutoff_df(self) -> None:
         output_cutoff_df = get_output_cutoff_df(cutoff_df=self.cutoff_df, columns=self.output_cutoff_df.columns)
         pd.testing.assert_frame_equal(output_cutoff_df, self.output_cutoff_df, check_names=False, check_dtype=False)
@@ -478,33 +778,986 @@ class TestSCOUTSAnalysis(unittest.TestCase):
         expected_kwargs = {'sheet_name': 'Gated Population', 'index': False}
         mock_to_excel.assert_called_with(*expected_args, **expected_kwargs)
 
-    @patch('src.analysis.read_excel_data')
-    def test_function_merge_excel_files(self, mock_read_excel_data: MagicMock) -> None:
-        output_path = 'some/path/to/folder/subfolder'
-        summary_path = 'some/path/to/summary.xlsx'
-        excels = ['some.xlsx', 'excel.xslx', 'file.xlsx', 'names.xlsx']
-        mock_sheet = [['A1', 'B1', 'C1'], ['A2', 'B2', 'C2']]
-        mock_read_excel_data.return_value = mock_sheet
-        wb = merge_excel_files(output_path=output_path, summary_path=summary_path, excels=excels)
-        self.assertEqual(len(wb.sheetnames), len(excels) + 1)
-        for sheet in wb.sheetnames:
-            for row, mock_row in zip(wb[sheet].iter_rows(), mock_sheet):
-                for cell, mock_cell_value in zip(row, mock_row):
-                    self.assertEqual(cell.value, mock_cell_value)
-
-    @patch('src.analysis.load_workbook')
-    def test_function_read_excel_data(self, mock_load_workbook: MagicMock) -> None:
-        path = 'some/path/to/file.xlsx'
-        wb = Workbook()
-        ws = wb.active
-        ws.cell(row=1, column=1, value='a')
-        ws.cell(row=1, column=2, value='b')
-        ws.cell(row=2, column=1, value='c')
-        ws.cell(row=2, column=2, value='d')
-        mock_load_workbook.return_value = wb
-        result = read_excel_data(path=path)
-        self.assertEqual(result, [['a', 'b'], ['c', 'd']])
-        mock_load_workbook.assert_called_once_with(path)
+
+class TestSCOUTSSketch(unittest.TestCase):
+    """Tests all functions and classes from src.sketch module."""
+    def setUp(self) -> None:
+        """Creates random values (with some missing values) for each test."""
+        random_state = np.random.RandomState(42)
+        self.values = random_state.lognormal(size=(20000, 3))
+        self.values[random_state.rand(*self.values.shape) < 0.05] = np.nan
+
+    def test_class_quantile_sketch_exact(self) -> None:
+        sketch = QuantileSketch(capacity=len(self.values) + 1)
+        sketch.update(self.values)
+        self.assertEqual(sketch.rank_error, 0)
+        np.testing.assert_array_equal(sketch.quantiles([0.25, 0.75]), get_quantiles(self.values, [0.25, 0.75]))
+
+    def test_class_quantile_sketch_error_bound(self) -> None:
+        sketches = [QuantileSketch.from_error(error=0.01) for _ in range(4)]
+        for i, sketch in enumerate(sketches):
+            sketch.update(self.values[i::4])
+        for sketch in sketches[1:]:
+            sketches[0].merge(sketch)
+        sketch = sketches[0]
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertGreater(sketch.rank_error, 0)
+        self.assertLessEqual(sketch.error, 0.01)
+        self.assertLess(sum(len(level) for level in sketch.levels), len(self.values))
+        for column, quantiles in enumerate(sketch.quantiles([0.25, 0.75]).T):
+            column_values = np.sort(self.values[~np.isnan(self.values[:, column]), column])
+            for quantile, estimate in zip([0.25, 0.75], quantiles):
+                rank = np.searchsorted(column_values, estimate)
+                self.assertLessEqual(abs(rank - quantile * (len(column_values) - 1)), sketch.rank_error + 1)
+        cutoff_errors = get_sketch_cutoff_error(sketch=sketch, tukey=1.5)
+        exact_cutoffs = get_cutoff_values(values=self.values, tukey=1.5)[:, [LOWER_CUTOFF, UPPER_CUTOFF]]
+        estimated_cutoffs = get_sketch_cutoff_values(sketch=sketch, tukey=1.5)[:, [LOWER_CUTOFF, UPPER_CUTOFF]]
+        self.assertTrue((np.abs(exact_cutoffs - estimated_cutoffs) <= cutoff_errors).all())
+        with self.assertRaises(ValueError):
+            sketch.merge(QuantileSketch(capacity=10))
+
+    def test_function_get_sketch_capacity(self) -> None:
+        self.assertLess(get_sketch_capacity(error=0.01), get_sketch_capacity(error=0.001))
+        for error in [0, 1]:
+            with self.assertRaises(ValueError):
+                get_sketch_capacity(error=error)
+
+
+class TemporaryFolderTestCase(unittest.TestCase):
+    """Base class of the tests that write files: each test gets its own temporary folder (self.folder), which is
+    removed after the test. Also builds the configurations used to run SCOUTS on the test case."""
+    def setUp(self) -> None:
+        """Creates a temporary folder for each test."""
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        """Removes the temporary folder."""
+        self.folder.cleanup()
+
+    def copy_test_case(self) -> str:
+        """Copies the test case (as a .csv file) to the temporary folder, returning its path."""
+        path = os.path.join(self.folder.name, 'test-case.csv')
+        pd.read_csv(TEST_CASE_CSV).to_csv(path, index=False)
+        return path
+
+    def get_config(self, **options: Any) -> Dict[str, Any]:
+        """Returns a configuration (as read by run_from_config) for the test case, with the temporary folder as
+        output folder and some options changed."""
+        return {'input_file': TEST_CASE_CSV, 'output_folder': self.folder.name, 'samples': ['ct', 'treat', 'patient'],
+                'reference': 'ct', **options}
+
+    @staticmethod
+    def get_kwargs(input_file: str, **options: Any) -> Dict[str, Any]:
+        """Returns the keyword arguments (besides the output folder) of a start_scouts call for an input file with
+        the samples of the test case, with some options changed."""
+        return {'input_file': input_file, 'cutoff_rule': 'sample ref', 'marker_rule': 'single any', 'tukey_factor': 1.5,
+                'export_csv': True, 'sample_list': [('ct', 'yes'), ('treat', 'no'), ('patient', 'no')],
+                'non_outliers': True, 'bottom_outliers': True, **options}
+
+
+class TestSCOUTSCache(TemporaryFolderTestCase):
+    """Tests all functions from src.cache module."""
+    def setUp(self) -> None:
+        """Copies the test case to a temporary folder, which also holds the cache folder."""
+        super().setUp()
+        self.input_file = self.copy_test_case()
+        self.cache_folder = os.path.join(self.folder.name, 'cache')
+
+    def test_function_write_sidecar_entry(self) -> None:
+        logger = logging.getLogger('scouts-test')
+
+        def fail() -> None:
+            raise OSError('disk full')
+
+        with self.assertLogs(logger, level='WARNING') as logs:
+            with warn_on_error(logger=logger, message='could not save entry'):
+                write_sidecar_entry(folder=self.cache_folder, write_data=fail, sidecar={'key': 1})
+        self.assertEqual(logs.output, ['WARNING:scouts-test:could not save entry: disk full'])
+        self.assertIsNone(read_cache_sidecar(entry_folder=self.cache_folder))  # no sidecar without its data
+        write_sidecar_entry(folder=self.cache_folder, write_data=lambda: None, sidecar={'key': 1})
+        self.assertEqual(read_cache_sidecar(entry_folder=self.cache_folder), {'key': 1})
+
+    def test_function_load_cached_dataframe(self) -> None:
+        loader = MagicMock(side_effect=load_indexed_dataframe)
+        expected = load_indexed_dataframe(self.input_file)
+        for _ in range(2):
+            df = load_cached_dataframe(input_file=self.input_file, cache_folder=self.cache_folder, loader=loader)
+            pd.testing.assert_frame_equal(df, expected)
+        loader.assert_called_once()
+        self.assertIsInstance(df.values.base.base, np.memmap)
+        df.iloc[0, 0] = -1.0  # copy-on-write: the cached values are not changed
+        df = load_cached_dataframe(input_file=self.input_file, cache_folder=self.cache_folder, loader=loader)
+        pd.testing.assert_frame_equal(df, expected)
+        self.assertTrue(os.path.isdir(get_cache_entry_folder(self.input_file, self.cache_folder)))
+
+    def test_function_load_cached_dataframe_precision(self) -> None:
+        loader = MagicMock(side_effect=load_indexed_dataframe)
+        for precision in ['float64', 'float32', 'float64', 'float32']:
+            df = load_cached_dataframe(input_file=self.input_file, cache_folder=self.cache_folder, loader=loader,
+                                       precision=precision)
+            expected = load_indexed_dataframe(self.input_file, precision=precision)
+            pd.testing.assert_frame_equal(set_dataframe_precision(df=df, precision=precision),
+                                          set_dataframe_precision(df=expected, precision=precision))
+        self.assertTrue(all(dtype == np.float32 for dtype in df.dtypes))
+        self.assertEqual([call[1]['precision'] for call in loader.call_args_list], ['float64', 'float32'])
+
+    def test_function_load_cached_dataframe_stale_entry(self) -> None:
+        loader = MagicMock(side_effect=load_indexed_dataframe)
+        load_cached_dataframe(input_file=self.input_file, cache_folder=self.cache_folder, loader=loader)
+        changed_df = pd.read_csv(self.input_file)
+        changed_df.iloc[0, 1] += 1  # same size and file name, different contents
+        stat = os.stat(self.input_file)
+        changed_df.to_csv(self.input_file, index=False)
+        os.utime(self.input_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        df = load_cached_dataframe(input_file=self.input_file, cache_folder=self.cache_folder, loader=loader)
+        self.assertEqual(loader.call_count, 2)
+        pd.testing.assert_frame_equal(df, changed_df.set_index(changed_df.columns[0]))
+
+
+class TestSCOUTSStages(TemporaryFolderTestCase):
+    """Tests all classes from src.stages module, and how start_scouts reuses stages."""
+    def setUp(self) -> None:
+        """Copies the test case to a temporary folder, which also holds the output folders."""
+        super().setUp()
+        self.input_file = self.copy_test_case()
+        self.config = self.get_config(input_file=self.input_file, cutoff_rule='sample ref', marker_rule='any',
+                                      gating='cytof', gate_cutoff_value=0.1, reuse_stages=True)
+
+    def test_class_stage_cache(self) -> None:
+        stage_folder = os.path.join(self.folder.name, STAGE_CACHE_FOLDER)
+        df = load_indexed_dataframe(self.input_file)
+        stage_cache = StageCache(folder=stage_folder, input_file=self.input_file)
+        columns = pd.MultiIndex.from_product([['CD4', 'CD8'], ['Q1', 'Q3']], names=['marker', 'statistic'])
+        cutoff_df = pd.DataFrame(np.arange(8.0).reshape(2, 4), index=['Sample A', 'Sample B'], columns=columns)
+        mask = np.array([True, False, True])
+        self.assertIsNone(stage_cache.load_frames(stage='cutoffs', key={'tukey_factor': 1.5}))
+        stage_cache.save_frames(stage='cutoffs', key={'tukey_factor': 1.5}, frames=[cutoff_df, None])
+        stage_cache.save(stage='masks', key={'tukey_factor': 1.5}, arrays={'sample.top': mask}, info=['sample'])
+        stage_cache.save_dataframe(stage='gated', key={'gating': 'no_gate'}, df=df)
+        stage_cache = StageCache(folder=stage_folder, input_file=self.input_file)
+        saved_cutoff_df, saved_error_df = stage_cache.load_frames(stage='cutoffs', key={'tukey_factor': 1.5})
+        pd.testing.assert_frame_equal(saved_cutoff_df, cutoff_df)
+        self.assertIsNone(saved_error_df)
+        saved_masks = stage_cache.load(stage='masks', key={'tukey_factor': 1.5})
+        np.testing.assert_array_equal(saved_masks.arrays['sample.top'], mask)
+        self.assertEqual(saved_masks.info, ['sample'])
+        self.assertIsNone(stage_cache.load_frames(stage='cutoffs', key={'tukey_factor': 3.0}))
+        pd.testing.assert_frame_equal(stage_cache.load_dataframe(stage='gated', key={'gating': 'no_gate'}), df)
+        self.assertIsNone(stage_cache.load_dataframe(stage='gated', key={'gating': 'cytof'}))
+        df.iloc[0, 0] += 1
+        df.to_csv(self.input_file)  # changed input file: nothing is reused
+        stage_cache = StageCache(folder=stage_folder, input_file=self.input_file)
+        self.assertIsNone(stage_cache.load_frames(stage='cutoffs', key={'tukey_factor': 1.5}))
+        self.assertIsNone(stage_cache.load_dataframe(stage='gated', key={'gating': 'no_gate'}))
+
+    @patch('src.analysis.get_masks_by_cutoff_source', side_effect=get_masks_by_cutoff_source)
+    @patch('src.analysis.get_cutoff_dataframe', side_effect=get_cutoff_dataframe)
+    @patch('src.analysis.load_indexed_dataframe', side_effect=load_indexed_dataframe)
+    def test_function_start_scouts_reuse_stages(self, mock_load: MagicMock, mock_cutoff: MagicMock,
+                                                mock_masks: MagicMock) -> None:
+        output_folder = os.path.join(self.folder.name, 'output')
+        os.mkdir(output_folder)
+        runs = [({}, 1, 1, 1),  # first run: every stage is computed
+                ({'marker_rule': 'single any'}, 0, 0, 0),  # only the marker rule changed: nothing is computed
+                ({'marker_rule': 'single any', 'non_outliers': True}, 0, 0, 1),  # masks are computed again
+                ({'marker_rule': 'single any', 'tukey_factor': 3.0}, 0, 1, 1),  # cutoffs and masks are computed
+                ({'marker_rule': 'single any', 'gate_cutoff_value': 0.2}, 1, 1, 1)]  # everything is computed
+        for i, (options, loads, cutoffs, masks) in enumerate(runs):
+            run_from_config({**self.config, 'output_folder': output_folder, **options})
+            self.assertEqual((mock_load.call_count, mock_cutoff.call_count, mock_masks.call_count),
+                             (loads, cutoffs, masks))
+            expected_folder = os.path.join(self.folder.name, f'expected_{i}')
+            os.mkdir(expected_folder)
+            run_from_config({**self.config, 'output_folder': expected_folder, **options, 'reuse_stages': False})
+            for name in ['summary.xlsx', 'cutoff_values.xlsx', 'stats.xlsx']:
+                for sheet_name, expected in pd.read_excel(os.path.join(expected_folder, name), None).items():
+                    pd.testing.assert_frame_equal(pd.read_excel(os.path.join(output_folder, name), sheet_name),
+                                                  expected)
+            for name in os.listdir(os.path.join(expected_folder, 'data')):
+                pd.testing.assert_frame_equal(pd.read_csv(os.path.join(output_folder, 'data', name)),
+                                              pd.read_csv(os.path.join(expected_folder, 'data', name)))
+            for mock in (mock_load, mock_cutoff, mock_masks):
+                mock.reset_mock()
+
+
+class TestSCOUTSManifest(TemporaryFolderTestCase):
+    """Tests all classes from src.manifest module."""
+    def test_class_selection_manifest(self) -> None:
+        run_from_config({'input_file': TEST_CASE_CSV, 'output_folder': self.folder.name,
+                         'samples': ['ct', 'treat', 'patient'], 'reference': 'ct', 'cutoff_rule': 'sample ref',
+                         'marker_rule': 'single any', 'non_outliers': True, 'bottom_outliers': True,
+                         'gating': 'cytof', 'gate_cutoff_value': 1.5, 'export_manifest': True})
+        data_folder = os.path.join(self.folder.name, 'data')
+        summary_df = pd.read_excel(os.path.join(self.folder.name, 'summary.xlsx'))
+        with SelectionManifest(data_folder) as manifest:
+            self.assertEqual(manifest.numbers, list(summary_df['file number']))
+            for number in manifest.numbers:
+                expected = pd.read_csv(os.path.join(data_folder, '%04d.csv' % number), index_col=0)
+                result = manifest.get_subset(number)
+                pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+                self.assertEqual(manifest.get_info(number)['count'], len(expected))
+            self.assertEqual(len(manifest.get_matrix()), len(self.cytof_gated_rows()))
+
+    def test_class_manifest_writer(self) -> None:
+        matrix = pd.DataFrame({'Marker01': [1.0, 2.0, 3.0]}, index=['ct_1', 'ct_2', 'ct_3'])
+        rows = np.array([2, 0, 1])
+        info = {'category': 'top outliers'}
+        with ManifestWriter(folder=self.folder.name, matrix=matrix) as manifest_writer:
+            manifest_writer.add(number=1, rows=rows, mask=np.array([True, False, True]), info=info)
+            manifest_writer.add(number=2, rows=rows, mask=np.array([False, True, False]), info=info)
+            manifest_writer.add(number=3, rows=np.arange(3), mask=np.array([False, True, True]), info=info)
+        with SelectionManifest(self.folder.name) as manifest:
+            self.assertEqual(sorted(manifest.selections.files), ['0001', '0002', '0003', 'rows_0'])
+            np.testing.assert_array_equal(manifest.get_positions(1), [2, 1])
+            np.testing.assert_array_equal(manifest.get_positions(2), [0])
+            pd.testing.assert_frame_equal(manifest.get_subset(3), matrix.iloc[[1, 2]])
+        os.remove(os.path.join(self.folder.name, MANIFEST_FILE))
+        with self.assertRaises(ValueError):
+            with ManifestWriter(folder=self.folder.name, matrix=matrix) as manifest_writer:
+                manifest_writer.add(number=1, rows=rows, mask=np.array([True, False, True]), info=info)
+                raise ValueError
+        self.assertTrue(os.path.isfile(os.path.join(self.folder.name, SELECTIONS_FILE)))
+        self.assertFalse(os.path.isfile(os.path.join(self.folder.name, MANIFEST_FILE)))
+
+    @staticmethod
+    def cytof_gated_rows() -> pd.DataFrame:
+        """Returns the rows of the test case that pass the Mass Cytometry gate used above."""
+        df = pd.read_csv(TEST_CASE_CSV, index_col=0)
+        apply_cytof_gating(df=df, cutoff=1.5)
+        return df
+
+
+class TestSCOUTSStore(TemporaryFolderTestCase):
+    """Tests all classes from src.store module."""
+    def test_class_results_store(self) -> None:
+        run_from_config({'input_file': TEST_CASE_CSV, 'output_folder': self.folder.name,
+                         'samples': ['ct', 'treat', 'patient'], 'reference': 'ct', 'cutoff_rule': 'sample ref',
+                         'marker_rule': 'single any', 'non_outliers': True, 'bottom_outliers': True,
+                         'export_store': True})
+        data_folder = os.path.join(self.folder.name, 'data')
+        summary_df = pd.read_excel(os.path.join(self.folder.name, 'summary.xlsx'))
+        with ResultsStore(data_folder) as store:
+            self.assertEqual(list(store.index.index), list(summary_df['file number']))
+            for number in store.index.index:
+                expected = pd.read_csv(os.path.join(data_folder, '%04d.csv' % number), index_col=0)
+                pd.testing.assert_frame_equal(store.read(number), expected, check_dtype=False)
+            numbers = store.find(cutoff_from='reference', outliers_for='Marker01', category='top outliers')
+            self.assertEqual(len(numbers), 1)
+            self.assertEqual(summary_df.set_index('file number').loc[numbers[0], 'outliers_for'], 'Marker01')
+
+    def test_class_store_writer(self) -> None:
+        df = pd.DataFrame({'Marker01': [1.0, 2.0, 3.0]}, index=pd.Index(['ct_1', 'ct_2', 'ct_3'], name='Sample'))
+        with StoreWriter(folder=self.folder.name) as store_writer:
+            store_writer.add(number=1, data=df.iloc[[2, 0]], info={'category': 'top outliers'})
+            store_writer.add(number=2, data=df.iloc[[]], info={'category': 'bottom outliers'})
+            store_writer.add(number=3, data=df, info={'category': 'non-outliers'})
+        with ResultsStore(self.folder.name) as store:
+            self.assertEqual(list(store.index['rows']), [2, 0, 3])
+            self.assertEqual(store.parquet_file.num_row_groups, 2)
+            for number, expected in [(1, df.iloc[[2, 0]]), (2, df.iloc[[]]), (3, df)]:
+                pd.testing.assert_frame_equal(store.read(number), expected, check_index_type=False)
+            self.assertEqual(store.find(category='non-outliers'), [3])
+
+
+class TestSCOUTSCatalog(TemporaryFolderTestCase):
+    """Tests all classes from src.catalog module."""
+    def test_class_run_catalog(self) -> None:
+        samples = ['ct', 'treat', 'patient']
+        run_from_config({'input_file': TEST_CASE_CSV, 'output_folder': self.folder.name,
+                         'samples': samples, 'reference': 'ct', 'cutoff_rule': 'sample ref',
+                         'marker_rule': 'single any', 'non_outliers': True, 'bottom_outliers': True,
+                         'export_parquet': True})
+        summary_df = pd.read_excel(os.path.join(self.folder.name, 'summary.xlsx'), keep_default_na=False)
+        with RunCatalog(self.folder.name) as catalog:
+            self.assertEqual(catalog.find(), list(summary_df['file number']))
+            for number, *info in summary_df.itertuples(index=False):
+                self.assertEqual(catalog.find(**dict(zip(Info._fields, info))), [number])
+                paths = catalog.get_paths(number)
+                self.assertEqual(sorted(paths), ['csv', 'parquet'])
+                self.assertEqual(catalog.get_data_path(number), paths['parquet'])
+                expected = pd.read_csv(paths['csv'], index_col=0)
+                pd.testing.assert_frame_equal(load_indexed_dataframe(paths['parquet']), expected, check_dtype=False,
+                                              check_index_type=False)
+                self.assertEqual(catalog.get_info(number), {**dict(zip(Info._fields, info)), 'rows': len(expected)})
+                self.assertEqual(catalog.get_sample_counts(number),
+                                 {sample: int(expected.index.str.contains(sample).sum()) for sample in samples})
+            sizes = catalog.connection.execute('SELECT path, bytes FROM files').fetchall()
+            for path, size in sizes:
+                self.assertEqual(os.path.getsize(os.path.join(self.folder.name, path)), size)
+            with self.assertRaises(ValueError):
+                catalog.find(marker='Marker01')
+            with self.assertRaises(KeyError):
+                catalog.get_info(len(summary_df) + 1)
+
+    def test_class_catalog_writer(self) -> None:
+        info = {'cutoff_from': 'reference', 'reference': 'ct', 'outliers_for': 'Marker01', 'category': 'top outliers'}
+        catalog_writer = CatalogWriter(folder=self.folder.name)
+        catalog_writer.add(number=1, info=info, rows=0, sample_counts={'ct': 0},
+                           paths=[os.path.join(self.folder.name, 'data', '0001.csv')])
+        self.assertFalse(os.path.exists(os.path.join(self.folder.name, CATALOG_FILE)))
+        catalog_writer.save()
+        catalog_writer.save()  # replaces the previous catalog
+        with RunCatalog(self.folder.name) as catalog:
+            self.assertEqual(catalog.find(outliers_for='Marker01', category='top outliers'), [1])
+            self.assertEqual(catalog.find(outliers_for='Marker02'), [])
+            self.assertEqual(catalog.get_sample_counts(1), {'ct': 0})
+            self.assertEqual(catalog.get_data_path(1), os.path.join(self.folder.name, 'data', '0001.csv'))
+            self.assertEqual(catalog.connection.execute('SELECT path, bytes FROM files').fetchall(),
+                             [(os.path.join('data', '0001.csv'), None)])
+        with self.assertRaises(FileNotFoundError):
+            RunCatalog(os.path.join(self.folder.name, 'data'))
+
+
+class TestSCOUTSProgress(TemporaryFolderTestCase):
+    """Tests all classes from src.progress module, and how SCOUTS runs report progress and are cancelled."""
+    def setUp(self) -> None:
+        """Creates a temporary output folder and a configuration for each test."""
+        super().setUp()
+        self.config = self.get_config(cutoff_rule='sample ref', marker_rule='single any', gating='cytof',
+                                      gate_cutoff_value=0.1, export_excel=True)
+
+    def test_class_progress_reporter(self) -> None:
+        reports = []
+        cancel_token = CancellationToken()
+        progress = ProgressReporter(callback=reports.append, cancel_token=cancel_token, interval=3600)
+        progress.start_stage('subsets', steps=4)
+        progress.advance(rows=10)
+        progress.advance(rows=5)  # less than interval seconds since the last report: not reported
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0][:4], ('subsets', 0, 4, 0))
+        self.assertIsNone(reports[0].eta)
+        self.assertGreaterEqual(progress.get_progress().eta, 0)
+        progress.add_files([TEST_CASE_CSV, 'missing.csv'])
+        progress.advance(steps=2)  # the stage is done: always reported
+        self.assertEqual(reports[-1][1:6], (4, 4, 15, 2, os.path.getsize(TEST_CASE_CSV)))
+        self.assertEqual(reports[-1].eta, 0)
+        cancel_token.cancel()
+        with self.assertRaises(AnalysisCancelledError):
+            progress.advance()
+        with self.assertRaises(AnalysisCancelledError):
+            progress.start_stage('tables')
+        self.assertEqual(format_progress(Progress('subsets', 3, 10, 300, 2, 1.5e6, 12.0, 28.0)),
+                         'subsets: 3/10, 2 files (1.5 MB) written, about 28 s left')
+        self.assertEqual(format_progress(Progress('loading', 0, None, 0, 0, 0, 0.0, None)), 'loading')
+
+    def test_function_start_scouts_progress(self) -> None:
+        reports = []
+        run_from_config(self.config, progress_callback=reports.append)
+        stages = [stage for i, stage in enumerate(report.stage for report in reports) if reports[i - 1].stage != stage
+                  or i == 0]
+        self.assertEqual(stages, ['loading', 'gating', 'cutoffs', 'outliers', 'stats', 'subsets', 'tables',
+                                  'finished'])
+        subsets = [report for report in reports if report.stage == 'subsets']
+        self.assertEqual(subsets[-1].step, subsets[-1].steps)
+        self.assertEqual(subsets[-1].steps, len(os.listdir(os.path.join(self.folder.name, 'data'))) // 2)
+        output_files = [os.path.join(root, name) for root, _, names in os.walk(self.folder.name)
+                        for name in names if name != PROFILE_FILE]  # the profile is saved after the last report
+        self.assertEqual(reports[-1].files_written, len(output_files))
+        self.assertEqual(reports[-1].bytes_written, sum(os.path.getsize(path) for path in output_files))
+
+    def test_function_start_scouts_cancelled(self) -> None:
+        cancel_token = CancellationToken()
+
+        def cancel_after_first_subset(progress: Progress) -> None:
+            if progress.stage == 'subsets':  # the first subset is written before the token is checked again
+                cancel_token.cancel()
+
+        with self.assertRaises(AnalysisCancelledError):
+            run_from_config(self.config, cancel_token=cancel_token, progress_callback=cancel_after_first_subset)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder.name, 'data'))), ['0001.csv', '0001.xlsx'])
+        self.assertFalse(os.path.exists(os.path.join(self.folder.name, 'summary.xlsx')))
+        cancel_token = CancellationToken()
+        cancel_token.cancel()
+        with self.assertRaises(AnalysisCancelledError):  # streaming runs are cancelled as well
+            run_from_config({**self.config, 'export_excel': False, 'stream_chunk_size': 4}, cancel_token=cancel_token)
+
+
+class TestSCOUTSProfiling(TemporaryFolderTestCase):
+    """Tests all classes from src.profiling module, and the profiles saved by SCOUTS runs."""
+    def setUp(self) -> None:
+        """Creates a temporary output folder and a configuration for each test."""
+        super().setUp()
+        self.config = self.get_config(cutoff_rule='sample ref', marker_rule='single any', gating='cytof',
+                                      gate_cutoff_value=0.1)
+
+    def load_profile(self) -> Dict[str, Any]:
+        """Returns the run profile saved in the output folder."""
+        with open(os.path.join(self.folder.name, PROFILE_FILE)) as profile_file:
+            return json.load(profile_file)
+
+    def test_class_run_profiler(self) -> None:
+        profiler = RunProfiler(folder=self.folder.name, trace_memory=True, profile_calls=True)
+        profiler.start()
+        profiler.start_stage(stage='loading', rows_processed=0, files_written=0, bytes_written=0)
+        values = np.ones(1_000_000)
+        del values
+        profiler.start_stage(stage='subsets', rows_processed=10, files_written=0, bytes_written=0)
+        profiler.stop(rows_processed=5, files_written=2, bytes_written=100, error=AnalysisCancelledError())
+        profile = self.load_profile()
+        self.assertEqual((profile['status'], profile['files_written'], profile['pstats_file']),
+                         ('cancelled', 2, PSTATS_FILE))
+        self.assertEqual([stage['stage'] for stage in profile['stages']], ['loading', 'subsets'])
+        loading, subsets = profile['stages']
+        self.assertEqual((loading['rows_processed'], subsets['rows_processed']), (10, 5))
+        self.assertEqual((subsets['files_written'], subsets['bytes_written']), (2, 100))
+        self.assertGreaterEqual(loading['peak_traced_bytes'], 8_000_000)
+        self.assertLess(subsets['peak_traced_bytes'], 8_000_000)
+        self.assertGreaterEqual(profile['wall_seconds'], loading['wall_seconds'] + subsets['wall_seconds'])
+        self.assertFalse(tracemalloc.is_tracing())
+        pstats.Stats(os.path.join(self.folder.name, PSTATS_FILE))  # can be read back
+        profiler = RunProfiler(folder=os.path.join(self.folder.name, 'missing'))
+        profiler.start()
+        profiler.stop(rows_processed=0, files_written=0, bytes_written=0)  # only logs a warning
+
+    def test_function_start_scouts_profile(self) -> None:
+        run_from_config(self.config)
+        profile = self.load_profile()
+        self.assertEqual(profile['status'], 'finished')
+        self.assertEqual([stage['stage'] for stage in profile['stages']],
+                         ['loading', 'gating', 'cutoffs', 'outliers', 'stats', 'subsets', 'tables'])
+        self.assertIsNone(profile['stages'][0]['peak_traced_bytes'])
+        self.assertIsNone(profile['pstats_file'])
+        stages = {stage['stage']: stage for stage in profile['stages']}
+        self.assertEqual(stages['loading']['rows_processed'], len(pd.read_csv(TEST_CASE_CSV)))
+        data_files = os.listdir(os.path.join(self.folder.name, 'data'))
+        self.assertEqual(stages['subsets']['files_written'], len(data_files))
+        self.assertEqual(sum(stage['bytes_written'] for stage in profile['stages']), profile['bytes_written'])
+        with self.assertRaises(SampleNamingError):
+            run_from_config({**self.config, 'samples': ['ct', 'missing']})
+        self.assertEqual(self.load_profile()['status'], 'failed (SampleNamingError)')
+        run_from_config({**self.config, 'stream_chunk_size': 4, 'profile_calls': True})
+        profile = self.load_profile()
+        self.assertEqual([stage['stage'] for stage in profile['stages']],
+                         ['first pass', 'cutoffs', 'second pass', 'tables'])
+        self.assertTrue(os.path.isfile(os.path.join(self.folder.name, PSTATS_FILE)))
+
+
+class TestSCOUTSBenchmark(TemporaryFolderTestCase):
+    """Tests all functions from src.benchmark module."""
+    def setUp(self) -> None:
+        """Creates a temporary benchmark folder and a small benchmark case."""
+        super().setUp()
+        self.case = BenchmarkCase('tiny', 'cytof', 300, 5, 3, {})
+
+    def test_function_get_cell_names(self) -> None:
+        self.assertEqual(get_cell_names(start=0, stop=7, cells=7, samples=['Ct', 'T001', 'T002']),
+                         ['Ct_1', 'Ct_2', 'Ct_3', 'T001_1', 'T001_2', 'T002_1', 'T002_2'])
+        self.assertEqual(get_cell_names(start=3, stop=5, cells=7, samples=['Ct', 'T001', 'T002']),
+                         ['T001_1', 'T001_2'])
+
+    def test_function_yield_synthetic_blocks(self) -> None:
+        for kind in ('cytof', 'rnaseq'):
+            df = pd.concat(yield_synthetic_blocks(kind=kind, cells=100, markers=12, samples=4))
+            self.assertEqual(df.shape, (100, 12))
+            self.assertEqual((df.index.name, df.columns[0], df.columns[-1]), ('Sample', 'Marker01', 'Marker12'))
+            self.assertEqual(df.index[[0, 25, 99]].tolist(), ['Ct_1', 'T001_1', 'T003_25'])
+            pd.testing.assert_frame_equal(df, pd.concat(yield_synthetic_blocks(kind=kind, cells=100, markers=12,
+                                                                               samples=4)))
+        self.assertTrue(pd.api.types.is_integer_dtype(df.values) and (df >= 0).all().all())  # rnaseq counts
+        with patch('src.benchmark.BENCHMARK_BLOCK_VALUES', 120):  # blocks of 10 cells
+            blocks = list(yield_synthetic_blocks(kind='cytof', cells=95, markers=12, samples=4))
+        self.assertEqual([len(block) for block in blocks], [10] * 9 + [5])
+        self.assertEqual(pd.concat(blocks).index.tolist(), get_cell_names(0, 95, 95, ['Ct', 'T001', 'T002', 'T003']))
+        with self.assertRaises(ValueError):
+            next(yield_synthetic_blocks(kind='flow', cells=10, markers=2, samples=2))
+
+    def test_function_write_synthetic_input(self) -> None:
+        path = write_synthetic_input(case=self.case, folder=self.folder.name)
+        df = pd.read_csv(path, index_col=0)
+        self.assertEqual(df.shape, (300, 5))
+        modified_time = os.path.getmtime(path)
+        self.assertEqual(write_synthetic_input(case=self.case, folder=self.folder.name), path)  # reused
+        self.assertEqual(os.path.getmtime(path), modified_time)
+        self.assertEqual(os.listdir(self.folder.name), [os.path.basename(path)])
+
+    def test_function_run_benchmarks(self) -> None:
+        with patch('src.benchmark.get_commit', side_effect=[('aaaa1111', False), ('bbbb2222', True)]):
+            first, = run_benchmarks(cases=[self.case], folder=self.folder.name, isolate=False)
+            second, = run_benchmarks(cases=[self.case], folder=self.folder.name, isolate=False)
+        self.assertEqual((first['commit'], first['case'], first['status']), ('aaaa1111', 'tiny', 'finished'))
+        self.assertTrue(second['dirty'])
+        self.assertEqual([stage['stage'] for stage in first['stages']][:3], ['loading', 'gating', 'cutoffs'])
+        with open(os.path.join(self.folder.name, BENCHMARK_RESULTS_FILE)) as results_file:
+            self.assertEqual(len(results_file.readlines()), 2)
+        results = load_benchmark_results(folder=self.folder.name)
+        self.assertEqual(results.loc[results['stage'] == 'total', 'commit'].tolist(), ['aaaa1111', 'bbbb2222'])
+        comparison = compare_benchmarks(folder=self.folder.name, base='aaaa')
+        self.assertIn(('tiny', 'total'), comparison.index)
+        self.assertAlmostEqual(comparison.loc[('tiny', 'total'), 'wall_ratio'],
+                               second['wall_seconds'] / first['wall_seconds'])
+        with self.assertRaises(ValueError):
+            compare_benchmarks(folder=self.folder.name, base='cccc')
+        with self.assertRaises(SystemExit):
+            main(['benchmark', '--folder', self.folder.name, '--case', 'missing'])
+
+    def test_constant_benchmark_suites(self) -> None:
+        cases = BENCHMARK_SUITES['full']
+        self.assertEqual((min(case.cells for case in cases), max(case.cells for case in cases)), (10 ** 4, 10 ** 7))
+        self.assertEqual((min(case.markers for case in cases), max(case.markers for case in cases)), (30, 20_000))
+        self.assertEqual((min(case.samples for case in cases), max(case.samples for case in cases)), (2, 100))
+        for suite in BENCHMARK_SUITES.values():
+            self.assertEqual(len({case.name for case in suite}), len(suite))
+
+
+class TestSCOUTSCli(TemporaryFolderTestCase):
+    """Tests all functions from src.cli module."""
+    def setUp(self) -> None:
+        """Creates a minimal configuration and a temporary output folder for each test."""
+        super().setUp()
+        self.config = self.get_config()
+
+    def test_function_load_config(self) -> None:
+        path = os.path.join(self.folder.name, 'job.json')
+        with open(path, 'w') as config_file:
+            json.dump(self.config, config_file)
+        self.assertEqual(load_config(path), self.config)
+        with self.assertRaises(InvalidConfigError):
+            load_config(os.path.join(self.folder.name, 'missing.json'))
+
+    def test_class_scouts_config(self) -> None:
+        config = ScoutsConfig(input_file=TEST_CASE_CSV, output_folder=self.folder.name,
+                              sample_list=[('ct', 'yes')])
+        self.assertEqual(config.get_options(list(DEFAULT_CONFIG)), DEFAULT_CONFIG)
+        self.assertEqual(get_scouts_config(config), config)
+        self.assertEqual(get_scouts_config(config, tukey_factor=3.0), config.replace(tukey_factor=3.0))
+        self.assertEqual(config.tukey_factor, 1.5)
+        self.assertEqual(get_scouts_config(**config.get_options(['input_file', 'output_folder', 'sample_list'])),
+                         config)
+
+    def test_function_parse_config(self) -> None:
+        config = parse_config(self.config)
+        self.assertEqual(config.sample_list, [('ct', 'yes'), ('treat', 'no'), ('patient', 'no')])
+        self.assertEqual(config.cutoff_rule, 'sample')
+        self.assertEqual(config.tukey_factor, 1.5)
+        with self.assertRaises(NoIOPathError):
+            parse_config({**self.config, 'input_file': None})
+        with self.assertRaises(NoSampleError):
+            parse_config({**self.config, 'samples': []})
+        bad_options = [{'cutoff_rule': 'neither'}, {'gating': 'cytof'}, {'export_csv': 'yes'}, {'what': 1},
+                       {'n_writers': -1}, {'writer_queue_depth': 0}, {'stream_chunk_size': 10, 'export_excel': True},
+                       {'quantile_method': 'tdigest'}, {'sketch_error': 1.5},
+                       {'table_format': 'csv'}, {'single_excel': True, 'table_format': 'parquet'},
+                       {'precision': 'float16'}, {'stream_chunk_size': 10, 'precision': 'float32'},
+                       {'stream_chunk_size': 10, 'reuse_stages': True}, {'tukey_sweep': 1.5}, {'tukey_sweep': []},
+                       {'tukey_sweep': [1.5, 'high']}, {'tukey_sweep': [1.5, 1.5]}, {'tukey_sweep': [-1.0]},
+                       {'tukey_sweep': [1.5, 3.0], 'quantile_method': 'sketch'}, {'profile_calls': 'yes'},
+                       {'sparse': True}, {'sparse': True, 'gating': 'rnaseq', 'gate_cutoff_value': -1.0},
+                       {'sparse': True, 'gating': 'rnaseq', 'gate_cutoff_value': 0.0, 'n_writers': 2},
+                       {'sample_workers': -1}, {'sample_workers': 2, 'cutoff_rule': 'ref'},
+                       {'sample_workers': 2, 'reuse_stages': True}, {'scratch_folder': '/tmp'}]
+        for bad_option in bad_options:
+            with self.assertRaises(InvalidConfigError):
+                parse_config({**self.config, **bad_option})
+
+    @patch('src.sparse.start_scouts_sparse')
+    @patch('src.cli.start_scouts_streaming')
+    @patch('src.cli.start_scouts')
+    def test_function_run_from_config(self, mock_start_scouts: MagicMock, mock_streaming: MagicMock,
+                                      mock_sparse: MagicMock) -> None:
+        run_from_config(self.config)
+        mock_start_scouts.assert_called_once_with(parse_config(self.config), cancel_token=None,
+                                                  progress_callback=None)
+        mock_streaming.assert_not_called()
+        run_from_config({**self.config, 'stream_chunk_size': 1000})
+        mock_start_scouts.assert_called_once()
+        self.assertEqual(mock_streaming.call_args[1]['chunk_size'], 1000)
+        run_from_config({**self.config, 'sparse': True, 'gating': 'rnaseq', 'gate_cutoff_value': 0})
+        mock_start_scouts.assert_called_once()
+        self.assertEqual(mock_sparse.call_args[1]['gate_cutoff_value'], 0.0)
+
+    def test_function_main(self) -> None:
+        path = os.path.join(self.folder.name, 'job.json')
+        with open(path, 'w') as config_file:
+            json.dump({**self.config, 'cutoff_rule': 'sample ref', 'marker_rule': 'any'}, config_file)
+        main(['run', '--config', path])
+        for file_name in ['summary.xlsx', 'stats.xlsx', 'cutoff_values.xlsx', os.path.join('data', '0001.csv')]:
+            self.assertTrue(os.path.isfile(os.path.join(self.folder.name, file_name)))
+        with self.assertRaises(SystemExit):
+            main(['run', '--config', path, '--input', 'test-case.wrong_extension'])
+
+    def test_function_main_invalid_samples(self) -> None:
+        path = os.path.join(self.folder.name, 'job.json')
+        for options in ({'samples': ['a(', 'ct'], 'reference': 'ct', 'sample_match': 'regex'},
+                        {'samples': ['ct', 'ct_1'], 'contiguous_samples': True}):
+            with open(path, 'w') as config_file:
+                json.dump({**self.config, **options}, config_file)
+            with self.assertRaises(SystemExit) as context:
+                main(['run', '--config', path])
+            self.assertTrue(str(context.exception.code).startswith('scouts: error: '))
+
+    def test_function_main_columnar(self) -> None:
+        input_file = os.path.join(self.folder.name, 'test-case.parquet')
+        pd.read_csv(TEST_CASE_CSV).to_parquet(input_file)
+        path = os.path.join(self.folder.name, 'job.json')
+        with open(path, 'w') as config_file:
+            json.dump({**self.config, 'input_file': input_file, 'export_parquet': True, 'export_feather': True,
+                       'table_format': 'parquet', 'export_gated': True, 'quantile_method': 'sketch'}, config_file)
+        main(['run', '--config', path])
+        for file_name in ['summary', 'stats', 'cutoff_values', 'cutoff_values_error_bound', 'gated_population']:
+            self.assertTrue(os.path.isfile(os.path.join(self.folder.name, f'{file_name}.parquet')))
+        data_folder = os.path.join(self.folder.name, 'data')
+        for file_name in [name for name in os.listdir(data_folder) if name.endswith('.csv')]:
+            expected = pd.read_csv(os.path.join(data_folder, file_name))
+            for extension in ['.parquet', '.feather']:
+                result = load_dataframe(os.path.join(data_folder, file_name.replace('.csv', extension)))
+                pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_index_type=False)
+        stats_df = pd.read_parquet(os.path.join(self.folder.name, 'stats.parquet'))
+        self.assertEqual(list(stats_df.columns[:4]), ['sheet', 'sample', 'population', 'statistic'])
+
+    def test_headless_run_does_not_import_qt(self) -> None:
+        code = "import sys, src.cli; assert not any(name.startswith('PySide2') for name in sys.modules)"
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.join(os.path.dirname(__file__), '..'))
+
+
+class TestSCOUTSWriters(TemporaryFolderTestCase):
+    """Tests all functions and classes from src.writers module."""
+    def setUp(self) -> None:
+        """Creates a small DataFrame and a temporary output folder for each test."""
+        super().setUp()
+        self.df = pd.DataFrame({'Marker01': [1.0, 2.0], 'Marker02': [3.0, 4.0]}, index=['ct_1', 'ct_2'])
+
+    def get_path(self, i: int, extension: str) -> str:
+        """Returns the path of the i-th output file with the given extension."""
+        return os.path.join(self.folder.name, f'{i:04d}.{extension}')
+
+    def test_function_write_subset(self) -> None:
+        write_subset(data=self.df, paths=[self.get_path(1, 'csv')])
+        pd.testing.assert_frame_equal(pd.read_csv(self.get_path(1, 'csv'), index_col=0), self.df)
+        self.assertFalse(os.path.exists(self.get_path(1, 'xlsx')))
+
+    def test_function_save_dataframe(self) -> None:
+        self.df.index.name = 'Sample'
+        for extension in ['parquet', 'feather']:
+            save_dataframe(df=self.df, path=self.get_path(1, extension))
+            pd.testing.assert_frame_equal(load_dataframe(self.get_path(1, extension)), self.df.reset_index())
+        save_dataframe(df=self.df, path=self.get_path(2, 'parquet'), index=False)
+        pd.testing.assert_frame_equal(pd.read_parquet(self.get_path(2, 'parquet')), self.df.reset_index(drop=True))
+        with self.assertRaises(ValueError):
+            save_dataframe(df=self.df, path=self.get_path(1, 'txt'))
+
+    def test_class_writer_pool_serial(self) -> None:
+        written = []
+        with WriterPool(n_writers=0, on_written=written.append) as writer_pool:
+            writer_pool.submit(data=self.df, paths=[self.get_path(1, 'csv'), self.get_path(1, 'xlsx')])
+            self.assertTrue(os.path.isfile(self.get_path(1, 'csv')))
+            self.assertTrue(os.path.isfile(self.get_path(1, 'xlsx')))
+            self.assertFalse(writer_pool.pending)
+        self.assertEqual(written, [[self.get_path(1, 'csv'), self.get_path(1, 'xlsx')]])
+
+    def test_class_writer_pool_parallel(self) -> None:
+        written = []
+        with WriterPool(n_writers=2, queue_depth=3, on_written=written.append) as writer_pool:
+            for i in range(1, 11):
+                writer_pool.submit(data=self.df * i, paths=[self.get_path(i, 'csv')])
+                self.assertLessEqual(len(writer_pool.pending), 3)
+        self.assertEqual(sorted(written), [[self.get_path(i, 'csv')] for i in range(1, 11)])
+        for i in range(1, 11):
+            pd.testing.assert_frame_equal(pd.read_csv(self.get_path(i, 'csv'), index_col=0), self.df * i)
+        with self.assertRaises(OSError):
+            with WriterPool(n_writers=1) as writer_pool:
+                missing_folder = os.path.join(self.folder.name, 'missing', '0001.csv')
+                writer_pool.submit(data=self.df, paths=[missing_folder])
+        with self.assertRaises(ValueError):
+            WriterPool(n_writers=-1)
+
+    def test_function_get_excel_rows(self) -> None:
+        df = pd.DataFrame({'Marker01': [1.0, np.nan], 'Marker02': [np.inf, -np.inf]}, index=['ct_1', 'ct_2'])
+        df.index.name = 'Sample'
+        rows = list(get_excel_rows(df=df, index=True))
+        self.assertEqual(rows, [['Sample', 'Marker01', 'Marker02'], ['ct_1', 1.0, 'inf'], ['ct_2', None, '-inf']])
+        self.assertEqual(list(get_excel_rows(df=self.df, index=False)), [['Marker01', 'Marker02'], [1.0, 3.0],
+                                                                        [2.0, 4.0]])
+
+    def test_class_merged_workbook_writer(self) -> None:
+        path = os.path.join(self.folder.name, 'merged_data.xlsx')
+        merged_writer = MergedWorkbookWriter(path=path)
+        for i in range(1, 4):
+            merged_writer.add(number=i, data=self.df * i)
+            (self.df * i).to_excel(self.get_path(i, 'xlsx'))
+        summary_df = pd.DataFrame({'file number': [1, 2, 3], 'category': ['top outliers'] * 3})
+        merged_writer.save(summary_df=summary_df)
+        sheets = pd.read_excel(path, sheet_name=None)
+        self.assertEqual(list(sheets), ['Summary', '0001', '0002', '0003'])
+        pd.testing.assert_frame_equal(sheets['Summary'], summary_df)
+        for i in range(1, 4):
+            pd.testing.assert_frame_equal(sheets['%04d' % i], pd.read_excel(self.get_path(i, 'xlsx')))
+
+
+class TestSCOUTSStreaming(TemporaryFolderTestCase):
+    """Tests all functions from src.streaming module."""
+    def setUp(self) -> None:
+        """Saves the test case as a .csv file and creates temporary output folders for each test."""
+        super().setUp()
+        self.input_file = self.copy_test_case()
+        self.kwargs = self.get_kwargs(input_file=self.input_file, gating='cytof', gate_cutoff_value=0.1,
+                                      export_gated=False)
+
+    def make_output_folder(self, name: str) -> str:
+        """Creates and returns an output folder inside the temporary folder."""
+        path = os.path.join(self.folder.name, name)
+        os.mkdir(path)
+        return path
+
+    def test_function_start_scouts_streaming(self) -> None:
+        memory_folder, streaming_folder = self.make_output_folder('memory'), self.make_output_folder('streaming')
+        scratch_folder = self.make_output_folder('scratch')
+        start_scouts(output_folder=memory_folder, export_excel=False, single_excel=False, **self.kwargs)
+        start_scouts_streaming(output_folder=streaming_folder, chunk_size=4, scratch_folder=scratch_folder,
+                               **self.kwargs)
+        file_names = sorted(os.listdir(os.path.join(memory_folder, 'data')))
+        self.assertEqual(file_names, sorted(os.listdir(os.path.join(streaming_folder, 'data'))))
+        for file_name in file_names:
+            expected = pd.read_csv(os.path.join(memory_folder, 'data', file_name), index_col=0)
+            result = pd.read_csv(os.path.join(streaming_folder, 'data', file_name), index_col=0)
+            pd.testing.assert_frame_equal(expected.sort_index(kind='stable'), result.sort_index(kind='stable'))
+        for file_name in ['summary.xlsx', 'cutoff_values.xlsx']:
+            pd.testing.assert_frame_equal(pd.read_excel(os.path.join(memory_folder, file_name)),
+                                          pd.read_excel(os.path.join(streaming_folder, file_name)))
+        self.assertFalse([name for name in os.listdir(streaming_folder) if 'spill' in name])
+        self.assertEqual(os.listdir(scratch_folder), [])  # spill files are removed once cutoffs are calculated
+
+    def test_function_get_spilled_ranks(self) -> None:
+        path = os.path.join(self.folder.name, 'values.bin')
+        values = np.concatenate([np.random.default_rng(0).lognormal(size=200_000), np.full(50_000, 2.0), [np.nan] * 10])
+        values.tofile(path)
+        expected = np.sort(values)
+        ranks = np.array([0, 50_000, 62_500, 187_499, 249_999])
+        tracemalloc.start()
+        result = get_spilled_ranks(path=path, ranks=ranks, block_values=1000)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        np.testing.assert_array_equal(result, expected[ranks])
+        self.assertLess(peak, values.nbytes / 5)  # memory depends on the block size, not on the number of values
+
+    def test_function_start_scouts_streaming_errors(self) -> None:
+        output_folder = self.make_output_folder('errors')
+        with self.assertRaises(PandasInputError):
+            start_scouts_streaming(output_folder=output_folder, chunk_size=4,
+                                   **{**self.kwargs, 'input_file': TEST_CASE_XLSX})
+        with self.assertRaises(SampleNamingError):
+            start_scouts_streaming(output_folder=output_folder, chunk_size=4,
+                                   **{**self.kwargs, 'sample_list': [('ct', 'yes'), ('missing', 'no')]})
+
+    def test_function_update_running_stats(self) -> None:
+        values = np.array([[1.0, np.nan], [2.0, np.nan], [4.0, 5.0], [8.0, np.nan], [np.nan, 7.0]])
+        running = None
+        for start in range(0, len(values), 2):
+            running = update_running_stats(running, values[start:start + 2])
+        expected = pd.DataFrame(values).describe().loc[['count', 'mean', '50%', 'std']].values
+        expected[2] = np.nan  # medians are not available from running stats
+        np.testing.assert_allclose(get_stats_values(running), expected)
+
+
+class TestSCOUTSSparse(TemporaryFolderTestCase):
+    """Tests all classes and functions from src.sparse module."""
+    def setUp(self) -> None:
+        """Saves the test case as a .csv file and creates a temporary folder."""
+        super().setUp()
+        self.input_file = self.copy_test_case()
+        self.gated_df = pd.read_csv(self.input_file, index_col=0)
+        apply_rnaseq_gating(df=self.gated_df, cutoff=1.5)
+        self.kwargs = self.get_kwargs(input_file=self.input_file, gate_cutoff_value=1.5, export_gated=True)
+
+    def test_class_sparse_frame(self) -> None:
+        frame = SparseFrame.from_dataframe(df=pd.read_csv(self.input_file, index_col=0), cutoff=1.5)
+        self.assertEqual(list(frame.index), list(self.gated_df.index))
+        np.testing.assert_array_equal(frame.matrix.toarray(), self.gated_df.fillna(0).to_numpy())
+        with patch('src.sparse.SPARSE_BLOCK_VALUES', 10):  # two rows at a time
+            loaded, input_index = SparseFrame.from_csv(input_file=self.input_file, cutoff=1.5)
+            self.assertEqual(list(input_index), list(pd.read_csv(self.input_file, index_col=0).index))
+            self.assertEqual((loaded.matrix != frame.matrix).nnz, 0)
+            self.assertEqual(list(loaded.index), list(frame.index))
+            path = os.path.join(self.folder.name, 'gated.csv')
+            loaded.to_csv(path)
+        with open(path) as result_file:
+            self.assertEqual(result_file.read(), self.gated_df.to_csv())
+        loaded.take(np.array([], dtype=int)).to_csv(path)
+        with open(path) as result_file:
+            self.assertEqual(result_file.read(), self.gated_df.iloc[:0].to_csv())
+        self.assertEqual(SparseFrame.from_dataframe(df=self.gated_df.iloc[:0], cutoff=1.5).matrix.shape, (0, 5))
+        self.assertEqual(frame.matrix.dtype, np.float64)
+        self.assertEqual(SparseFrame.from_dataframe(df=self.gated_df, cutoff=1.5, dtype='float32').matrix.dtype,
+                         np.float32)
+
+    def test_class_sparse_mask(self) -> None:
+        mask = SparseMask.from_entries(rows=np.array([0, 2, 2]), columns=np.array([1, 0, 1]), shape=(4, 3))
+        np.testing.assert_array_equal(mask[:, 1], [True, False, True, False])
+        np.testing.assert_array_equal(mask[:, 2], [False] * 4)
+        np.testing.assert_array_equal(mask.any(axis=1), [True, False, True, False])
+        with self.assertRaises(IndexError):
+            mask[0, 1]
+        with self.assertRaises(ValueError):
+            mask.any(axis=0)
+
+    def test_function_get_column_quantiles(self) -> None:
+        frame = SparseFrame.from_dataframe(df=self.gated_df, cutoff=1.5)
+        values = self.gated_df.to_numpy()
+        quantiles = [0.0, 0.25, 0.5, 0.75, 1.0]
+        np.testing.assert_array_equal(get_column_quantiles(matrix=frame.matrix, quantiles=quantiles),
+                                      np.nanquantile(values, quantiles, axis=0))
+        np.testing.assert_allclose(get_sparse_column_stats(matrix=frame.matrix),
+                                   get_masked_stats(values=values, mask=np.True_))
+        empty = get_sparse_column_stats(matrix=frame.matrix[:0])
+        np.testing.assert_array_equal(empty[0], 0)
+        self.assertTrue(np.isnan(empty[1:]).all())
+
+    def test_function_start_scouts_sparse(self) -> None:
+        memory_folder, sparse_folder = [os.path.join(self.folder.name, name) for name in ('memory', 'sparse')]
+        for folder in (memory_folder, sparse_folder):
+            os.mkdir(folder)
+        start_scouts(output_folder=memory_folder, export_excel=False, single_excel=False,
+                     gating='rnaseq', table_format='parquet', **self.kwargs)
+        start_scouts_sparse(output_folder=sparse_folder, table_format='parquet', **self.kwargs)
+        file_names = sorted(os.listdir(os.path.join(memory_folder, 'data')))
+        self.assertEqual(file_names, sorted(os.listdir(os.path.join(sparse_folder, 'data'))))
+        for file_name in file_names:
+            with open(os.path.join(memory_folder, 'data', file_name)) as expected, \
+                    open(os.path.join(sparse_folder, 'data', file_name)) as result:
+                self.assertEqual(expected.read(), result.read())
+        with open(os.path.join(sparse_folder, 'gated_population.csv')) as result_file:
+            self.assertEqual(result_file.read(), self.gated_df.to_csv())
+        for file_name in ['summary.parquet', 'cutoff_values.parquet', 'stats.parquet']:
+            pd.testing.assert_frame_equal(pd.read_parquet(os.path.join(memory_folder, file_name)),
+                                          pd.read_parquet(os.path.join(sparse_folder, file_name)), check_dtype=False)
+        with RunCatalog(memory_folder) as expected, RunCatalog(sparse_folder) as result:
+            pd.testing.assert_frame_equal(expected.get_subsets(), result.get_subsets())
+        with self.assertRaises(PandasInputError):
+            start_scouts_sparse(output_folder=sparse_folder, **{**self.kwargs, 'input_file': TEST_CASE_XLSX})
+        with self.assertRaises(SampleNamingError):
+            start_scouts_sparse(output_folder=sparse_folder, **{**self.kwargs, 'sample_list': [('missing', 'yes')]})
+
+
+class TestSCOUTSBatch(TemporaryFolderTestCase):
+    """Tests all functions from src.batch module."""
+    def setUp(self) -> None:
+        """Creates a temporary folder with three input files (one of which can't be analysed) and a configuration."""
+        super().setUp()
+        self.input_folder = os.path.join(self.folder.name, 'inputs')
+        self.output_folder = os.path.join(self.folder.name, 'outputs')
+        os.makedirs(self.input_folder)
+        df = pd.read_csv(TEST_CASE_CSV)
+        for name in ['day1', 'day2']:
+            df.to_csv(os.path.join(self.input_folder, f'{name}.csv'), index=False)
+        df.replace({'ct': 'control'}, regex=True).to_csv(os.path.join(self.input_folder, 'day3.csv'), index=False)
+        with open(os.path.join(self.input_folder, 'notes.txt'), 'w') as notes_file:
+            notes_file.write('not an input file')
+        self.config = {'samples': ['ct', 'treat', 'patient'], 'reference': 'ct', 'cutoff_rule': 'sample ref',
+                       'export_csv': False}
+
+    def test_function_get_batch_inputs(self) -> None:
+        expected = [os.path.join(self.input_folder, f'day{i}.csv') for i in (1, 2, 3)]
+        self.assertEqual(get_batch_inputs([self.input_folder]), expected)
+        self.assertEqual(get_batch_inputs([expected[1], os.path.join(self.input_folder, 'day*.csv')]),
+                         [expected[1], expected[0], expected[2]])
+        with self.assertRaises(InvalidConfigError):
+            get_batch_inputs([os.path.join(self.input_folder, '*.xlsx')])
+
+    def test_function_get_batch_output_folders(self) -> None:
+        folders = get_batch_output_folders(input_files=['a/day1.csv', 'b/day1.xlsx', 'day2.csv'], output_folder='out')
+        self.assertEqual(folders, [os.path.join('out', 'day1'), os.path.join('out', 'day1_2'),
+                                   os.path.join('out', 'day2')])
+
+    def test_function_run_batch(self) -> None:
+        results = run_batch(config=self.config, inputs=[self.input_folder], output_folder=self.output_folder,
+                            workers=2)
+        self.assertEqual([result.status for result in results], ['finished', 'finished', 'failed'])
+        self.assertIn('sample names were not found', results[2].error)
+        for name in ['day1', 'day2']:
+            self.assertTrue(os.path.isfile(os.path.join(self.output_folder, name, 'summary.xlsx')))
+        pd.testing.assert_frame_equal(pd.read_excel(os.path.join(self.output_folder, 'day1', 'summary.xlsx')),
+                                      pd.read_excel(os.path.join(self.output_folder, 'day2', 'summary.xlsx')))
+        report_df = pd.read_csv(os.path.join(self.output_folder, BATCH_REPORT_FILE))
+        self.assertEqual(report_df['status'].tolist(), ['finished', 'finished', 'failed'])
+        self.assertEqual(report_df['output_folder'].tolist(), [result.output_folder for result in results])
+        with self.assertRaises(SystemExit):
+            main(['batch', os.path.join(self.input_folder, 'day3.csv'), '--config', self.write_config(),
+                  '--output', self.output_folder])
+
+    def test_function_run_batch_cancelled(self) -> None:
+        cancel_token = CancellationToken()
+        cancel_token.cancel()
+        results = run_batch(config=self.config, inputs=[self.input_folder], output_folder=self.output_folder,
+                            workers=1, cancel_token=cancel_token)
+        self.assertTrue(all(result.status in ('finished', 'cancelled') for result in results))
+        self.assertEqual(results[-1].status, 'cancelled')
+        with self.assertRaises(InvalidConfigError):
+            run_batch(config={**self.config, 'cutoff_rule': 'neither'}, inputs=[self.input_folder],
+                      output_folder=self.output_folder)
+
+    def write_config(self) -> str:
+        """Saves the batch configuration as a .json file, returning its path."""
+        path = os.path.join(self.folder.name, 'batch.json')
+        with open(path, 'w') as config_file:
+            json.dump(self.config, config_file)
+        return path
+
+
+class TestSCOUTSParallel(TemporaryFolderTestCase):
+    """Tests all classes and functions from src.parallel module."""
+    def setUp(self) -> None:
+        """Loads the test case and creates a temporary folder."""
+        super().setUp()
+        self.df = load_indexed_dataframe(TEST_CASE_CSV)
+        self.samples = ['ct', 'treat', 'patient']
+        self.markers = get_marker_names(self.df)
+
+    def test_class_sample_worker_pool(self) -> None:
+        values = get_values(self.df)
+        tasks = [{'rows': rows, 'tukey': 1.5, 'bottom_outliers': False, 'non_outliers': False, 'populations': [],
+                  'marker_rules': []} for rows in [slice(0, 10), np.array([3, 1, 12])]]
+        done = []
+        with SampleWorkerPool(values=values, n_workers=2) as pool:
+            results = pool.map(get_sample_results, tasks=tasks, on_result=done.append)
+            name = pool.shared_memory.name
+        self.assertEqual(done, results)
+        for task, result in zip(tasks, results):
+            np.testing.assert_array_equal(result.cutoff_values, get_cutoff_values(values[task['rows']], tukey=1.5))
+            self.assertEqual(result.rows, len(values[task['rows']]))
+        with self.assertRaises(FileNotFoundError):  # released once the pool exits
+            shared_memory.SharedMemory(name=name)
+        with self.assertRaises(ValueError):
+            SampleWorkerPool(values=values, n_workers=0)
+
+    def test_function_get_parallel_sample_results(self) -> None:
+        results = get_parallel_sample_results(df=self.df, samples=self.samples, markers=self.markers, tukey=1.5,
+                                              marker_rule='any single', bottom_outliers=True, non_outliers=True,
+                                              n_workers=2)
+        cutoff_df = get_cutoff(df=self.df, samples=self.samples, markers=self.markers, tukey=1.5)
+        pd.testing.assert_frame_equal(results.cutoff_df, cutoff_df)
+        masks = get_outlier_masks(input_df=self.df, cutoff_df=cutoff_df, cutoff_from='sample', samples=self.samples,
+                                  bottom_outliers=True, non_outliers=True)
+        for expected, result in zip(masks, results.masks):
+            np.testing.assert_array_equal(expected, result)
+        stats = get_stats_dfs(input_df=self.df, masks={'sample': masks}, markers=self.markers,
+                              cutoff_rule='sample', marker_rule='any single', samples=self.samples, bottom=True,
+                              non=True)
+        self.assertEqual(list(results.stats), list(stats))
+        for key, stats_df in stats.items():
+            pd.testing.assert_frame_equal(results.stats[key], stats_df)
+        overlapping = get_parallel_sample_results(df=self.df, samples=['ct', 'c'], markers=self.markers, tukey=1.5,
+                                                  marker_rule='any', bottom_outliers=False, non_outliers=False,
+                                                  n_workers=2)
+        self.assertIsNone(overlapping.stats)  # rows of "ct" also belong to "c"
+
+    def test_function_start_scouts_sample_workers(self) -> None:
+        kwargs = {'input_file': TEST_CASE_CSV, 'cutoff_rule': 'sample ref', 'marker_rule': 'single any',
+                  'tukey_factor': 1.5, 'export_csv': True, 'export_excel': False, 'single_excel': False,
+                  'sample_list': [('ct', 'yes'), ('treat', 'no'), ('patient', 'no')], 'gating': 'cytof',
+                  'gate_cutoff_value': 0.1, 'export_gated': False, 'non_outliers': True, 'bottom_outliers': True,
+                  'table_format': 'parquet'}
+        serial_folder, parallel_folder = [os.path.join(self.folder.name, name) for name in ('serial', 'parallel')]
+        for folder, sample_workers in [(serial_folder, 0), (parallel_folder, 2)]:
+            os.mkdir(folder)
+            start_scouts(output_folder=folder, sample_workers=sample_workers, **kwargs)
+        file_names = sorted(os.listdir(os.path.join(serial_folder, 'data')))
+        self.assertEqual(file_names, sorted(os.listdir(os.path.join(parallel_folder, 'data'))))
+        for file_name in file_names:
+            with open(os.path.join(serial_folder, 'data', file_name)) as expected, \
+                    open(os.path.join(parallel_folder, 'data', file_name)) as result:
+                self.assertEqual(expected.read(), result.read())
+        for file_name in ['summary.parquet', 'cutoff_values.parquet', 'stats.parquet']:
+            pd.testing.assert_frame_equal(pd.read_parquet(os.path.join(serial_folder, file_name)),
+                                          pd.read_parquet(os.path.join(parallel_folder, file_name)))
 
 
 if __name__ == '__main__':